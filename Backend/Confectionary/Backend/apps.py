@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class DjangoAppConfig(AppConfig):
     name = 'Backend'
+
+    def ready(self):
+        # подключаем обработчики сигналов записи, сбрасывающие кеш ответов и кеш токенов
+        from . import cache, authentication
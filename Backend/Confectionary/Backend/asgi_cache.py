@@ -0,0 +1,107 @@
+import hashlib
+
+from asgiref.sync import sync_to_async
+from django.core.cache.backends.locmem import LocMemCache
+from django.urls import resolve, Resolver404
+from django.utils.encoding import escape_uri_path, iri_to_uri
+from django.utils.http import parse_etags
+
+from .cache import response_cache, get_versions, response_key, cached_views
+
+# Асинхронная выдача кешированных ответов под ASGI (Confectionary/asgi.py).
+# Django 3.0 не поддерживает асинхронные представления и ORM: любое представление под ASGI выполняется в потоке
+# (sync_to_async), со всеми промежуточными слоями и DRF. Маршрутизатор отвечает на анонимные GET-запросы
+# к представлениям с cached_response (recipes_all, recipe_info, client_info и другие) сам, в цикле событий:
+# ключ ответа считается так же, как в cached_response (cache.py), и готовый ответ - статус, заголовки и тело,
+# в том виде, в каком его отдал Django, - берётся из кеша ответов; совпавший If-None-Match - ответ 304.
+# Промах передаётся приложению Django, а успешный ответ с тем же ETag сохраняется для следующих запросов.
+# Запросы с токеном (в том числе recipe_grade_check) всегда идут в Django: им нужна БД.
+# Кеш в памяти процесса читается прямо в цикле событий, внешний (файловый, Redis) - в потоке.
+# При нескольких процессах сервера кеш ответов обязан быть внешним: LocMemCache каждого процесса не видит
+# новых номеров версий, увеличенных записями в других процессах, и отдавал бы устаревшие ответы (см. README).
+
+# заголовки запроса, от которых зависит готовый ответ: формат (JSON:API или страница DRF) и CORS
+varying_headers = (b'accept', b'origin')
+
+
+class CachedResponseRouter:
+    def __init__(self, application):
+        self.application = application
+
+    @staticmethod
+    async def call_cache(function, *args):
+        if isinstance(response_cache(), LocMemCache):
+            return function(*args)
+        return await sync_to_async(function, thread_sensitive=False)(*args)
+
+    @staticmethod
+    def view_scopes(path):
+        # области данных ответа представления по пути запроса или None, если ответ не кешируется
+        try:
+            match = resolve(path)
+        except Resolver404:
+            return None
+        # представление DRF (api_view) называется и размещается как исходная функция
+        scopes = cached_views.get('%s.%s' % (match.func.__module__, match.func.__name__), None)
+        if scopes is None:
+            return None
+        return [scope.format(**match.kwargs) for scope in scopes]
+
+    @staticmethod
+    def lookup(full_path, scopes, variant):
+        # (ключ ответа, готовый ответ или None)
+        key = response_key(full_path, get_versions(scopes))
+        return key, response_cache().get('asgi:%s:%s' % (key, variant))
+
+    @staticmethod
+    def store(key, variant, response):
+        response_cache().set('asgi:%s:%s' % (key, variant), response)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'GET':
+            return await self.application(scope, receive, send)
+        headers = dict(scope['headers'])
+        if b'authorization' in headers:
+            return await self.application(scope, receive, send)
+        scopes = self.view_scopes(scope['path'])
+        if scopes is None:
+            return await self.application(scope, receive, send)
+
+        # полный путь - как request.get_full_path()
+        query_string = scope['query_string'].decode('latin-1')
+        full_path = escape_uri_path(scope['path']) + ('?' + iri_to_uri(query_string) if query_string else '')
+        variant = hashlib.md5(repr([headers.get(name, b'') for name in varying_headers]).encode()).hexdigest()
+        key, cached = await self.call_cache(self.lookup, full_path, scopes, variant)
+        etag = '"%s"' % key
+
+        if etag in parse_etags(headers.get(b'if-none-match', b'').decode('latin-1')):
+            await send({
+                'type': 'http.response.start',
+                'status': 304,
+                'headers': [(b'etag', etag.encode()), (b'vary', b'Authorization')],
+            })
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        if cached is not None:
+            status, response_headers, body = cached
+            await send({'type': 'http.response.start', 'status': status, 'headers': response_headers})
+            await send({'type': 'http.response.body', 'body': body})
+            return
+
+        response = {}
+        chunks = []
+
+        async def capture(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+                response['headers'] = [(bytes(name), bytes(value)) for name, value in message.get('headers', [])]
+            elif message['type'] == 'http.response.body':
+                chunks.append(message.get('body', b''))
+            await send(message)
+
+        await self.application(scope, receive, capture)
+
+        # сохраняется только успешный ответ cached_response при тех же версиях и без cookie
+        names = {name.lower(): value for name, value in response.get('headers', [])}
+        if response.get('status') == 200 and names.get(b'etag') == etag.encode() and b'set-cookie' not in names:
+            await self.call_cache(self.store, key, variant, (200, response['headers'], b''.join(chunks)))
@@ -0,0 +1,148 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils.translation import gettext_lazy as _
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+
+from .models import Client
+
+# Аутентификация по токену без запроса к БД на каждый запрос (настройка AUTH_TOKEN_CACHE).
+# Токен -> (пользователь, токен) хранится в LRU процесса (до MAX_ENTRIES записей, каждая не дольше LOCAL_TTL секунд)
+# и, если задан, в общем кеше CACHE (SHARED_TTL секунд); БД читается только при промахе обоих.
+# Общий кеш должен быть общим для всех процессов сервера (Redis, FileBasedCache): кеш, существующий только внутри
+# процесса (LocMemCache, DummyCache), как общий не используется - иначе отозванный в одном процессе токен
+# принимался бы остальными до SHARED_TTL секунд.
+# Удаление токена (выход - TokenDestroyView) и сохранение пользователя через save() (в том числе блокировка, status='B')
+# удаляют записи из общего кеша и из LRU этого процесса сразу; в остальных процессах сервера копия в LRU живёт
+# не дольше LOCAL_TTL секунд - это наибольшая задержка отзыва. Заблокированный пользователь не проходит
+# аутентификацию и с действующим токеном.
+# Изменение пользователей через QuerySet.update() (например, Client.objects.filter(...).update(status='B'))
+# не отправляет post_save: после такой блокировки нужно вызвать revoke_client_tokens(ids), иначе
+# пользователь остаётся аутентифицированным до истечения записей кеша.
+
+
+class TokenCache:
+    def __init__(self, max_entries=10000, local_ttl=5, shared_ttl=60, cache_alias=None):
+        self.max_entries = max_entries
+        self.local_ttl = local_ttl
+        self.shared_ttl = shared_ttl
+        self.cache_alias = cache_alias
+        # ключ токена -> ((пользователь, токен), момент устаревания по time.monotonic)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        options = getattr(settings, 'AUTH_TOKEN_CACHE', {})
+        return cls(
+            max_entries=options.get('MAX_ENTRIES', 10000),
+            local_ttl=options.get('LOCAL_TTL', 5),
+            shared_ttl=options.get('SHARED_TTL', 60),
+            cache_alias=options.get('CACHE', None),
+        )
+
+    def cache(self):
+        # общий кеш; None - не задан или существует только внутри процесса
+        if self.cache_alias is None:
+            return None
+        cache = caches[self.cache_alias]
+        if isinstance(cache, (LocMemCache, DummyCache)):
+            return None
+        return cache
+
+    def cache_key(self, key):
+        return 'auth_token:%s' % key
+
+    def get(self, key):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is not None:
+                if entry[1] > now:
+                    self.entries.move_to_end(key)
+                    return entry[0]
+                del self.entries[key]
+        cache = self.cache()
+        if cache is None:
+            return None
+        value = cache.get(self.cache_key(key))
+        if value is not None:
+            self.remember(key, value)
+        return value
+
+    def set(self, key, value):
+        cache = self.cache()
+        if cache is not None:
+            cache.set(self.cache_key(key), value, timeout=self.shared_ttl)
+        self.remember(key, value)
+
+    def remember(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.local_ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def revoke(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+        cache = self.cache()
+        if cache is not None and keys:
+            cache.delete_many([self.cache_key(key) for key in keys])
+
+
+token_cache = TokenCache.from_settings()
+
+
+def revoke_client_tokens(client_ids):
+    # сброс кеша токенов пользователей, изменённых в обход save() (QuerySet.update, пакетная блокировка)
+    keys = list(Token.objects.filter(user_id__in=client_ids).values_list('key', flat=True))
+    token_cache.revoke(*keys)
+    return keys
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    def authenticate_credentials(self, key):
+        cached = token_cache.get(key)
+        if cached is None:
+            try:
+                token = self.get_model().objects.select_related('user').get(key=key)
+            except self.get_model().DoesNotExist:
+                raise AuthenticationFailed(_('Invalid token.'))
+            cached = (token.user, token)
+            token_cache.set(key, cached)
+
+        user, token = cached
+        if not user.is_active or user.status != 'A':
+            raise AuthenticationFailed(_('User inactive or deleted.'))
+        # копия: представления могут менять и сохранять request.user, общая запись кеша при этом не меняется
+        return copy.copy(user), token
+
+
+
+##### Сброс кеша по сигналам записи #####
+
+@receiver(post_delete, sender=Token)
+def token_deleted_handler(sender, instance, **kwargs):
+    token_cache.revoke(instance.key)
+
+
+@receiver(post_save, sender=Client)
+def client_saved_handler(sender, instance, created, **kwargs):
+    # блокировка и правка профиля: в кеше не должно остаться прежней копии пользователя;
+    # повторно - после фиксации транзакции, иначе параллельный запрос успел бы снова закешировать старую строку
+    if not created:
+        keys = revoke_client_tokens([instance.id])
+        transaction.on_commit(lambda: token_cache.revoke(*keys))
@@ -0,0 +1,162 @@
+import functools
+import hashlib
+import time
+
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_in
+from django.core.cache import caches
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
+from rest_framework import status
+from rest_framework.response import Response
+
+from .signals import recipe_changed, recipe_grade_changed, comment_changed, client_changed, rankings_changed, \
+    recommendations_changed
+
+# Кеш ответов на анонимные GET-запросы чтения.
+# Ответ зависит от областей данных: 'recipes' (списки рецептов), 'recipe:<id>' (страница рецепта),
+# 'client:<id>' (страница пользователя), 'clients' (имена и аватарки авторов на карточках и страницах рецептов),
+# 'ingredient_index' (поиск по ингредиентам; версия растёт, когда процесс заменяет индекс, см. ingredients.py).
+# У каждой области есть номер версии; ключ ответа содержит номера версий его областей, поэтому запись, увеличившая
+# номер версии, делает все зависимые ответы ненайденными, а сами устаревшие записи вытесняет хранилище кеша
+# (LRU и время жизни задаются в CACHES). Ключ ответа служит и ETag: If-None-Match проверяется без чтения ответа.
+# Хранилище должно быть общим для всех процессов сервера (файловый кеш или Redis), если процессов несколько.
+
+
+def response_cache():
+    return caches[getattr(settings, 'RESPONSE_CACHE_ALIAS', 'default')]
+
+
+def version_key(scope):
+    return 'version:%s' % scope
+
+
+def initial_version():
+    # номер версии, вытесненный из кеша, создаётся заново большим всех прежних,
+    # иначе ответы, сохранённые при старых номерах, снова стали бы действительными
+    return int(time.time() * 1000000)
+
+
+def get_versions(scopes):
+    cache = response_cache()
+    keys = [version_key(scope) for scope in scopes]
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        # add не перезаписывает номер, успевший появиться из другого процесса
+        for key in missing:
+            cache.add(key, initial_version(), timeout=None)
+        versions.update(cache.get_many(missing))
+    return [versions.get(key, 0) for key in keys]
+
+
+def bump_versions(*scopes):
+    cache = response_cache()
+    for scope in scopes:
+        key = version_key(scope)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, initial_version(), timeout=None)
+
+
+# 'модуль.имя' представления с cached_response -> шаблоны областей его ответа (для маршрутизатора ASGI, asgi_cache.py)
+cached_views = {}
+
+
+def response_key(full_path, versions):
+    # ключ ответа и его ETag: полный путь запроса и номера версий его областей
+    return hashlib.md5(('%s|%s' % (full_path, versions)).encode()).hexdigest()
+
+
+def cached_response(*scopes):
+    # scopes - шаблоны областей данных ответа с именованными аргументами представления, например 'recipe:{pk}'
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            # авторизованным пользователям ответ не кешируется
+            if request.method != 'GET' or request.user.is_authenticated:
+                return view(request, *args, **kwargs)
+
+            versions = get_versions([scope.format(**kwargs) for scope in scopes])
+            key = response_key(request.get_full_path(), versions)
+            etag = '"%s"' % key
+
+            if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+                response = Response(status=status.HTTP_304_NOT_MODIFIED)
+            else:
+                cache = response_cache()
+                data = cache.get('response:%s' % key)
+                if data is None:
+                    response = view(request, *args, **kwargs)
+                    # кешируются только успешные ответы
+                    if response.status_code != status.HTTP_200_OK:
+                        return response
+                    cache.set('response:%s' % key, response.data)
+                else:
+                    response = Response(data=data, status=status.HTTP_200_OK)
+            response['ETag'] = etag
+            patch_vary_headers(response, ['Authorization'])
+            return response
+        cached_views['%s.%s' % (view.__module__, view.__name__)] = scopes
+        return wrapper
+    return decorator
+
+
+
+##### Сброс версий по сигналам записи #####
+
+def neighbour_scopes(recipe_id):
+    # страницы рецептов, среди похожих на которые выводится карточка рецепта recipe_id
+    from .models import RecipeNeighbour
+
+    return ['recipe:%s' % pk for pk in
+            RecipeNeighbour.objects.filter(neighbour_id=recipe_id).values_list('recipe_id', flat=True)]
+
+
+@receiver(recipe_changed)
+def recipe_changed_handler(sender, recipe_id, **kwargs):
+    # 'ingredients' - версия индекса ингредиентов (ingredients.py), 'facets' - фасетов выдачи (facets.py)
+    bump_versions('recipes', 'recipe:%s' % recipe_id, 'ingredients', 'facets', *neighbour_scopes(recipe_id))
+
+
+@receiver(recipe_grade_changed)
+def recipe_grade_changed_handler(sender, recipe_id, **kwargs):
+    # рейтинг выводится на карточках, на странице рецепта и в похожих рецептах других страниц
+    bump_versions('recipes', 'recipe:%s' % recipe_id, *neighbour_scopes(recipe_id))
+
+
+@receiver(pre_delete, sender='Backend.Recipe')
+def recipe_deleted_handler(sender, instance, **kwargs):
+    # строки соседей удаляются вместе с рецептом, поэтому страницы с его карточкой сбрасываются до удаления
+    bump_versions(*neighbour_scopes(instance.id))
+
+
+@receiver(comment_changed)
+def comment_changed_handler(sender, recipe_id, **kwargs):
+    bump_versions('recipe:%s' % recipe_id)
+
+
+@receiver(rankings_changed)
+def rankings_changed_handler(sender, **kwargs):
+    bump_versions('recipes')
+
+
+@receiver(recommendations_changed)
+def recommendations_changed_handler(sender, recipe_ids, **kwargs):
+    # похожие рецепты выводятся на странице рецепта
+    bump_versions(*['recipe:%s' % recipe_id for recipe_id in recipe_ids])
+
+
+@receiver(client_changed)
+def client_changed_handler(sender, client_id, **kwargs):
+    # фасеты зависят от логинов авторов (фильтр author)
+    bump_versions('clients', 'client:%s' % client_id, 'facets')
+
+
+@receiver(user_logged_in)
+def client_logged_in_handler(sender, user, **kwargs):
+    # на странице пользователя выводится время последнего входа
+    bump_versions('client:%s' % user.id)
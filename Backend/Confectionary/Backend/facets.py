@@ -0,0 +1,83 @@
+import hashlib
+
+from django.db.models import Count, Q
+
+from .cache import response_cache, get_versions
+from .models import Recipe, Tag, TagWord, Client
+
+# Фильтры и фасеты выдачи рецептов (recipes_search).
+# Фильтры: диапазоны времени приготовления, порций и веса (?cook_time_min=10&cook_time_max=60 ...), теги
+# (?tags=торт,шоколад - рецепт должен иметь все) и логин автора без учёта регистра (?author=...).
+# Фасеты - количество отобранных рецептов по интервалам каждого числового поля и самые частые теги отобранных рецептов.
+# Они не зависят от страницы и порядка выдачи, поэтому считаются один раз на набор фильтров (двумя запросами:
+# все гистограммы - одной условной агрегацией, теги - группировкой) и хранятся в кеше ответов до изменения
+# рецептов или профилей (версия области 'facets', см. cache.py; оценки рецептов на фасеты не влияют).
+
+# поле -> границы интервалов гистограммы; интервал включает левую границу и не включает правую
+facet_buckets = {
+    'cook_time': [0, 15, 30, 60, 120, 240, 1441],
+    'portions': [1, 2, 4, 6, 10, 101],
+    'weight': [0, 250, 500, 1000, 2000, 5000, 1000001],
+}
+
+# сколько самых частых тегов выводится в фасете
+facet_tags_quantity = 10
+
+
+def filter_recipes(params, recipes=None):
+    # применяет фильтры из параметров запроса; бросает ValueError при некорректном значении
+    recipes = Recipe.objects.filter(status='A') if recipes is None else recipes
+    for field in facet_buckets:
+        for suffix, lookup in (('_min', '__gte'), ('_max', '__lte')):
+            value = params.get(field + suffix, None)
+            if value not in (None, ''):
+                recipes = recipes.filter(**{field + lookup: int(value)})
+    for word in filter_tags(params):
+        recipes = recipes.filter(id__in=Tag.objects.filter(word__name=word).values('recipe_id'))
+    author = params.get('author', None)
+    if author:
+        recipes = recipes.filter(creator__in=Client.objects.filter(username_key=Client.normalize_username_key(author)))
+    return recipes
+
+
+def filter_tags(params):
+    return sorted({TagWord.normalize(name) for name in params.get('tags', '').split(',') if name.strip()})
+
+
+def filters_key(params):
+    # ключ набора фильтров без параметров страницы и порядка выдачи
+    names = [field + suffix for field in facet_buckets for suffix in ('_min', '_max')] + ['author']
+    values = [(name, params.get(name, '')) for name in names] + [('tags', filter_tags(params))]
+    return hashlib.md5(repr(values).encode()).hexdigest()
+
+
+def compute_facets(recipes):
+    aggregates = {}
+    for field, edges in facet_buckets.items():
+        for index, (low, high) in enumerate(zip(edges, edges[1:])):
+            bucket = Q(**{field + '__gte': low, field + '__lt': high})
+            aggregates['%s_%i' % (field, index)] = Count('id', filter=bucket)
+    counts = recipes.aggregate(**aggregates)
+
+    facets = {}
+    for field, edges in facet_buckets.items():
+        facets[field] = [
+            {'min': low, 'max': high - 1, 'count': counts['%s_%i' % (field, index)]}
+            for index, (low, high) in enumerate(zip(edges, edges[1:]))
+        ]
+    tags = Tag.objects.filter(recipe__in=recipes).values('word__name').annotate(
+        recipes_count=Count('recipe', distinct=True)
+    ).order_by('-recipes_count', 'word__name')[:facet_tags_quantity]
+    facets['tags'] = [{'name': tag['word__name'], 'recipes_count': tag['recipes_count']} for tag in tags]
+    return facets
+
+
+def recipe_facets(params, recipes):
+    # фасеты отобранных рецептов recipes (filter_recipes(params)) из кеша или с подсчётом
+    cache = response_cache()
+    key = 'facets:%s:%s' % (filters_key(params), get_versions(['facets'])[0])
+    facets = cache.get(key)
+    if facets is None:
+        facets = compute_facets(recipes)
+        cache.set(key, facets)
+    return facets
@@ -0,0 +1,108 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.hashers import check_password, make_password
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+# Проверка и вычисление хешей паролей (вход, смена пароля) в ограниченном пуле потоков (настройка PASSWORD_HASHING).
+# Одновременно считается не больше WORKERS хешей, ещё до QUEUE ждут в очереди; остальные запросы сразу, а ждущие
+# дольше WAIT секунд - по истечении ожидания получают 503 с заголовком Retry-After, и всплеск входов не занимает
+# все рабочие процессы сервера. Потоков достаточно: PBKDF2 (hashlib) считается без GIL.
+# Задачи пула не обращаются к БД: в пул передаётся только пароль и хеш, запись - в потоке запроса.
+# Хеш, вычисленный не первым алгоритмом PASSWORD_HASHERS или с другими параметрами, при успешном входе
+# пересчитывается текущим алгоритмом (сравнить алгоритмы - команда bench_hashers).
+
+
+class HashingBusy(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Сервер занят проверкой паролей, повторите запрос позже.'
+    default_code = 'hashing_busy'
+
+    def __init__(self, wait, detail=None, code=None):
+        super().__init__(detail, code)
+        # значение заголовка Retry-After (см. rest_framework.views.exception_handler)
+        self.wait = wait
+
+
+class HashingPool:
+    def __init__(self, workers=2, queue_size=20, wait=5, retry_after=2):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.wait = wait
+        self.retry_after = retry_after
+        # места выполняемых и ожидающих задач
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hashing')
+
+    @classmethod
+    def from_settings(cls):
+        options = getattr(settings, 'PASSWORD_HASHING', {})
+        return cls(
+            workers=options.get('WORKERS', 2),
+            queue_size=options.get('QUEUE', 20),
+            wait=options.get('WAIT', 5),
+            retry_after=options.get('RETRY_AFTER', 2),
+        )
+
+    def run(self, function, *args):
+        if not self.slots.acquire(blocking=False):
+            raise HashingBusy(self.retry_after)
+        try:
+            future = self.executor.submit(function, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        # место освобождается по завершении задачи, даже если запрос её уже не ждёт
+        future.add_done_callback(lambda _: self.slots.release())
+        try:
+            return future.result(timeout=self.wait)
+        except FutureTimeoutError:
+            future.cancel()
+            raise HashingBusy(self.retry_after)
+
+
+hashing_pool = HashingPool.from_settings()
+
+
+def verify_password(password, encoded):
+    # (пароль верен, новый хеш текущим алгоритмом или None, если пересчёт не нужен)
+    upgraded = []
+    valid = check_password(password, encoded, setter=lambda raw: upgraded.append(make_password(raw)))
+    return valid, upgraded[0] if upgraded else None
+
+
+def check_client_password(client, password):
+    valid, upgraded = hashing_pool.run(verify_password, password, client.password)
+    if upgraded is not None:
+        client.password = upgraded
+        client.save(update_fields=['password'])
+    return valid
+
+
+def set_client_password(client, password):
+    client.password = hashing_pool.run(make_password, password)
+    # как в AbstractBaseUser.set_password: после сохранения пароль передаётся валидаторам (password_changed)
+    client._password = password
+
+
+class PooledModelBackend(ModelBackend):
+    # ModelBackend с проверкой пароля в пуле
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        user_model = get_user_model()
+        if username is None:
+            username = kwargs.get(user_model.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
+        try:
+            user = user_model._default_manager.get_by_natural_key(username)
+        except user_model.DoesNotExist:
+            # хеш считается и для несуществующего логина: время ответа не выдаёт, есть ли такой пользователь
+            hashing_pool.run(make_password, password)
+            return None
+        if check_client_password(user, password) and self.user_can_authenticate(user):
+            return user
+        return None
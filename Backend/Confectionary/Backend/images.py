@@ -0,0 +1,87 @@
+import hashlib
+import io
+import posixpath
+
+from PIL import Image, ImageOps
+from django.core.files.base import ContentFile
+
+# Производные изображения (уменьшенные копии в WebP) хранятся рядом с оригиналом под именем
+# <имя оригинала>_<хеш содержимого>_<размер>.webp, поэтому их можно кешировать в браузере без ограничения срока.
+# Имя оригинала в каталоге уникально (хранилище не перезаписывает файлы), поэтому одинаковые изображения разных
+# записей не делят копии и удаление копий одной записи не затрагивает другую.
+
+# имя размера -> наибольшая сторона изображения в пикселях
+derivative_sizes = {
+    'card': 480,
+    'page': 1080,
+    'full': 2048,
+}
+derivative_format = 'WEBP'
+derivative_quality = 80
+digest_length = 16
+
+
+def derivative_name(name, digest, size):
+    stem = posixpath.splitext(posixpath.basename(name))[0]
+    return posixpath.join(posixpath.dirname(name), '%s_%s_%s.webp' % (stem, digest, size))
+
+
+def derivative_url(field_file, digest, size):
+    return field_file.storage.url(derivative_name(field_file.name, digest, size))
+
+
+def read_file(field_file):
+    # читаем по текущему имени через хранилище: FieldFile.open() переоткрыл бы прежний файл, если имя поля сменилось
+    with field_file.storage.open(field_file.name, 'rb') as file:
+        return file.read()
+
+
+def make_derivatives(field_file):
+    # записывает производные изображения для файла поля и возвращает хеш содержимого оригинала
+    data = read_file(field_file)
+    digest = hashlib.sha256(data).hexdigest()[:digest_length]
+
+    image = Image.open(io.BytesIO(data))
+    # поворачиваем по EXIF до удаления метаданных: производные сохраняются без EXIF
+    image = ImageOps.exif_transpose(image)
+    image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+
+    storage = field_file.storage
+    for size, max_side in derivative_sizes.items():
+        name = derivative_name(field_file.name, digest, size)
+        if storage.exists(name):
+            continue
+        resized = image.copy()
+        resized.thumbnail((max_side, max_side), Image.LANCZOS)
+        buffer = io.BytesIO()
+        resized.save(buffer, derivative_format, quality=derivative_quality, method=4)
+        storage.save(name, ContentFile(buffer.getvalue()))
+    return digest
+
+
+def derivative_names(name, digest):
+    if not (name and digest):
+        return []
+    return [derivative_name(name, digest, size) for size in derivative_sizes]
+
+
+def strip_metadata(field_file):
+    # сохраняет копию оригинала без EXIF (повернув по метке ориентации) под новым именем и переводит на неё поле;
+    # возвращает True, если копия создана. Прежний файл не удаляется: его удаляет вызывающий код после того,
+    # как запись начнёт ссылаться на копию, поэтому сбой пересохранения не оставляет запись без изображения
+    data = read_file(field_file)
+    image = Image.open(io.BytesIO(data))
+    image_format = image.format
+    if not (image.getexif() or 'exif' in image.info):
+        return False
+
+    image = ImageOps.exif_transpose(image)
+    image.info.pop('exif', None)
+    if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, **({'quality': 90} if image_format == 'JPEG' else {}))
+
+    # имя занято оригиналом - хранилище выберет свободное
+    field_file.name = field_file.storage.save(field_file.name, ContentFile(buffer.getvalue()))
+    return True
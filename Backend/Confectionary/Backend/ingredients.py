@@ -0,0 +1,113 @@
+import logging
+import threading
+from collections import defaultdict
+
+import numpy
+from django.db import connection
+
+from .cache import get_versions, bump_versions
+from .models import Ingredient, IngredientWord
+from .search import tokenize
+
+logger = logging.getLogger(__name__)
+
+# Инвертированный индекс ингредиентов для поиска «что испечь из того, что есть».
+# Слово словаря ингредиентов -> отсортированный массив id активных рецептов, где оно встречается. Запрошенный
+# ингредиент - основы слов; ему соответствуют все слова словаря, содержащие эти основы ('масло' - и 'масло
+# сливочное', и 'масло растительное'), и объединение их массивов. Поиск складывает попадания рецептов в массив
+# счётчиков по id рецепта, поэтому «все из X, кроме не более N» и «ни одного из Z» - несколько векторных операций.
+# Индекс строится в памяти процесса одним запросом. Первый поиск после изменения рецептов (номер версии области
+# 'ingredients' кеша ответов, см. cache.py) запускает перестроение в фоновом потоке, а поиски до его окончания
+# читают прежний индекс; готовый индекс подменяет прежний целиком. Ожидает построения только самый первый поиск.
+# Ответы, закешированные по прежнему индексу, вытесняются увеличением версии области 'ingredient_index'.
+
+
+class IngredientIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        # (id слова словаря -> отсортированный массив id рецептов,
+        #  основа слова -> множество id слов словаря, в наименовании которых она есть,
+        #  наибольший id рецепта в индексе + 1); заменяется целиком, поэтому поиск не видит наполовину новый индекс
+        self.state = ({}, {}, 0)
+        # перестроение в фоновом потоке уже идёт
+        self.rebuilding = False
+
+    def refresh(self):
+        version = get_versions(['ingredients'])[0]
+        if version == self.version:
+            return
+        with self.lock:
+            if version == self.version or self.rebuilding:
+                return
+            if self.version is None:
+                # прежнего индекса ещё нет - строим, пока поиск ждёт
+                self.state = self.build()
+                self.version = version
+                return
+            self.rebuilding = True
+        threading.Thread(target=self.rebuild, args=(version,), daemon=True).start()
+
+    def rebuild(self, version):
+        try:
+            state = self.build()
+        except Exception:
+            # прежний индекс продолжает работать, следующий поиск попробует снова
+            logger.exception('Не удалось перестроить индекс ингредиентов')
+        else:
+            with self.lock:
+                self.state = state
+                self.version = version
+            bump_versions('ingredient_index')
+        finally:
+            self.rebuilding = False
+            # соединение с БД открыто этим потоком и больше не понадобится
+            connection.close()
+
+    def build(self):
+        pairs = numpy.array(list(Ingredient.objects.filter(
+            recipe__status='A', word__isnull=False
+        ).values_list('word_id', 'recipe_id').distinct().iterator()), dtype=numpy.int64).reshape(-1, 2)
+        # пары упорядочиваются по слову, внутри слова - по рецепту, и режутся на массивы слов
+        pairs = pairs[numpy.lexsort((pairs[:, 1], pairs[:, 0]))]
+        words, starts = numpy.unique(pairs[:, 0], return_index=True)
+        postings = {int(word): recipes for word, recipes in zip(words, numpy.split(pairs[:, 1], starts[1:]))}
+
+        stems = defaultdict(set)
+        for word_id, name in IngredientWord.objects.values_list('id', 'name').iterator():
+            if word_id not in postings:
+                continue
+            for stem in name.split():
+                stems[stem].add(word_id)
+
+        return postings, dict(stems), int(pairs[:, 1].max()) + 1 if len(pairs) else 0
+
+    @staticmethod
+    def recipes_with(state, name):
+        # отсортированный массив id рецептов с ингредиентом name
+        postings, stems, _ = state
+        words = [stems.get(stem, set()) for stem in set(tokenize(name))]
+        words = set.intersection(*words) if words else set()
+        if not words:
+            return numpy.empty(0, dtype=numpy.int64)
+        return numpy.unique(numpy.concatenate([postings[word] for word in words]))
+
+    def search(self, include, exclude=(), missing=0, limit=1000):
+        # рецепты со всеми ингредиентами include, кроме не более missing, и без ингредиентов exclude:
+        # сначала рецепты с большим числом найденных ингредиентов, затем более новые
+        self.refresh()
+        if not include:
+            return []
+        state = self.state
+        counts = numpy.zeros(state[2], dtype=numpy.int32)
+        for name in include:
+            counts[self.recipes_with(state, name)] += 1
+        found = counts >= max(len(include) - missing, 1)
+        for name in exclude:
+            found[self.recipes_with(state, name)] = False
+        ids = numpy.flatnonzero(found)
+        order = numpy.lexsort((-ids, -counts[ids]))
+        return [int(recipe_id) for recipe_id in ids[order][:limit]]
+
+
+ingredient_index = IngredientIndex()
@@ -0,0 +1,45 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает алгоритмы хеширования паролей: время одного хеша и число хешей в секунду при параллельной ' \
+           'проверке (для выбора PASSWORD_HASHERS и PASSWORD_HASHING).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('hashers', nargs='*',
+                            help='Пути к классам алгоритмов (по умолчанию - PASSWORD_HASHERS).')
+        parser.add_argument('--rounds', type=int, default=20,
+                            help='Количество хешей на одно измерение.')
+        parser.add_argument('--threads', default='1,2,4',
+                            help='Числа потоков для измерения пропускной способности через запятую.')
+
+    def handle(self, *args, **options):
+        rounds = options['rounds']
+        threads = [int(value) for value in options['threads'].split(',')]
+        for path in options['hashers'] or settings.PASSWORD_HASHERS:
+            hasher = import_string(path)()
+            password = 'bench-password'
+            try:
+                encoded = hasher.encode(password, hasher.salt())
+            except ValueError as error:
+                # библиотека алгоритма (argon2-cffi, bcrypt) не установлена
+                self.stdout.write(self.style.WARNING('%s: %s' % (hasher.algorithm, error)))
+                continue
+
+            started = time.perf_counter()
+            for _ in range(rounds):
+                hasher.verify(password, encoded)
+            single = (time.perf_counter() - started) / rounds
+            self.stdout.write(self.style.SUCCESS('%s: %.1f мс на проверку' % (hasher.algorithm, single * 1000)))
+
+            for count in threads:
+                with ThreadPoolExecutor(max_workers=count) as executor:
+                    started = time.perf_counter()
+                    list(executor.map(lambda _: hasher.verify(password, encoded), range(rounds * count)))
+                    elapsed = time.perf_counter() - started
+                self.stdout.write('  потоков %i: %.1f проверок/с' % (count, rounds * count / elapsed))
@@ -0,0 +1,59 @@
+import statistics
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Нагружает запущенный сервер параллельными GET-запросами и выводит пропускную способность и задержки ' \
+           '(для сравнения развёртываний WSGI и ASGI).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('urls', nargs='+',
+                            help='Адреса запросов; запросы распределяются по ним по очереди.')
+        parser.add_argument('--requests', type=int, default=2000,
+                            help='Общее количество запросов.')
+        parser.add_argument('--concurrency', type=int, default=50,
+                            help='Количество одновременных запросов.')
+        parser.add_argument('--token', default=None,
+                            help='Токен пользователя для заголовка Authorization (по умолчанию - анонимные запросы).')
+        parser.add_argument('--warmup', type=int, default=100,
+                            help='Количество запросов до начала измерения (заполняют кеши).')
+
+    def request(self, url, token):
+        headers = {'Authorization': 'Token %s' % token} if token else {}
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=30) as response:
+                response.read()
+                ok = response.status < 400
+        except (urllib.error.URLError, OSError):
+            ok = False
+        return time.perf_counter() - started, ok
+
+    def run(self, urls, count, concurrency, token):
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return list(executor.map(lambda index: self.request(urls[index % len(urls)], token), range(count)))
+
+    def handle(self, *args, **options):
+        urls = options['urls']
+        self.run(urls, options['warmup'], options['concurrency'], options['token'])
+
+        started = time.perf_counter()
+        results = self.run(urls, options['requests'], options['concurrency'], options['token'])
+        elapsed = time.perf_counter() - started
+
+        latencies = sorted(latency for latency, ok in results if ok)
+        errors = len(results) - len(latencies)
+        if not latencies:
+            self.stdout.write(self.style.ERROR('Все запросы завершились ошибкой'))
+            return
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        self.stdout.write(self.style.SUCCESS('Запросов в секунду: %.1f' % (len(results) / elapsed)))
+        self.stdout.write('Задержка, мс: медиана %.1f, p99 %.1f, наибольшая %.1f' % (
+            statistics.median(latencies) * 1000, p99 * 1000, latencies[-1] * 1000
+        ))
+        self.stdout.write('Ошибок: %i' % errors)
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from Backend.models import Recipe, CookStage
+
+
+class Command(BaseCommand):
+    help = 'Создаёт уменьшенные копии изображений рецептов и этапов, у которых их ещё нет.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help='Пересоздать уменьшенные копии для всех изображений.')
+
+    def handle(self, *args, **options):
+        recipes = Recipe.objects.exclude(avatar='').only('id', 'avatar', 'avatar_digest', 'creator_id')
+        cook_stages = CookStage.objects.exclude(picture='').only('id', 'picture', 'picture_digest', 'recipe_id')
+        if not options['force']:
+            recipes = recipes.filter(avatar_digest='')
+            cook_stages = cook_stages.filter(picture_digest='')
+
+        built = 0
+        for recipe in recipes.iterator():
+            recipe.build_avatar_derivatives()
+            built += 1
+        for cook_stage in cook_stages.iterator():
+            cook_stage.build_picture_derivatives()
+            built += 1
+        self.stdout.write(self.style.SUCCESS('Обработано изображений: %i' % built))
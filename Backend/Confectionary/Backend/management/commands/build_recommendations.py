@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from Backend.recommendations import build_recommendations
+
+
+class Command(BaseCommand):
+    help = 'Строит списки похожих рецептов по наименованиям, ингредиентам, тегам и общим положительным оценкам.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--new', action='store_true',
+                            help='Построить соседей только для рецептов, у которых их ещё нет, '
+                                 'и добавить эти рецепты в списки их соседей.')
+
+    def handle(self, *args, **options):
+        changed = build_recommendations(new_only=options['new'])
+        self.stdout.write(self.style.SUCCESS('Обновлены похожие рецепты у рецептов: %i' % changed))
@@ -0,0 +1,160 @@
+import datetime
+import json
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count, Q, Sum
+from django.utils import timezone
+
+from Backend.models import *
+from Backend.pagination import recipe_orderings, comment_orderings
+from Backend.facets import facet_buckets, filter_recipes
+
+
+class Command(BaseCommand):
+    help = 'Выполняет EXPLAIN для запросов представлений и завершается с ошибкой, ' \
+           'если какой-либо запрос читает таблицу целиком.'
+
+    # запросы, которым полный просмотр разрешён: представление -> причина
+    allowed_scans = {
+        'tags_popular': 'подсчёт рецептов по всему словарю тегов',
+        'ingredient_index': 'индекс ингредиентов строится в памяти по всем ингредиентам активных рецептов',
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument('--plans', action='store_true',
+                            help='Выводить планы всех запросов, а не только найденные полные просмотры.')
+
+    def handle(self, *args, **options):
+        if connection.vendor not in ('mysql', 'sqlite', 'postgresql'):
+            raise CommandError('EXPLAIN не поддерживается для СУБД %s.' % connection.vendor)
+        self.tables = set(connection.introspection.table_names())
+
+        failed = []
+        for view, label, queryset in self.view_queries():
+            plan = self.explain(queryset)
+            scans = self.full_scans(plan)
+            if options['plans']:
+                self.stdout.write('%s (%s):\n%s\n' % (view, label, plan))
+            if not scans:
+                continue
+            if view in self.allowed_scans:
+                self.stdout.write(self.style.WARNING('%s (%s): полный просмотр %s разрешён - %s' % (
+                    view, label, ', '.join(scans), self.allowed_scans[view])))
+            else:
+                failed.append(view)
+                self.stdout.write(self.style.ERROR('%s (%s): полный просмотр %s' % (view, label, ', '.join(scans))))
+
+        if failed:
+            raise CommandError('Полный просмотр таблиц в запросах представлений: %s' % ', '.join(sorted(set(failed))))
+        self.stdout.write(self.style.SUCCESS('Все запросы представлений используют индексы.'))
+
+    def view_queries(self):
+        # запросы строятся так же, как в представлениях; значения параметров берутся из существующих строк
+        recipe = Recipe.objects.values('id', 'creator_id').first() or {'id': 1, 'creator_id': 1}
+        client = Client.objects.values('id', 'username', 'email').first() or \
+            {'id': 1, 'username': 'user', 'email': 'user@example.com'}
+        comment_id = Comment.objects.values_list('id', flat=True).first() or 1
+        word = TagWord.objects.values_list('name', flat=True).first() or 'торт'
+
+        active = Recipe.objects.filter(status='A')
+        for ordering, (field, _) in recipe_orderings.items():
+            yield 'recipes_all', ordering, active.order_by('-' + field, '-id')[:11]
+            yield 'client_recipes', ordering, \
+                active.filter(creator=recipe['creator_id']).order_by('-' + field, '-id')[:11]
+        yield 'recipes_random', 'ids', Recipe.objects.filter(status='A').values_list('id', flat=True)
+        yield 'recipes_by_tag', 'exact', Recipe.objects.filter(
+            status='A', tag_words__in=TagWord.objects.filter(name=word)
+        ).distinct().order_by('-date_init', '-id')[:11]
+        yield 'recipes_by_tag', 'prefix', TagWord.objects.filter(name__gte=word, name__lt=word + '\uffff')
+        yield 'ingredient_index', 'build', Ingredient.objects.filter(
+            recipe__status='A', word__isnull=False
+        ).values_list('word_id', 'recipe_id').distinct()
+        for field in facet_buckets:
+            yield 'recipes_search', field, filter_recipes({field + '_min': '1', field + '_max': '10'}).order_by(
+                '-date_init', '-id'
+            )[:11]
+        yield 'recipes_by_title', 'cards', Recipe.objects.select_related('creator').filter(
+            id__in=[recipe['id']], status='A'
+        )
+        yield 'recipes_by_author', 'prefix', active.filter(
+            creator__in=Client.objects.username_prefix(client['username'])
+        ).order_by('-date_init', '-id')[:11]
+        yield 'authors_autocomplete', 'prefix', Client.objects.username_prefix(client['username']).filter(
+            status='A'
+        ).order_by('username_key')[:10]
+        yield 'author_recipes', 'new', active.filter(creator=recipe['creator_id']).order_by('-date_init', '-id')[:11]
+        yield 'tags_popular', 'aggregate', TagWord.objects.filter(tags__recipe__status='A').annotate(
+            recipes_count=Count('tags__recipe', distinct=True)
+        ).order_by('-recipes_count', 'name')[:20]
+
+        yield 'recipe_info', 'recipe', Recipe.objects.select_related('creator').filter(id=recipe['id'], status='A')
+        yield 'recipe_info', 'ingredients', Ingredient.objects.filter(recipe_id__in=[recipe['id']])
+        yield 'recipe_info', 'cook_stages', CookStage.objects.filter(recipe_id__in=[recipe['id']])
+        yield 'recipe_info', 'tags', Tag.objects.filter(recipe_id__in=[recipe['id']])
+        yield 'recipe_info', 'similar', Recipe.objects.filter(
+            neighbour_of__recipe_id=recipe['id'], status='A'
+        ).order_by('-neighbour_of__score', 'id')
+        comments = Comment.objects.select_related('creator').filter(recipe_id=recipe['id'], status='A')
+        for ordering, (field, _) in comment_orderings.items():
+            yield 'recipe_comments', ordering, comments.order_by('-' + field, '-id')[:11]
+
+        yield 'client_info', 'client', Client.objects.filter(id=client['id'])
+        yield 'login', 'username', Client.objects.filter(username=client['username'])
+        yield 'login', 'email', Client.objects.filter(email=client['email'])
+
+        yield 'recipe_edit', 'recipe', Recipe.objects.filter(id=recipe['id'], creator=recipe['creator_id'], status='A')
+        yield 'recipe_grade_check', 'grade', RecipeGrade.objects.filter(
+            status='A', evaluator=client['id'], recipe__in=Recipe.objects.filter(id=recipe['id'], status='A')
+        )
+        yield 'recipes_recommended', 'neighbours', RecipeNeighbour.objects.filter(
+            recipe_id__in=[recipe['id']]
+        ).exclude(
+            neighbour_id__in=RecipeGrade.objects.filter(evaluator=client['id'], status='A').values('recipe_id')
+        ).values('neighbour_id').annotate(total=Sum('score')).order_by('-total', 'neighbour_id')[:200]
+        yield 'comment_grade_check', 'grade', CommentGrade.objects.filter(
+            status='A', evaluator=client['id'], comment__in=Comment.objects.filter(id=comment_id, status='A')
+        )
+
+        since = timezone.now() - datetime.timedelta(days=7)
+        yield 'refresh_rankings', 'grades', RecipeGrade.objects.filter(date_change__gte=since, status='A')
+        yield 'refresh_rankings', 'comments', Comment.objects.filter(date_init__gte=since, status='A')
+        yield 'refresh_rankings', 'current', Recipe.objects.filter(
+            Q(status='A', trending__gt=0) | Q(status='A', trending__lt=0)
+        )
+
+        yield 'media_jobs', 'own', MediaJob.objects.filter(creator=client['id']).order_by('-id')[:50]
+        yield 'media_worker', 'claim', MediaJob.objects.filter(
+            status__in=['Q', 'R'], run_after__lte=timezone.now()
+        ).order_by('run_after', 'id')[:1]
+
+    def explain(self, queryset):
+        if connection.vendor == 'mysql':
+            return queryset.explain(format='json')
+        return queryset.explain()
+
+    def full_scans(self, plan):
+        # имена таблиц, которые план читает целиком
+        if connection.vendor == 'mysql':
+            return sorted(set(self.mysql_full_scans(json.loads(plan))))
+        if connection.vendor == 'postgresql':
+            return sorted(set(re.findall(r'Seq Scan on (\S+)', plan)))
+        # SQLite: "SCAN TABLE x" без "USING ... INDEX" - чтение всей таблицы (U0, U1... - таблицы подзапросов)
+        scans = set()
+        for line in plan.splitlines():
+            match = re.search(r'\bSCAN (?:TABLE )?(\S+)', line)
+            if match and 'USING' not in line and (match.group(1) in self.tables or re.match(r'U\d+$', match.group(1))):
+                scans.add(match.group(1))
+        return sorted(scans)
+
+    def mysql_full_scans(self, node):
+        # access_type "ALL" в плане формата JSON - полный просмотр таблицы
+        if isinstance(node, dict):
+            if node.get('access_type') == 'ALL':
+                yield node.get('table_name', '?')
+            for value in node.values():
+                yield from self.mysql_full_scans(value)
+        elif isinstance(node, list):
+            for value in node:
+                yield from self.mysql_full_scans(value)
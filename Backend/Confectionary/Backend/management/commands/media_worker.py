@@ -0,0 +1,52 @@
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from Backend.media_queue import work, worker_process
+
+
+class Command(BaseCommand):
+    help = 'Запускает обработчики очереди медиафайлов (уменьшенные копии, удаление EXIF, удаление файлов).'
+
+    # пауза между проверками дочерних процессов, в секундах
+    supervise_interval = 1.0
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=2,
+                            help='Количество процессов-обработчиков.')
+        parser.add_argument('--poll', type=float, default=1.0,
+                            help='Пауза между опросами пустой очереди, в секундах.')
+        parser.add_argument('--once', action='store_true',
+                            help='Завершить работу, как только очередь опустеет.')
+
+    def handle(self, *args, **options):
+        if options['processes'] <= 1:
+            processed = work(options['poll'], options['once'])
+            self.stdout.write(self.style.SUCCESS('Выполнено задач: %i' % processed))
+            return
+
+        # соединения с БД не должны наследоваться дочерними процессами
+        connections.close_all()
+        workers = [self.start_worker(options) for _ in range(options['processes'])]
+        try:
+            # упавший обработчик перезапускается; с --once успешно завершившиеся больше не запускаются
+            while workers:
+                time.sleep(self.supervise_interval)
+                for index, worker in reversed(list(enumerate(workers))):
+                    if worker.is_alive():
+                        continue
+                    if options['once'] and worker.exitcode == 0:
+                        del workers[index]
+                        continue
+                    self.stderr.write('Обработчик %s завершился с кодом %s, перезапуск' % (worker.pid, worker.exitcode))
+                    workers[index] = self.start_worker(options)
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
+
+    def start_worker(self, options):
+        worker = multiprocessing.Process(target=worker_process, args=(options['poll'], options['once']), daemon=True)
+        worker.start()
+        return worker
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from Backend.models import Recipe
+from Backend.search import search_index
+
+
+class Command(BaseCommand):
+    help = 'Пересоздаёт полнотекстовый индекс рецептов по данным БД.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Количество рецептов, загружаемых из БД за один проход.')
+
+    def handle(self, *args, **options):
+        recipes = Recipe.objects.prefetch_related('tags', 'ingredients', 'cook_stages').order_by('id')
+        # iterator() не поддерживает prefetch_related в Django 3.0, поэтому читаем выборку частями по id
+        indexed = search_index.rebuild(self.chunked(recipes, options['chunk_size']))
+        self.stdout.write(self.style.SUCCESS('Проиндексировано рецептов: %i' % indexed))
+
+    def chunked(self, recipes, chunk_size):
+        last_id = 0
+        while True:
+            chunk = list(recipes.filter(id__gt=last_id)[:chunk_size])
+            if not chunk:
+                break
+            yield from chunk
+            last_id = chunk[-1].id
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Q
+
+from Backend.models import Recipe, Comment
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает хранимые счётчики оценок рецептов и комментариев по строкам RecipeGrade и CommentGrade.'
+
+    # (модель, связь с оценками, подпись в отчёте)
+    rated_models = [
+        (Recipe, 'recipe_grades', 'рецептов'),
+        (Comment, 'comment_grades', 'комментариев'),
+    ]
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Количество объектов в одном пакетном UPDATE.')
+
+    def handle(self, *args, **options):
+        for model, grades, label in self.rated_models:
+            fixed = self.recount(model, grades, options['batch_size'])
+            self.stdout.write(self.style.SUCCESS('Исправлено %s: %i' % (label, fixed)))
+
+    def recount(self, model, grades, batch_size):
+        active = Q(**{grades + '__status': 'A'})
+        objects = model.objects.annotate(
+            upvotes_actual=Count(grades, filter=active & Q(**{grades + '__grade': True})),
+            downvotes_actual=Count(grades, filter=active & Q(**{grades + '__grade': False}))
+        ).only('id', 'upvotes', 'downvotes', 'rating').order_by('id')
+
+        changed = []
+        fixed = 0
+        for obj in objects.iterator():
+            if (obj.upvotes, obj.downvotes, obj.rating) == \
+                    (obj.upvotes_actual, obj.downvotes_actual, obj.upvotes_actual - obj.downvotes_actual):
+                continue
+            obj.upvotes = obj.upvotes_actual
+            obj.downvotes = obj.downvotes_actual
+            obj.rating = obj.upvotes_actual - obj.downvotes_actual
+            changed.append(obj)
+            if len(changed) >= batch_size:
+                model.objects.bulk_update(changed, ['upvotes', 'downvotes', 'rating'])
+                fixed += len(changed)
+                changed = []
+        if changed:
+            model.objects.bulk_update(changed, ['upvotes', 'downvotes', 'rating'])
+            fixed += len(changed)
+        return fixed
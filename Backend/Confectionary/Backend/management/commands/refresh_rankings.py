@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from Backend.rankings import refresh_trending
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает популярность рецептов (лента trending) по недавним оценкам и комментариям.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Количество рецептов в одном пакетном UPDATE.')
+        parser.add_argument('--interval', type=float, default=None,
+                            help='Повторять пересчёт с указанной паузой в секундах (по умолчанию - один раз).')
+
+    def handle(self, *args, **options):
+        while True:
+            changed = refresh_trending(batch_size=options['batch_size'])
+            self.stdout.write(self.style.SUCCESS('Изменена популярность рецептов: %i' % changed))
+            if not options['interval']:
+                return
+            # между пересчётами соединение с БД не удерживается
+            connection.close()
+            time.sleep(options['interval'])
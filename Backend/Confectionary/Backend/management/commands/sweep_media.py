@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+
+from Backend.images import derivative_names
+from Backend.models import Client, Recipe, CookStage
+from Backend.signals import recipe_changed, client_changed
+
+
+class Command(BaseCommand):
+    help = 'Находит ссылки на отсутствующие файлы изображений и пакетно сбрасывает их на изображения по умолчанию.'
+
+    # (модель, поле изображения, поле хеша уменьшенных копий, поле id владельца кешируемых ответов)
+    image_fields = [
+        (Client, 'avatar', None, 'id'),
+        (Recipe, 'avatar', 'avatar_digest', 'id'),
+        (CookStage, 'picture', 'picture_digest', 'recipe_id'),
+    ]
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Только вывести найденные битые ссылки, ничего не изменяя.')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Количество строк в одном пакетном UPDATE.')
+
+    def handle(self, *args, **options):
+        for model, field_name, digest_field, owner_field in self.image_fields:
+            storage = model._meta.get_field(field_name).storage
+            columns = ['id', field_name, digest_field or field_name, owner_field]
+            rows = model.objects.exclude(**{field_name: ''}).values_list(*columns).order_by('id')
+            dangling = [(pk, name, digest, owner_id) for pk, name, digest, owner_id in rows.iterator()
+                        if not storage.exists(name)]
+
+            if not options['dry_run']:
+                reset = {field_name: ''}
+                if digest_field:
+                    reset[digest_field] = ''
+                batch_size = options['batch_size']
+                for start in range(0, len(dangling), batch_size):
+                    batch = dangling[start:start + batch_size]
+                    model.objects.filter(id__in=[pk for pk, _, _, _ in batch]).update(**reset)
+                    # уменьшенные копии без оригинала больше не нужны
+                    if digest_field:
+                        for pk, name, digest, _ in batch:
+                            for derivative in derivative_names(name, digest):
+                                storage.delete(derivative)
+                # ответы из кеша ссылаются на сброшенные файлы
+                for owner_id in {owner_id for _, _, _, owner_id in dangling}:
+                    if model is Client:
+                        client_changed.send(sender=model, client_id=owner_id)
+                    else:
+                        recipe_changed.send(sender=model, recipe_id=owner_id)
+
+            self.stdout.write('%s.%s: битых ссылок - %i' % (model.__name__, field_name, len(dangling)))
@@ -0,0 +1,185 @@
+import datetime
+import logging
+import os
+import shutil
+import time
+import traceback
+
+import django
+from django.apps import apps
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, connection, transaction
+from django.utils import timezone
+
+from .signals import recipe_changed, client_changed
+
+logger = logging.getLogger(__name__)
+
+# Очередь задач обработки медиафайлов хранится в таблице MediaJob.
+# Обработчики запросов только ставят задачи в очередь, а выполняет их команда media_worker:
+# несколько процессов забирают задачи с блокировкой строки и повторяют неудавшиеся с увеличивающейся задержкой.
+# Модели импортируются внутри функций: дочерний процесс, запущенный через spawn, импортирует модуль до django.setup().
+
+max_attempts = 5
+retry_delay = 30
+# задача в статусе 'R' дольше этого срока считается брошенной упавшим обработчиком и выдаётся повторно
+job_timeout = 300
+
+
+def claim_job():
+    from .models import MediaJob
+
+    now = timezone.now()
+    with transaction.atomic():
+        jobs = MediaJob.objects.select_for_update(
+            skip_locked=connection.features.has_select_for_update_skip_locked
+        ).filter(status__in=['Q', 'R'], run_after__lte=now).order_by('run_after', 'id')
+        job = jobs.first()
+        if job is None:
+            return None
+        job.status = 'R'
+        job.attempts += 1
+        job.run_after = now + datetime.timedelta(seconds=job_timeout)
+        job.save(update_fields=['status', 'attempts', 'run_after'])
+    return job
+
+
+def process_recipe_avatar(job):
+    from .models import Recipe
+
+    recipe = Recipe.objects.filter(id=job.target_id).first()
+    # уменьшенные копии уже построены - изображение обработано предыдущей задачей
+    if recipe is None or not recipe.avatar or recipe.avatar_digest:
+        return
+    if not strip_and_replace(Recipe, recipe.id, 'avatar', recipe.avatar):
+        return
+    recipe.build_avatar_derivatives()
+    recipe_changed.send(sender=Recipe, recipe_id=recipe.id)
+
+
+def process_cook_stage_picture(job):
+    from .models import CookStage
+
+    cook_stage = CookStage.objects.select_related('recipe').filter(id=job.target_id).first()
+    if cook_stage is None or not cook_stage.picture or cook_stage.picture_digest:
+        return
+    if not strip_and_replace(CookStage, cook_stage.id, 'picture', cook_stage.picture):
+        return
+    cook_stage.build_picture_derivatives()
+    recipe_changed.send(sender=CookStage, recipe_id=cook_stage.recipe_id)
+
+
+def process_client_avatar(job):
+    from .models import Client
+
+    client = Client.objects.filter(id=job.target_id).first()
+    if client is None or not client.avatar:
+        return
+    old_name = client.avatar.name
+    if strip_and_replace(Client, client.id, 'avatar', client.avatar) and client.avatar.name != old_name:
+        client_changed.send(sender=Client, client_id=client.id)
+
+
+def strip_and_replace(model, pk, field_name, field_file):
+    # удаляет EXIF из изображения записи; False - запись уже ссылается на другой файл и обрабатывать нечего
+    from .images import strip_metadata
+
+    old_name = field_file.name
+    try:
+        if not strip_metadata(field_file):
+            return True
+    except FileNotFoundError:
+        # файл уже удалён - ссылку зачистит команда sweep_media
+        return True
+    except OSError:
+        # файл не читается как изображение - оставляем как есть
+        field_file.name = old_name
+        return True
+
+    storage = field_file.storage
+    new_name = field_file.name
+    if not model.objects.filter(id=pk, **{field_name: old_name}).update(**{field_name: new_name}):
+        # изображение заменили, пока задача выполнялась: копия не нужна
+        storage.delete(new_name)
+        field_file.name = old_name
+        return False
+    # оригинал удаляется только после того, как запись ссылается на копию
+    transaction.on_commit(lambda: storage.delete(old_name))
+    return True
+
+
+def process_delete_files(job):
+    from django.core.files.storage import default_storage
+
+    for path in job.paths.splitlines():
+        default_storage.delete(path)
+
+
+def process_delete_dir(job):
+    for path in job.paths.splitlines():
+        full_path = os.path.join(settings.MEDIA_ROOT, path)
+        if os.path.isdir(full_path):
+            shutil.rmtree(full_path)
+
+
+processors = {
+    'recipe_avatar': process_recipe_avatar,
+    'cook_stage_picture': process_cook_stage_picture,
+    'client_avatar': process_client_avatar,
+    'delete_files': process_delete_files,
+    'delete_dir': process_delete_dir,
+}
+
+
+def run_job(job):
+    from .models import MediaJob
+
+    try:
+        processors[job.kind](job)
+    except Exception:
+        fields = {'last_error': traceback.format_exc()}
+        if job.attempts >= max_attempts:
+            fields['status'] = 'F'
+        else:
+            fields['status'] = 'Q'
+            fields['run_after'] = timezone.now() + datetime.timedelta(seconds=retry_delay * 2 ** (job.attempts - 1))
+        MediaJob.objects.filter(id=job.id).update(**fields)
+        return False
+    MediaJob.objects.filter(id=job.id).update(status='D', date_done=timezone.now(), last_error='')
+    return True
+
+
+def work(poll_interval=1.0, once=False):
+    # once - завершиться, как только очередь опустеет
+    processed = 0
+    while True:
+        # соединение, разорванное сервером БД (MySQL "gone away") или устаревшее по CONN_MAX_AGE, открывается заново
+        close_old_connections()
+        try:
+            job = claim_job()
+        except DatabaseError:
+            if once:
+                raise
+            logger.exception('Не удалось получить задачу из очереди медиафайлов')
+            connection.close()
+            time.sleep(poll_interval)
+            continue
+        if job is None:
+            if once:
+                return processed
+            time.sleep(poll_interval)
+            continue
+        try:
+            run_job(job)
+        except Exception:
+            # не удалось записать итог задачи: она останется в статусе 'R' и будет выдана повторно через job_timeout
+            logger.exception('Не удалось завершить задачу обработки медиафайлов %s', job.id)
+            connection.close()
+        processed += 1
+
+
+def worker_process(poll_interval, once):
+    # точка входа дочернего процесса (при запуске через spawn приложение Django ещё не загружено)
+    if not apps.ready:
+        django.setup()
+    work(poll_interval, once)
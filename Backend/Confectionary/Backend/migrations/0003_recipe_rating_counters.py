@@ -0,0 +1,44 @@
+# Generated by Django 3.0.3 on 2026-10-18 12:40
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def fill_rating_counters(apps, schema_editor):
+    Recipe = apps.get_model('Backend', 'Recipe')
+    active = Q(recipe_grades__status='A')
+    recipes = Recipe.objects.annotate(
+        upvotes_actual=Count('recipe_grades', filter=active & Q(recipe_grades__grade=True)),
+        downvotes_actual=Count('recipe_grades', filter=active & Q(recipe_grades__grade=False))
+    )
+    for recipe in recipes.iterator():
+        recipe.upvotes = recipe.upvotes_actual
+        recipe.downvotes = recipe.downvotes_actual
+        recipe.rating = recipe.upvotes_actual - recipe.downvotes_actual
+        recipe.save(update_fields=['upvotes', 'downvotes', 'rating'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Backend', '0002_auto_20201005_0859'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='downvotes',
+            field=models.IntegerField(default=0, verbose_name='Отрицательные оценки'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='rating',
+            field=models.IntegerField(default=0, verbose_name='Рейтинг'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='upvotes',
+            field=models.IntegerField(default=0, verbose_name='Положительные оценки'),
+        ),
+        migrations.RunPython(fill_rating_counters, migrations.RunPython.noop),
+    ]
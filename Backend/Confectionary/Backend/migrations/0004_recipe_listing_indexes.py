@@ -0,0 +1,21 @@
+# Generated by Django 3.0.3 on 2026-10-18 12:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Backend', '0003_recipe_rating_counters'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['status', 'date_init', 'id'], name='recipe_status_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['status', 'rating', 'id'], name='recipe_status_rating_idx'),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 3.0.3 on 2026-10-18 12:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def normalize(name):
+    return ' '.join(name.split()).casefold().replace('ё', 'е')
+
+
+def fill_tag_dictionary(apps, schema_editor):
+    Tag = apps.get_model('Backend', 'Tag')
+    TagWord = apps.get_model('Backend', 'TagWord')
+    names = {normalize(name) for name in Tag.objects.values_list('name', flat=True).distinct()}
+    TagWord.objects.bulk_create([TagWord(name=name) for name in names], ignore_conflicts=True)
+    words = dict(TagWord.objects.values_list('name', 'id'))
+    for tag in Tag.objects.only('id', 'name').iterator():
+        Tag.objects.filter(id=tag.id).update(word_id=words[normalize(tag.name)])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Backend', '0004_recipe_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TagWord',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=30, unique=True, verbose_name='Наименование')),
+            ],
+            options={
+                'verbose_name': 'Тег словаря',
+                'verbose_name_plural': 'Словарь тегов',
+            },
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='tag_words',
+            field=models.ManyToManyField(related_name='recipes', through='Backend.Tag', to='Backend.TagWord', verbose_name='Теги'),
+        ),
+        migrations.AddField(
+            model_name='tag',
+            name='word',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='tags', to='Backend.TagWord', verbose_name='Тег словаря'),
+        ),
+        migrations.RunPython(fill_tag_dictionary, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='tag',
+            name='word',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='tags', to='Backend.TagWord', verbose_name='Тег словаря'),
+        ),
+    ]
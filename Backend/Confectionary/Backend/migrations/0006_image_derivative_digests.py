@@ -0,0 +1,23 @@
+# Generated by Django 3.0.3 on 2026-10-18 12:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Backend', '0005_tag_dictionary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cookstage',
+            name='picture_digest',
+            field=models.CharField(blank=True, default='', max_length=16, verbose_name='Хеш изображения этапа'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='avatar_digest',
+            field=models.CharField(blank=True, default='', max_length=16, verbose_name='Хеш аватарки'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 3.0.3 on 2026-10-18 12:47
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Backend', '0006_image_derivative_digests'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('recipe_avatar', 'Обработка аватарки рецепта'), ('cook_stage_picture', 'Обработка изображения этапа'), ('client_avatar', 'Обработка аватарки пользователя'), ('delete_files', 'Удаление файлов'), ('delete_dir', 'Удаление каталога')], max_length=20, verbose_name='Тип')),
+                ('target_id', models.IntegerField(blank=True, null=True, verbose_name='Объект')),
+                ('paths', models.TextField(blank=True, default='', verbose_name='Пути')),
+                ('status', models.CharField(choices=[('Q', 'В очереди'), ('R', 'Выполняется'), ('D', 'Выполнена'), ('F', 'Ошибка')], default='Q', max_length=3, verbose_name='Статус')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='Попытки')),
+                ('last_error', models.TextField(blank=True, default='', verbose_name='Последняя ошибка')),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Не раньше')),
+                ('date_init', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('date_done', models.DateTimeField(blank=True, null=True, verbose_name='Дата выполнения')),
+                ('creator', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='media_jobs', to=settings.AUTH_USER_MODEL, verbose_name='Инициатор')),
+            ],
+            options={
+                'verbose_name': 'Задача обработки медиафайлов',
+                'verbose_name_plural': 'Задачи обработки медиафайлов',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='mediajob',
+            index=models.Index(fields=['status', 'run_after'], name='media_job_queue_idx'),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 3.0.3 on 2026-10-18 12:52
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def fill_rating_counters(apps, schema_editor):
+    Comment = apps.get_model('Backend', 'Comment')
+    active = Q(comment_grades__status='A')
+    comments = Comment.objects.annotate(
+        upvotes_actual=Count('comment_grades', filter=active & Q(comment_grades__grade=True)),
+        downvotes_actual=Count('comment_grades', filter=active & Q(comment_grades__grade=False))
+    )
+    for comment in comments.iterator():
+        comment.upvotes = comment.upvotes_actual
+        comment.downvotes = comment.downvotes_actual
+        comment.rating = comment.upvotes_actual - comment.downvotes_actual
+        comment.save(update_fields=['upvotes', 'downvotes', 'rating'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Backend', '0007_media_job_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='downvotes',
+            field=models.IntegerField(default=0, verbose_name='Отрицательные оценки'),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='rating',
+            field=models.IntegerField(default=0, verbose_name='Рейтинг'),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='upvotes',
+            field=models.IntegerField(default=0, verbose_name='Положительные оценки'),
+        ),
+        migrations.RunPython(fill_rating_counters, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['recipe', 'status', 'date_init', 'id'], name='comment_recipe_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['recipe', 'status', 'rating', 'id'], name='comment_recipe_rating_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.0.3 on 2026-10-18 12:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Backend', '0008_comment_rating_counters'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='commentgrade',
+            index=models.Index(fields=['comment', 'status', 'grade'], name='comment_grade_comment_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['creator', 'status', 'date_init', 'id'], name='recipe_creator_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipegrade',
+            index=models.Index(fields=['recipe', 'status', 'grade'], name='recipe_grade_recipe_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tag',
+            index=models.Index(fields=['word', 'recipe'], name='tag_word_recipe_idx'),
+        ),
+    ]
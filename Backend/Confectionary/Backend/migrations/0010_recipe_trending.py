@@ -0,0 +1,53 @@
+# Generated by Django 3.0.3 on 2026-10-18 12:59
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Backend', '0009_hot_path_indexes'),
+    ]
+
+    operations = [
+        # у существующих оценок время изменения неизвестно: поле остаётся пустым, а не получает текущее время,
+        # иначе все старые оценки попали бы в ленту популярных как свежие
+        migrations.AddField(
+            model_name='commentgrade',
+            name='date_change',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Дата изменения'),
+        ),
+        migrations.AlterField(
+            model_name='commentgrade',
+            name='date_change',
+            field=models.DateTimeField(blank=True, default=django.utils.timezone.now, null=True, verbose_name='Дата изменения'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='trending',
+            field=models.FloatField(default=0, verbose_name='Популярность'),
+        ),
+        migrations.AddField(
+            model_name='recipegrade',
+            name='date_change',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Дата изменения'),
+        ),
+        migrations.AlterField(
+            model_name='recipegrade',
+            name='date_change',
+            field=models.DateTimeField(blank=True, default=django.utils.timezone.now, null=True, verbose_name='Дата изменения'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['date_init'], name='comment_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['status', 'trending', 'id'], name='recipe_status_trending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipegrade',
+            index=models.Index(fields=['date_change'], name='recipe_grade_date_idx'),
+        ),
+    ]
@@ -0,0 +1,106 @@
+# Generated by Django 3.0.3 on 2026-10-18 13:04
+
+import re
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Копия нормализации названий ингредиентов (Backend.search.tokenize, IngredientWord.normalize) на момент миграции:
+# историческая миграция не должна зависеть от последующих изменений стеммера и импортировать модули приложения.
+
+_perfective_ground = re.compile(r'((ив|ивши|ившись|ыв|ывши|ывшись)|((?<=[ая])(в|вши|вшись)))$')
+_reflexive = re.compile(r'(с[яь])$')
+_adjective = re.compile(r'(ее|ие|ые|ое|ими|ыми|ей|ий|ый|ой|ем|им|ым|ом|его|ого|ему|ому|их|ых|ую|юю|ая|яя|ою|ею)$')
+_participle = re.compile(r'((ивш|ывш|ующ)|((?<=[ая])(ем|нн|вш|ющ|щ)))$')
+_verb = re.compile(r'((ила|ыла|ена|ейте|уйте|ите|или|ыли|ей|уй|ил|ыл|им|ым|ен|ило|ыло|ено|ят|ует|уют|ит|ыт|ены|ить|'
+                   r'ыть|ишь|ую|ю)|((?<=[ая])(ла|на|ете|йте|ли|й|л|ем|н|ло|но|ет|ют|ны|ть|ешь|нно)))$')
+_noun = re.compile(r'(а|ев|ов|ие|ье|е|иями|ями|ами|еи|ии|и|ией|ей|ой|ий|й|иям|ям|ием|ем|ам|ом|о|у|ах|иях|ях|ы|ь|ию|'
+                   r'ью|ю|ия|ья|я)$')
+_rv = re.compile(r'^(.*?[аеиоуыэюя])(.*)$')
+_derivational = re.compile(r'.*[^аеиоуыэюя]+[аеиоуыэюя].*ость?$')
+_derivational_suffix = re.compile(r'ость?$')
+_superlative = re.compile(r'(ейше|ейш)$')
+_i = re.compile(r'и$')
+_soft_sign = re.compile(r'ь$')
+_double_n = re.compile(r'нн$')
+
+_token = re.compile(r'\w+')
+
+_stop_words = {
+    'и', 'в', 'во', 'на', 'с', 'со', 'из', 'для', 'по', 'под', 'над', 'к', 'ко', 'от', 'до', 'о', 'об', 'а', 'но',
+    'или', 'не', 'без', 'за', 'при', 'у', 'же', 'то', 'как',
+}
+
+
+def _stem(word):
+    word = word.casefold().replace('ё', 'е')
+    match = _rv.match(word)
+    if not match:
+        return word
+    prefix, rv = match.groups()
+
+    cut = _perfective_ground.sub('', rv, 1)
+    if cut == rv:
+        rv = _reflexive.sub('', rv, 1)
+        cut = _adjective.sub('', rv, 1)
+        if cut != rv:
+            rv = _participle.sub('', cut, 1)
+        else:
+            cut = _verb.sub('', rv, 1)
+            rv = _noun.sub('', rv, 1) if cut == rv else cut
+    else:
+        rv = cut
+
+    rv = _i.sub('', rv, 1)
+    if _derivational.match(rv):
+        rv = _derivational_suffix.sub('', rv, 1)
+    cut = _soft_sign.sub('', rv, 1)
+    if cut == rv:
+        rv = _superlative.sub('', rv, 1)
+        rv = _double_n.sub('н', rv, 1)
+    else:
+        rv = cut
+    return prefix + rv
+
+
+def normalize(name):
+    words = _token.findall(name.casefold())
+    return ' '.join(sorted({_stem(word) for word in words if word not in _stop_words}))
+
+
+def fill_ingredient_dictionary(apps, schema_editor):
+    Ingredient = apps.get_model('Backend', 'Ingredient')
+    IngredientWord = apps.get_model('Backend', 'IngredientWord')
+    names = {normalize(name) for name in Ingredient.objects.values_list('name', flat=True).distinct()} - {''}
+    IngredientWord.objects.bulk_create([IngredientWord(name=name) for name in names], ignore_conflicts=True)
+    words = dict(IngredientWord.objects.values_list('name', 'id'))
+    for ingredient in Ingredient.objects.only('id', 'name').iterator():
+        if normalize(ingredient.name):
+            Ingredient.objects.filter(id=ingredient.id).update(word_id=words[normalize(ingredient.name)])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Backend', '0011_recipe_neighbours'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngredientWord',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=80, unique=True, verbose_name='Наименование')),
+            ],
+            options={
+                'verbose_name': 'Ингредиент словаря',
+                'verbose_name_plural': 'Словарь ингредиентов',
+            },
+        ),
+        migrations.AddField(
+            model_name='ingredient',
+            name='word',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='ingredients', to='Backend.IngredientWord', verbose_name='Ингредиент словаря'),
+        ),
+        migrations.RunPython(fill_ingredient_dictionary, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.0.3 on 2026-10-18 13:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Backend', '0012_ingredient_dictionary'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['status', 'cook_time'], name='recipe_status_cook_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['status', 'portions'], name='recipe_status_portions_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['status', 'weight'], name='recipe_status_weight_idx'),
+        ),
+    ]
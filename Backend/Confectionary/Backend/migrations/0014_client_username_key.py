@@ -0,0 +1,29 @@
+# Generated by Django 3.0.3 on 2026-10-18 13:06
+
+from django.db import migrations, models
+
+
+def fill_username_keys(apps, schema_editor):
+    Client = apps.get_model('Backend', 'Client')
+    for client in Client.objects.only('id', 'username').iterator():
+        Client.objects.filter(id=client.id).update(username_key=client.username.casefold().replace('ё', 'е'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Backend', '0013_recipe_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='client',
+            name='username_key',
+            field=models.CharField(default='', editable=False, max_length=80, verbose_name='Ключ логина'),
+        ),
+        migrations.AddIndex(
+            model_name='client',
+            index=models.Index(fields=['username_key'], name='client_username_key_idx'),
+        ),
+        migrations.RunPython(fill_username_keys, migrations.RunPython.noop),
+    ]
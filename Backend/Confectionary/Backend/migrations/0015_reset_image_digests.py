@@ -0,0 +1,21 @@
+# Generated by Django 3.0.3 on 2026-10-18 14:02
+
+from django.db import migrations
+
+
+def reset_image_digests(apps, schema_editor):
+    # уменьшенные копии теперь называются по имени оригинала: прежние копии не находятся по новым именам,
+    # до запуска build_image_derivatives выдаются оригиналы
+    apps.get_model('Backend', 'Recipe').objects.exclude(avatar_digest='').update(avatar_digest='')
+    apps.get_model('Backend', 'CookStage').objects.exclude(picture_digest='').update(picture_digest='')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Backend', '0014_client_username_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(reset_image_digests, migrations.RunPython.noop),
+    ]
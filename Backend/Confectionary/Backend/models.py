@@ -1,14 +1,14 @@
-import os
-import shutil
-
-from django.db import models
+from django.db import models, transaction
 from django.conf import settings
 from django.contrib.auth.base_user import AbstractBaseUser
 from django.contrib.auth.models import PermissionsMixin, UserManager, AbstractUser
-from django.db.models import Q
+from django.db.models import F
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from .validators import *
+from .images import make_derivatives, derivative_names, derivative_url
+from .search import tokenize
 from django.core.validators import MaxValueValidator
 
 # Django автоматичеки использует MEDIA_ROOT для загрузки изображений
@@ -28,21 +28,34 @@ def cook_stage_picture_upload_path(instance, filename):
 
 class ClientManager(UserManager):
     def get_by_natural_key(self, username):
-        return self.get(
-            Q(**{self.model.USERNAME_FIELD: username}) |
-            Q(**{self.model.EMAIL_FIELD: username})
-        )
+        # вход по логину или почте: два поиска по уникальным индексам вместо OR по двум полям
+        # (OR заставляет MySQL объединять индексы или читать таблицу целиком)
+        try:
+            return self.get(**{self.model.USERNAME_FIELD: username})
+        except self.model.DoesNotExist:
+            return self.get(**{self.model.EMAIL_FIELD: username})
+
+    def username_prefix(self, prefix):
+        # пользователи, логин которых начинается с prefix без учёта регистра
+        key = self.model.normalize_username_key(prefix)
+        return self.filter(username_key__gte=key, username_key__lt=key + '\uffff')
 
 
 class Client(AbstractBaseUser, PermissionsMixin):
     class Meta:
         verbose_name = _('Пользователь')
         verbose_name_plural = _('Пользователи')
+        # поиск авторов по началу логина без учёта регистра - диапазон ключа (authors_autocomplete, recipes_by_author)
+        indexes = [
+            models.Index(fields=['username_key'], name='client_username_key_idx'),
+        ]
 
     username = models.CharField(max_length=80, unique=True, validators=[CustomUsernameValidator()],
                                 error_messages={
                                     'unique': _('Введённый логин занят другим пользователем.'),
                                 }, verbose_name='Логин')
+    # логин в нижнем регистре (см. normalize_username_key); заполняется при сохранении
+    username_key = models.CharField(max_length=80, default='', editable=False, verbose_name='Ключ логина')
     password = models.CharField(max_length=128, verbose_name='Пароль')
     email = models.EmailField(unique=True,
                               error_messages={
@@ -72,30 +85,64 @@ class Client(AbstractBaseUser, PermissionsMixin):
     dir_path = 'pictures/users'
     default_avatar = settings.MEDIA_URL + 'pictures/default/client_default.jpg'
 
+    @staticmethod
+    def normalize_username_key(username):
+        return username.casefold().replace('ё', 'е')
+
+    def save(self, *args, **kwargs):
+        self.username_key = Client.normalize_username_key(self.username)
+        update_fields = kwargs.get('update_fields', None)
+        if update_fields is not None and 'username' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'username_key'}
+        super().save(*args, **kwargs)
+
     def try_get_avatar(self):
-        try:
-            # self.avatar.path может бросать ValueError
-            if os.path.exists(self.avatar.path):
-                return self.avatar.url
-            else:
-                self.avatar = ''
-                self.save()
-                raise ValueError
-        except ValueError:
-            return self.default_avatar
+        # читаем только сохранённое значение поля; битые ссылки зачищает команда sweep_media
+        if self.avatar:
+            return self.avatar.url
+        return self.default_avatar
+
+    def discard_avatar(self):
+        # файл удаляет обработчик очереди медиафайлов; запись сохраняет вызывающий код
+        MediaJob.objects.enqueue_delete([self.avatar.name], creator_id=self.id)
+        self.avatar = ''
 
     def safety_delete(self):
-        rm_path = settings.BASE_DIR + settings.MEDIA_URL + self.dir_path + '/' + str(self.id)
-        # пробуем удалить каталог со всеми связанными изображениями
-        shutil.rmtree(path=rm_path, ignore_errors=True)
+        # каталог со всеми связанными изображениями удалит обработчик очереди медиафайлов
+        MediaJob.objects.enqueue('delete_dir', paths=[self.dir_path + '/' + str(self.id)])
         # удаляем запись из БД
         self.delete()
 
 
+class RatingQuerySet(models.QuerySet):
+    # для моделей с хранимыми счётчиками оценок upvotes, downvotes, rating
+    def change_rating(self, upvotes=0, downvotes=0):
+        # сдвигаем хранимые счётчики оценок одним UPDATE без предварительного чтения строк
+        if not (upvotes or downvotes):
+            return 0
+        return self.update(
+            upvotes=F('upvotes') + upvotes,
+            downvotes=F('downvotes') + downvotes,
+            rating=F('rating') + (upvotes - downvotes)
+        )
+
+
 class Recipe(models.Model):
     class Meta:
         verbose_name = _('Рецепт')
         verbose_name_plural = _('Рецепты')
+        # индексы под постраничную выдачу по курсору (status, поле сортировки, id)
+        indexes = [
+            models.Index(fields=['status', 'date_init', 'id'], name='recipe_status_date_idx'),
+            models.Index(fields=['status', 'rating', 'id'], name='recipe_status_rating_idx'),
+            models.Index(fields=['status', 'trending', 'id'], name='recipe_status_trending_idx'),
+            # фильтры по диапазонам в recipes_search
+            models.Index(fields=['status', 'cook_time'], name='recipe_status_cook_time_idx'),
+            models.Index(fields=['status', 'portions'], name='recipe_status_portions_idx'),
+            models.Index(fields=['status', 'weight'], name='recipe_status_weight_idx'),
+            # рецепты автора (client_recipes)
+            models.Index(fields=['creator', 'status', 'date_init', 'id'], name='recipe_creator_date_idx'),
+        ]
 
     creator = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, on_delete=models.SET_NULL, related_name='recipes',
                                 verbose_name='Рецепт')
@@ -108,26 +155,48 @@ class Recipe(models.Model):
     weight = models.PositiveIntegerField(validators=[MaxValueValidator(1000000)], blank=True, null=True,
                                          verbose_name='Вес')
     avatar = models.ImageField(upload_to=recipe_avatar_upload_path, max_length=100, blank=True, verbose_name='Аватарка')
+    # хеш содержимого аватарки, под которым сохранены её уменьшенные копии (пусто - копий ещё нет)
+    avatar_digest = models.CharField(max_length=16, blank=True, default='', verbose_name='Хеш аватарки')
     status_vars = (
         ('A', 'В широком доступе'),
         ('B', 'Заблокировано'),
     )
     status = models.CharField(max_length=3, choices=status_vars, default='A', verbose_name='Статус')
     date_init = models.DateField(auto_now_add=True, verbose_name='Дата создания')
+    # агрегаты активных оценок; поддерживаются при каждом изменении RecipeGrade
+    upvotes = models.IntegerField(default=0, verbose_name='Положительные оценки')
+    downvotes = models.IntegerField(default=0, verbose_name='Отрицательные оценки')
+    rating = models.IntegerField(default=0, verbose_name='Рейтинг')
+    # популярность с затуханием по времени; пересчитывается командой refresh_rankings (см. rankings.py)
+    trending = models.FloatField(default=0, verbose_name='Популярность')
+    tag_words = models.ManyToManyField('TagWord', through='Tag', related_name='recipes', verbose_name='Теги')
+
+    objects = RatingQuerySet.as_manager()
 
     default_avatar = settings.MEDIA_URL + 'pictures/default/recipe_default.png'
 
-    def try_get_avatar(self):
+    def try_get_avatar(self, size=None):
+        # size - имя размера уменьшенной копии из images.derivative_sizes
+        if self.avatar:
+            if size and self.avatar_digest:
+                return derivative_url(self.avatar, self.avatar_digest, size)
+            return self.avatar.url
+        return self.default_avatar
+
+    def build_avatar_derivatives(self):
         try:
-            # self.avatar.path может бросать ValueError
-            if os.path.exists(self.avatar.path):
-                return self.avatar.url
-            else:
-                self.avatar = ''
-                self.save()
-                raise ValueError
-        except ValueError:
-            return self.default_avatar
+            self.avatar_digest = make_derivatives(self.avatar) if self.avatar else ''
+        except OSError:
+            # файл не читается как изображение - продолжаем отдавать оригинал
+            self.avatar_digest = ''
+        Recipe.objects.filter(id=self.id).update(avatar_digest=self.avatar_digest)
+
+    def discard_avatar(self):
+        # файлы удаляет обработчик очереди медиафайлов; запись сохраняет вызывающий код
+        MediaJob.objects.enqueue_delete([self.avatar.name] + derivative_names(self.avatar.name, self.avatar_digest),
+                                        creator_id=self.creator_id)
+        self.avatar = ''
+        self.avatar_digest = ''
 
 
 class CookStage(models.Model):
@@ -139,20 +208,62 @@ class CookStage(models.Model):
     description = models.TextField(default='', max_length=500, verbose_name='Описание')
     picture = models.ImageField(upload_to=cook_stage_picture_upload_path, max_length=100, blank=True,
                                 verbose_name='Изображение этапа')
+    picture_digest = models.CharField(max_length=16, blank=True, default='', verbose_name='Хеш изображения этапа')
 
     default_picture = settings.MEDIA_URL + 'pictures/default/cook_default.png'
 
-    def try_get_picture(self):
+    def try_get_picture(self, size=None):
+        # читаем только сохранённое значение поля; битые ссылки зачищает команда sweep_media
+        if self.picture:
+            if size and self.picture_digest:
+                return derivative_url(self.picture, self.picture_digest, size)
+            return self.picture.url
+        return self.default_picture
+
+    def build_picture_derivatives(self):
         try:
-            # self.picture.path может бросать ValueError
-            if os.path.exists(self.picture.path):
-                return self.picture.url
-            else:
-                self.picture = ''
-                self.save()
-                raise ValueError
-        except ValueError:
-            return self.default_picture
+            self.picture_digest = make_derivatives(self.picture) if self.picture else ''
+        except OSError:
+            # файл не читается как изображение - продолжаем отдавать оригинал
+            self.picture_digest = ''
+        CookStage.objects.filter(id=self.id).update(picture_digest=self.picture_digest)
+
+    def picture_names(self):
+        # оригинал и уменьшенные копии изображения этапа
+        if not self.picture:
+            return []
+        return [self.picture.name] + derivative_names(self.picture.name, self.picture_digest)
+
+    def discard_picture(self):
+        MediaJob.objects.enqueue_delete(self.picture_names())
+        self.picture = ''
+        self.picture_digest = ''
+
+
+class IngredientWordManager(models.Manager):
+    def resolve(self, names):
+        # возвращает {нормализованное имя: слово словаря}, добавляя в словарь недостающие слова
+        keys = {IngredientWord.normalize(name) for name in names} - {''}
+        words = {word.name: word for word in self.filter(name__in=keys)}
+        if len(words) < len(keys):
+            self.bulk_create([IngredientWord(name=key) for key in keys if key not in words], ignore_conflicts=True)
+            words = {word.name: word for word in self.filter(name__in=keys)}
+        return words
+
+
+class IngredientWord(models.Model):
+    class Meta:
+        verbose_name = _('Ингредиент словаря')
+        verbose_name_plural = _('Словарь ингредиентов')
+
+    # основы слов наименования в алфавитном порядке: 'Масло сливочное' и 'сливочного масла' - одно слово словаря
+    name = models.CharField(max_length=80, unique=True, verbose_name='Наименование')
+
+    objects = IngredientWordManager()
+
+    @staticmethod
+    def normalize(name):
+        return ' '.join(sorted(set(tokenize(name))))
 
 
 class Ingredient(models.Model):
@@ -164,16 +275,123 @@ class Ingredient(models.Model):
     name = models.CharField(default='', max_length=80, validators=[CustomIngredientValidator()],
                             verbose_name='Наименование')
     measure = models.CharField(default='', max_length=30, validators=[CustomMeasureValidator()], verbose_name='Мера')
+    # пусто - наименование не содержит значимых слов
+    word = models.ForeignKey(IngredientWord, null=True, blank=True, on_delete=models.PROTECT,
+                             related_name='ingredients', verbose_name='Ингредиент словаря')
+
+    def save(self, *args, **kwargs):
+        key = IngredientWord.normalize(self.name)
+        if self.word_id is None or self.word.name != key:
+            self.word = IngredientWord.objects.resolve([self.name]).get(key, None)
+        super().save(*args, **kwargs)
+
+
+class TagWordManager(models.Manager):
+    def resolve(self, names):
+        # возвращает {нормализованное имя: слово словаря}, добавляя в словарь недостающие слова
+        keys = {TagWord.normalize(name) for name in names}
+        words = {word.name: word for word in self.filter(name__in=keys)}
+        if len(words) < len(keys):
+            self.bulk_create([TagWord(name=key) for key in keys if key not in words], ignore_conflicts=True)
+            words = {word.name: word for word in self.filter(name__in=keys)}
+        return words
+
+
+class TagWord(models.Model):
+    class Meta:
+        verbose_name = _('Тег словаря')
+        verbose_name_plural = _('Словарь тегов')
+
+    # уникальный индекс по нормализованному имени: точный и префиксный поиск тега - чтение индекса
+    name = models.CharField(max_length=30, unique=True, verbose_name='Наименование')
+
+    objects = TagWordManager()
+
+    @staticmethod
+    def normalize(name):
+        return ' '.join(name.split()).casefold().replace('ё', 'е')
 
 
 class Tag(models.Model):
     class Meta:
         verbose_name = _('Прикреплённый тег')
         verbose_name_plural = _('Прикреплённые теги')
+        # покрывающий индекс для перехода от слова словаря к рецептам (recipes_by_tag, tags_popular)
+        indexes = [
+            models.Index(fields=['word', 'recipe'], name='tag_word_recipe_idx'),
+        ]
 
     recipe = models.ForeignKey(Recipe, on_delete=models.CASCADE, related_name='tags', verbose_name='Рецепт')
     name = models.CharField(max_length=30, default='', validators=[CustomTagValidator()],
                             verbose_name='Наименование')
+    word = models.ForeignKey(TagWord, on_delete=models.PROTECT, related_name='tags', verbose_name='Тег словаря')
+
+    def save(self, *args, **kwargs):
+        if self.word_id is None or self.word.name != TagWord.normalize(self.name):
+            self.word = TagWord.objects.resolve([self.name])[TagWord.normalize(self.name)]
+        super().save(*args, **kwargs)
+
+
+class RecipeNeighbour(models.Model):
+    class Meta:
+        verbose_name = _('Похожий рецепт')
+        verbose_name_plural = _('Похожие рецепты')
+        unique_together = ('recipe', 'neighbour')
+        # похожие рецепты в порядке убывания сходства - чтение диапазона индекса
+        indexes = [
+            models.Index(fields=['recipe', 'score'], name='neighbour_recipe_score_idx'),
+        ]
+
+    # строки строит команда build_recommendations (см. recommendations.py)
+    recipe = models.ForeignKey(Recipe, on_delete=models.CASCADE, related_name='neighbours', verbose_name='Рецепт')
+    neighbour = models.ForeignKey(Recipe, on_delete=models.CASCADE, related_name='neighbour_of',
+                                  verbose_name='Похожий рецепт')
+    score = models.FloatField(default=0, verbose_name='Сходство')
+
+
+class GradeQuerySet(models.QuerySet):
+    # для оценок с полем target_field - ссылкой на оцениваемый объект с хранимыми счётчиками оценок
+
+    def target_lookup(self, evaluator, target_id):
+        return {'evaluator': evaluator, self.model.target_field + '_id': target_id}
+
+    def change_target_rating(self, target_id, old_vote, new_vote):
+        target_model = self.model._meta.get_field(self.model.target_field).related_model
+        target_model.objects.filter(id=target_id).change_rating(new_vote[0] - old_vote[0], new_vote[1] - old_vote[1])
+
+    def upsert(self, evaluator, target_id, grade):
+        # идемпотентная запись оценки: повторный запрос с той же оценкой ничего не меняет
+        lookup = self.target_lookup(evaluator, target_id)
+        with transaction.atomic():
+            # строка без вклада в рейтинг вставляется, только если её ещё нет (INSERT IGNORE / ON CONFLICT DO NOTHING),
+            # поэтому одновременные первые голоса не упираются в unique_together
+            self.bulk_create([self.model(**lookup, grade=grade, status='B')], ignore_conflicts=True)
+            # блокировка строки упорядочивает параллельные голоса одного пользователя
+            instance = self.select_for_update().get(**lookup)
+            old_vote = instance.vote()
+            if (instance.grade, instance.status) != (grade, 'A'):
+                instance.grade = grade
+                instance.status = 'A'
+                instance.date_change = timezone.now()
+                self.filter(id=instance.id).update(grade=grade, status='A', date_change=instance.date_change)
+                self.change_target_rating(target_id, old_vote, instance.vote())
+        return instance
+
+    def cancel(self, evaluator, target_id):
+        # оценка не удаляется, а только блокируется; None - оценки нет или объект недоступен
+        lookup = self.target_lookup(evaluator, target_id)
+        lookup[self.model.target_field + '__status'] = 'A'
+        with transaction.atomic():
+            instance = self.select_for_update().filter(**lookup).first()
+            if instance is None:
+                return None
+            old_vote = instance.vote()
+            if instance.status != 'B':
+                instance.status = 'B'
+                instance.date_change = timezone.now()
+                self.filter(id=instance.id).update(status='B', date_change=instance.date_change)
+                self.change_target_rating(target_id, old_vote, instance.vote())
+        return instance
 
 
 class RecipeGrade(models.Model):
@@ -181,6 +399,12 @@ class RecipeGrade(models.Model):
         verbose_name = _('Оценка рецепта')
         verbose_name_plural = _('Оценки рецептов')
         unique_together = ('evaluator', 'recipe')
+        # покрывающий индекс для подсчёта активных оценок рецепта (recount_recipe_ratings)
+        indexes = [
+            models.Index(fields=['recipe', 'status', 'grade'], name='recipe_grade_recipe_idx'),
+            # недавние оценки для пересчёта популярности (refresh_rankings)
+            models.Index(fields=['date_change'], name='recipe_grade_date_idx'),
+        ]
 
     evaluator = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='recipe_grades',
                                   verbose_name='Оценивающий')
@@ -191,12 +415,32 @@ class RecipeGrade(models.Model):
         ('B', 'Заблокирована'),
     )
     status = models.CharField(max_length=3, choices=status_vars, default='A', verbose_name='Статус')
+    # время последнего изменения оценки (пусто - оценка поставлена до появления поля)
+    date_change = models.DateTimeField(default=timezone.now, null=True, blank=True, verbose_name='Дата изменения')
+
+    objects = GradeQuerySet.as_manager()
+
+    # поле оцениваемого объекта (см. GradeQuerySet)
+    target_field = 'recipe'
+
+    def vote(self):
+        # вклад оценки в счётчики рецепта: (положительные, отрицательные)
+        if self.status != 'A':
+            return 0, 0
+        return (1, 0) if self.grade else (0, 1)
 
 
 class Comment(models.Model):
     class Meta:
         verbose_name = _('Комментарий')
         verbose_name_plural = _('Комментарии')
+        # индексы под постраничную выдачу комментариев рецепта по курсору
+        indexes = [
+            models.Index(fields=['recipe', 'status', 'date_init', 'id'], name='comment_recipe_date_idx'),
+            models.Index(fields=['recipe', 'status', 'rating', 'id'], name='comment_recipe_rating_idx'),
+            # недавние комментарии для пересчёта популярности рецептов (refresh_rankings)
+            models.Index(fields=['date_init'], name='comment_date_idx'),
+        ]
 
     creator = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, on_delete=models.SET_NULL, related_name='comments',
                                 verbose_name='Создатель')
@@ -208,6 +452,12 @@ class Comment(models.Model):
     )
     status = models.CharField(max_length=3, choices=status_vars, default='A', verbose_name='Статус')
     date_init = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
+    # счётчики активных оценок (поддерживаются при добавлении, изменении и отмене оценки)
+    upvotes = models.IntegerField(default=0, verbose_name='Положительные оценки')
+    downvotes = models.IntegerField(default=0, verbose_name='Отрицательные оценки')
+    rating = models.IntegerField(default=0, verbose_name='Рейтинг')
+
+    objects = RatingQuerySet.as_manager()
 
 
 class CommentGrade(models.Model):
@@ -215,6 +465,10 @@ class CommentGrade(models.Model):
         verbose_name = _('Оценка комментария')
         verbose_name_plural = _('Оценки комментариев')
         unique_together = ('evaluator', 'comment')
+        # покрывающий индекс для подсчёта активных оценок комментария (recount_recipe_ratings)
+        indexes = [
+            models.Index(fields=['comment', 'status', 'grade'], name='comment_grade_comment_idx'),
+        ]
 
     evaluator = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='comment_grades',
                                   verbose_name='Оценивающий')
@@ -225,4 +479,66 @@ class CommentGrade(models.Model):
         ('A', 'Активна'),
         ('B', 'Заблокирована'),
     )
-    status = models.CharField(max_length=3, choices=status_vars, default='A', verbose_name='Статус')
\ No newline at end of file
+    status = models.CharField(max_length=3, choices=status_vars, default='A', verbose_name='Статус')
+    # время последнего изменения оценки (пусто - оценка поставлена до появления поля)
+    date_change = models.DateTimeField(default=timezone.now, null=True, blank=True, verbose_name='Дата изменения')
+
+    objects = GradeQuerySet.as_manager()
+
+    # поле оцениваемого объекта (см. GradeQuerySet)
+    target_field = 'comment'
+
+    def vote(self):
+        # вклад оценки в счётчики комментария: (положительные, отрицательные)
+        if self.status != 'A':
+            return 0, 0
+        return (1, 0) if self.grade else (0, 1)
+
+
+class MediaJobManager(models.Manager):
+    def enqueue(self, kind, target_id=None, paths=(), creator_id=None):
+        return self.create(kind=kind, target_id=target_id, paths='\n'.join(paths), creator_id=creator_id)
+
+    def enqueue_delete(self, paths, creator_id=None):
+        paths = [path for path in paths if path]
+        if paths:
+            return self.enqueue('delete_files', paths=paths, creator_id=creator_id)
+
+
+class MediaJob(models.Model):
+    class Meta:
+        verbose_name = _('Задача обработки медиафайлов')
+        verbose_name_plural = _('Задачи обработки медиафайлов')
+        # обработчик выбирает задачи по (status, run_after)
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='media_job_queue_idx'),
+        ]
+
+    kind_vars = (
+        ('recipe_avatar', 'Обработка аватарки рецепта'),
+        ('cook_stage_picture', 'Обработка изображения этапа'),
+        ('client_avatar', 'Обработка аватарки пользователя'),
+        ('delete_files', 'Удаление файлов'),
+        ('delete_dir', 'Удаление каталога'),
+    )
+    kind = models.CharField(max_length=20, choices=kind_vars, verbose_name='Тип')
+    # id обрабатываемой записи (для задач обработки изображений)
+    target_id = models.IntegerField(null=True, blank=True, verbose_name='Объект')
+    # пути относительно MEDIA_ROOT по одному в строке (для задач удаления)
+    paths = models.TextField(blank=True, default='', verbose_name='Пути')
+    creator = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL,
+                                related_name='media_jobs', verbose_name='Инициатор')
+    status_vars = (
+        ('Q', 'В очереди'),
+        ('R', 'Выполняется'),
+        ('D', 'Выполнена'),
+        ('F', 'Ошибка'),
+    )
+    status = models.CharField(max_length=3, choices=status_vars, default='Q', verbose_name='Статус')
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name='Попытки')
+    last_error = models.TextField(blank=True, default='', verbose_name='Последняя ошибка')
+    run_after = models.DateTimeField(default=timezone.now, verbose_name='Не раньше')
+    date_init = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
+    date_done = models.DateTimeField(null=True, blank=True, verbose_name='Дата выполнения')
+
+    objects = MediaJobManager()
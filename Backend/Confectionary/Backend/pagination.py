@@ -0,0 +1,110 @@
+import base64
+import binascii
+import datetime
+
+from django.conf import settings
+from django.core.paginator import Paginator, InvalidPage
+from django.db.models import Q
+
+# Постраничная выдача для функциональных представлений.
+# Основной режим - курсор по ключу (значение поля сортировки, id): стоимость запроса не зависит от номера страницы.
+# Режим совместимости - обычная нумерация страниц (?page=N) через Paginator.
+
+max_page_size = 50
+
+# поддерживаемые порядки выдачи рецептов: имя -> (поле сортировки, разбор значения из курсора)
+recipe_orderings = {
+    'new': ('date_init', datetime.date.fromisoformat),
+    'rating': ('rating', int),
+    'trending': ('trending', float),
+}
+
+# порядки выдачи комментариев рецепта
+comment_orderings = {
+    'new': ('date_init', datetime.datetime.fromisoformat),
+    'top': ('rating', int),
+}
+
+
+def get_page_size(request):
+    page_size = settings.REST_FRAMEWORK.get('PAGE_SIZE', 10)
+    try:
+        page_size = int(request.query_params.get('page_size', page_size))
+    except ValueError:
+        pass
+    return max(1, min(page_size, max_page_size))
+
+
+def encode_cursor(value, pk):
+    raw = '%s|%i' % (value.isoformat() if hasattr(value, 'isoformat') else value, pk)
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor, parse):
+    # бросает ValueError при любом повреждении курсора
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+    except (TypeError, UnicodeError, binascii.Error):
+        raise ValueError('Некорректный курсор.')
+    value, separator, pk = raw.rpartition('|')
+    if not separator:
+        raise ValueError('Некорректный курсор.')
+    return parse(value), int(pk)
+
+
+def paginate(request, queryset, orderings=None, default_ordering='new'):
+    # возвращает (объекты страницы, сведения о пагинации); бросает ValueError при некорректных параметрах
+    orderings = orderings or recipe_orderings
+    ordering = request.query_params.get('ordering', default_ordering)
+    if ordering not in orderings:
+        raise ValueError('Неизвестный порядок сортировки.')
+    field, parse = orderings[ordering]
+    queryset = queryset.order_by('-' + field, '-id')
+    page_size = get_page_size(request)
+
+    # режим совместимости: нумерованные страницы
+    page_number = request.query_params.get('page', None)
+    if page_number is not None:
+        paginator = Paginator(queryset, page_size)
+        try:
+            page = paginator.page(page_number)
+        except InvalidPage:
+            raise ValueError('Некорректный номер страницы.')
+        return list(page), {
+            'ordering': ordering,
+            'page': page.number,
+            'pages': paginator.num_pages,
+            'count': paginator.count,
+        }
+
+    cursor = request.query_params.get('cursor', None)
+    if cursor:
+        value, pk = decode_cursor(cursor, parse)
+        queryset = queryset.filter(Q(**{field + '__lt': value}) | Q(**{field: value, 'id__lt': pk}))
+
+    # берём на один объект больше, чтобы узнать, есть ли следующая страница
+    objects = list(queryset[:page_size + 1])
+    next_cursor = None
+    if len(objects) > page_size:
+        objects = objects[:page_size]
+        last = objects[-1]
+        next_cursor = encode_cursor(getattr(last, field), last.id)
+    return objects, {
+        'ordering': ordering,
+        'next': next_cursor,
+    }
+
+
+def paginate_ids(request, ids):
+    # нумерованные страницы по готовому упорядоченному списку id (например, по результатам поиска)
+    page_size = get_page_size(request)
+    paginator = Paginator(ids, page_size)
+    try:
+        page = paginator.page(request.query_params.get('page', 1))
+    except InvalidPage:
+        raise ValueError('Некорректный номер страницы.')
+    return list(page), {
+        'page': page.number,
+        'pages': paginator.num_pages,
+        'count': paginator.count,
+    }
@@ -0,0 +1,63 @@
+import datetime
+from collections import defaultdict
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Recipe, RecipeGrade, Comment
+from .signals import rankings_changed
+
+# Популярность рецептов для ленты 'trending' (настройка RANKINGS).
+# Популярность - сумма вкладов активных оценок и комментариев за последние WINDOW_DAYS дней: положительная оценка
+# даёт +1, отрицательная -1, комментарий COMMENT_WEIGHT, и каждый вклад уменьшается вдвое за HALF_LIFE_HOURS часов.
+# Значение хранится в Recipe.trending и пересчитывается командой refresh_rankings, поэтому лента читается
+# диапазоном индекса (status, trending, id), как и ленты 'new' и 'top' (хранимый рейтинг).
+# Пересчёт читает только оценки и комментарии из окна и рецепты с ненулевой популярностью.
+
+
+def ranking_options():
+    options = getattr(settings, 'RANKINGS', {})
+    return {
+        'window': datetime.timedelta(days=options.get('WINDOW_DAYS', 7)),
+        'half_life': datetime.timedelta(hours=options.get('HALF_LIFE_HOURS', 24)),
+        'comment_weight': options.get('COMMENT_WEIGHT', 0.5),
+    }
+
+
+def trending_scores(now=None):
+    # id активного рецепта -> популярность на момент now
+    now = now or timezone.now()
+    options = ranking_options()
+    since = now - options['window']
+    half_life = options['half_life'].total_seconds()
+
+    def decay(moment):
+        return 0.5 ** (max((now - moment).total_seconds(), 0) / half_life)
+
+    scores = defaultdict(float)
+    grades = RecipeGrade.objects.filter(date_change__gte=since, status='A').values_list('recipe_id', 'grade',
+                                                                                         'date_change')
+    for recipe_id, grade, date_change in grades.iterator():
+        scores[recipe_id] += (1 if grade else -1) * decay(date_change)
+    comments = Comment.objects.filter(date_init__gte=since, status='A').values_list('recipe_id', 'date_init')
+    for recipe_id, date_init in comments.iterator():
+        scores[recipe_id] += options['comment_weight'] * decay(date_init)
+    return {recipe_id: round(score, 6) for recipe_id, score in scores.items()}
+
+
+def refresh_trending(now=None, batch_size=500):
+    # записывает популярность в Recipe.trending; возвращает количество изменённых рецептов
+    scores = trending_scores(now)
+    current = dict(Recipe.objects.filter(
+        Q(status='A', trending__gt=0) | Q(status='A', trending__lt=0)
+    ).values_list('id', 'trending'))
+
+    # рецепты без активности в окне обнуляются
+    changed = [Recipe(id=recipe_id, trending=0) for recipe_id in current if recipe_id not in scores]
+    changed += [Recipe(id=recipe_id, trending=trending) for recipe_id, trending in scores.items()
+                if current.get(recipe_id, 0) != trending]
+    Recipe.objects.bulk_update(changed, ['trending'], batch_size=batch_size)
+    if changed:
+        rankings_changed.send(sender=Recipe)
+    return len(changed)
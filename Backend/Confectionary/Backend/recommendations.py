@@ -0,0 +1,174 @@
+import math
+from collections import Counter, defaultdict
+
+import numpy
+from django.conf import settings
+from django.db import transaction
+from scipy import sparse
+
+from .models import Recipe, Ingredient, Tag, RecipeGrade, RecipeNeighbour
+from .search import tokenize
+from .signals import recommendations_changed
+
+# Похожие рецепты (настройка RECOMMENDATIONS, команда build_recommendations).
+# Каждый активный рецепт - строка двух разреженных матриц: TF-IDF по основам слов наименования и ингредиентов и по
+# тегам словаря, и матрица положительных оценок (рецепт x пользователь). Строки нормированы, поэтому произведение
+# матрицы на транспонированную даёт косинусное сходство; итоговое сходство - взвешенная сумма содержательного
+# (1 - LIKES_WEIGHT) и сходства по общим положительным оценкам (LIKES_WEIGHT). Сходства считаются блоками
+# по BLOCK_SIZE строк, от каждого блока остаются NEIGHBOURS лучших соседей рецепта, которые хранятся в RecipeNeighbour:
+# страница рецепта читает их одним запросом по индексу (recipe, score).
+
+
+def recommendation_options():
+    options = getattr(settings, 'RECOMMENDATIONS', {})
+    return {
+        'neighbours': options.get('NEIGHBOURS', 10),
+        'likes_weight': options.get('LIKES_WEIGHT', 0.3),
+        'block_size': options.get('BLOCK_SIZE', 500),
+    }
+
+
+##### Векторы рецептов #####
+
+def recipe_documents():
+    # id активного рецепта -> термы наименования, ингредиентов и тегов
+    documents = {
+        recipe_id: tokenize(title)
+        for recipe_id, title in Recipe.objects.filter(status='A').values_list('id', 'title').iterator()
+    }
+    ingredients = Ingredient.objects.filter(recipe__status='A').values_list('recipe_id', 'name')
+    for recipe_id, name in ingredients.iterator():
+        documents.get(recipe_id, []).extend(tokenize(name))
+    # тег словаря - отдельный терм целиком, не пересекающийся с основами слов
+    tags = Tag.objects.filter(recipe__status='A').values_list('recipe_id', 'word__name')
+    for recipe_id, word in tags.iterator():
+        documents.get(recipe_id, []).append('#' + word)
+    return documents
+
+
+def normalize_rows(matrix):
+    norms = numpy.sqrt(numpy.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.csr_matrix(sparse.diags(1 / norms) @ matrix)
+
+
+def content_matrix(documents, ids):
+    vocabulary = {}
+    rows, columns, values = [], [], []
+    for row, recipe_id in enumerate(ids):
+        for term, count in Counter(documents[recipe_id]).items():
+            rows.append(row)
+            columns.append(vocabulary.setdefault(term, len(vocabulary)))
+            values.append(1 + math.log(count))
+    matrix = sparse.csr_matrix((values, (rows, columns)), shape=(len(ids), len(vocabulary)), dtype=numpy.float64)
+    # сглаженный IDF: редкие термы весят больше
+    frequencies = numpy.bincount(matrix.indices, minlength=len(vocabulary))
+    idf = numpy.log((1 + len(ids)) / (1 + frequencies)) + 1
+    return normalize_rows(matrix @ sparse.diags(idf))
+
+
+def likes_matrix(ids):
+    index = {recipe_id: row for row, recipe_id in enumerate(ids)}
+    evaluators = {}
+    rows, columns = [], []
+    likes = RecipeGrade.objects.filter(status='A', grade=True).values_list('recipe_id', 'evaluator_id')
+    for recipe_id, evaluator_id in likes.iterator():
+        if recipe_id in index:
+            rows.append(index[recipe_id])
+            columns.append(evaluators.setdefault(evaluator_id, len(evaluators)))
+    matrix = sparse.csr_matrix((numpy.ones(len(rows)), (rows, columns)), shape=(len(ids), len(evaluators)))
+    return normalize_rows(matrix)
+
+
+##### Соседи #####
+
+def nearest_neighbours(ids, content, likes, targets, options):
+    # (id рецепта, [(id соседа, сходство), ...]) для рецептов targets, соседи по убыванию сходства
+    index = {recipe_id: row for row, recipe_id in enumerate(ids)}
+    rows = [index[recipe_id] for recipe_id in targets if recipe_id in index]
+    quantity = min(options['neighbours'], len(ids) - 1)
+    weight = options['likes_weight']
+    for start in range(0, len(rows), options['block_size']):
+        block = rows[start:start + options['block_size']]
+        # блок сходств остаётся разреженным: в строке хранятся только рецепты с общими термами или оценками,
+        # а плотный блок BLOCK_SIZE x N при сотнях тысяч рецептов занимает сотни мегабайт
+        scores = sparse.csr_matrix((1 - weight) * (content[block] @ content.T) + weight * (likes[block] @ likes.T))
+        for position, row in enumerate(block):
+            if quantity <= 0:
+                yield ids[row], []
+                continue
+            begin, end = scores.indptr[position], scores.indptr[position + 1]
+            columns, values = scores.indices[begin:end], scores.data[begin:end]
+            # рецепт не считается похожим сам на себя
+            keep = (values > 0) & (columns != row)
+            columns, values = columns[keep], values[keep]
+            if len(values) > quantity:
+                # сортируются только кандидаты не хуже NEIGHBOURS-го по сходству
+                threshold = numpy.partition(values, len(values) - quantity)[len(values) - quantity]
+                keep = values >= threshold
+                columns, values = columns[keep], values[keep]
+            # по убыванию сходства, при равенстве - по id (строки матриц упорядочены по id)
+            order = numpy.lexsort((columns, -values))[:quantity]
+            yield ids[row], [(ids[column], round(float(value), 6))
+                             for column, value in zip(columns[order], values[order])]
+
+
+def stored_neighbours(recipe_ids):
+    neighbours = defaultdict(list)
+    rows = RecipeNeighbour.objects.filter(recipe_id__in=recipe_ids).order_by('recipe_id', '-score', 'neighbour_id')
+    for recipe_id, neighbour_id, score in rows.values_list('recipe_id', 'neighbour_id', 'score'):
+        neighbours[recipe_id].append((neighbour_id, score))
+    return neighbours
+
+
+def store_neighbours(neighbours, batch_size=500):
+    # переписывает соседей рецептов, у которых список изменился; возвращает id этих рецептов
+    changed = []
+    recipe_ids = list(neighbours)
+    for start in range(0, len(recipe_ids), batch_size):
+        batch = recipe_ids[start:start + batch_size]
+        current = stored_neighbours(batch)
+        batch = [recipe_id for recipe_id in batch if current.get(recipe_id, []) != neighbours[recipe_id]]
+        if not batch:
+            continue
+        with transaction.atomic():
+            RecipeNeighbour.objects.filter(recipe_id__in=batch).delete()
+            RecipeNeighbour.objects.bulk_create([
+                RecipeNeighbour(recipe_id=recipe_id, neighbour_id=neighbour_id, score=score)
+                for recipe_id in batch for neighbour_id, score in neighbours[recipe_id]
+            ])
+        changed += batch
+    return changed
+
+
+def build_recommendations(new_only=False):
+    # new_only - только рецепты, у которых ещё нет соседей (добавленные после прошлого построения);
+    # они же добавляются в списки своих соседей, если входят в их лучшие NEIGHBOURS
+    options = recommendation_options()
+    documents = recipe_documents()
+    ids = sorted(documents)
+    content = content_matrix(documents, ids)
+    likes = likes_matrix(ids)
+
+    if new_only:
+        built = set(RecipeNeighbour.objects.values_list('recipe_id', flat=True).distinct())
+        targets = [recipe_id for recipe_id in ids if recipe_id not in built]
+    else:
+        targets = ids
+    neighbours = dict(nearest_neighbours(ids, content, likes, targets, options))
+
+    if new_only:
+        candidates = defaultdict(list)
+        for recipe_id, recipe_neighbours in neighbours.items():
+            for neighbour_id, score in recipe_neighbours:
+                if neighbour_id not in neighbours:
+                    candidates[neighbour_id].append((recipe_id, score))
+        current = stored_neighbours(list(candidates))
+        for recipe_id, new_neighbours in candidates.items():
+            merged = sorted(current.get(recipe_id, []) + new_neighbours, key=lambda item: (-item[1], item[0]))
+            neighbours[recipe_id] = merged[:options['neighbours']]
+
+    changed = store_neighbours(neighbours)
+    if changed:
+        recommendations_changed.send(sender=RecipeNeighbour, recipe_ids=changed)
+    return len(changed)
@@ -0,0 +1,44 @@
+import random
+import threading
+import time
+
+import numpy
+
+from .models import Recipe
+
+# Случайные рецепты (recipes_random) без ORDER BY RAND().
+# Процесс хранит плотный массив id активных рецептов и перечитывает его не чаще раза в refresh_interval секунд
+# (одно чтение индекса по status). Выборка - случайные позиции массива без повторов, поэтому её стоимость не зависит
+# от размера каталога. Рецепт, заблокированный или удалённый после чтения массива, отсеивает запрос карточек
+# (status='A'); на этот случай позиций берётся с запасом.
+
+
+class RecipeSampler:
+    def __init__(self, refresh_interval=60):
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.ids = numpy.empty(0, dtype=numpy.int64)
+        self.built_at = None
+
+    def stale(self):
+        return self.built_at is None or time.monotonic() - self.built_at >= self.refresh_interval
+
+    def refresh(self):
+        if not self.stale():
+            return
+        with self.lock:
+            if self.stale():
+                self.ids = numpy.fromiter(
+                    Recipe.objects.filter(status='A').values_list('id', flat=True).iterator(), dtype=numpy.int64
+                )
+                self.built_at = time.monotonic()
+
+    def sample(self, quantity):
+        # до quantity * 2 различных id в случайном порядке
+        self.refresh()
+        ids = self.ids
+        positions = random.sample(range(len(ids)), min(len(ids), quantity * 2))
+        return [int(ids[position]) for position in positions]
+
+
+recipe_sampler = RecipeSampler()
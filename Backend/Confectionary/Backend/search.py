@@ -0,0 +1,248 @@
+import logging
+import math
+import os
+import re
+import sqlite3
+import threading
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+##### Стемминг (алгоритм Портера для русского языка) #####
+
+_perfective_ground = re.compile(r'((ив|ивши|ившись|ыв|ывши|ывшись)|((?<=[ая])(в|вши|вшись)))$')
+_reflexive = re.compile(r'(с[яь])$')
+_adjective = re.compile(r'(ее|ие|ые|ое|ими|ыми|ей|ий|ый|ой|ем|им|ым|ом|его|ого|ему|ому|их|ых|ую|юю|ая|яя|ою|ею)$')
+_participle = re.compile(r'((ивш|ывш|ующ)|((?<=[ая])(ем|нн|вш|ющ|щ)))$')
+_verb = re.compile(r'((ила|ыла|ена|ейте|уйте|ите|или|ыли|ей|уй|ил|ыл|им|ым|ен|ило|ыло|ено|ят|ует|уют|ит|ыт|ены|ить|'
+                   r'ыть|ишь|ую|ю)|((?<=[ая])(ла|на|ете|йте|ли|й|л|ем|н|ло|но|ет|ют|ны|ть|ешь|нно)))$')
+_noun = re.compile(r'(а|ев|ов|ие|ье|е|иями|ями|ами|еи|ии|и|ией|ей|ой|ий|й|иям|ям|ием|ем|ам|ом|о|у|ах|иях|ях|ы|ь|ию|'
+                   r'ью|ю|ия|ья|я)$')
+_rv = re.compile(r'^(.*?[аеиоуыэюя])(.*)$')
+_derivational = re.compile(r'.*[^аеиоуыэюя]+[аеиоуыэюя].*ость?$')
+_derivational_suffix = re.compile(r'ость?$')
+_superlative = re.compile(r'(ейше|ейш)$')
+_i = re.compile(r'и$')
+_soft_sign = re.compile(r'ь$')
+_double_n = re.compile(r'нн$')
+
+_token = re.compile(r'\w+')
+
+stop_words = {
+    'и', 'в', 'во', 'на', 'с', 'со', 'из', 'для', 'по', 'под', 'над', 'к', 'ко', 'от', 'до', 'о', 'об', 'а', 'но',
+    'или', 'не', 'без', 'за', 'при', 'у', 'же', 'то', 'как',
+}
+
+
+def stem(word):
+    word = word.casefold().replace('ё', 'е')
+    match = _rv.match(word)
+    if not match:
+        return word
+    prefix, rv = match.groups()
+
+    cut = _perfective_ground.sub('', rv, 1)
+    if cut == rv:
+        rv = _reflexive.sub('', rv, 1)
+        cut = _adjective.sub('', rv, 1)
+        if cut != rv:
+            rv = _participle.sub('', cut, 1)
+        else:
+            cut = _verb.sub('', rv, 1)
+            rv = _noun.sub('', rv, 1) if cut == rv else cut
+    else:
+        rv = cut
+
+    rv = _i.sub('', rv, 1)
+    if _derivational.match(rv):
+        rv = _derivational_suffix.sub('', rv, 1)
+    cut = _soft_sign.sub('', rv, 1)
+    if cut == rv:
+        rv = _superlative.sub('', rv, 1)
+        rv = _double_n.sub('н', rv, 1)
+    else:
+        rv = cut
+    return prefix + rv
+
+
+def tokenize(text):
+    # нормализованные основы слов текста без служебных слов
+    return [stem(word) for word in _token.findall(text.casefold()) if word not in stop_words]
+
+
+
+##### Инвертированный индекс рецептов #####
+
+class RecipeSearchIndex:
+    # Индекс хранится в локальном файле SQLite: postings(term, recipe_id, weight) с первичным ключом по (term, recipe_id),
+    # поэтому поиск по терму (и по префиксу терма) - это чтение диапазона ключа.
+    # Ранжирование - BM25 по взвешенной частоте термов в полях рецепта.
+
+    field_weights = {
+        'title': 3.0,
+        'tags': 2.0,
+        'ingredients': 1.5,
+        'cook_stages': 1.0,
+    }
+    prefix_weight = 0.5
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self, path=None):
+        # без явного пути файл берётся из SEARCH_INDEX_PATH при каждом подключении
+        self.explicit_path = path
+        self.lock = threading.Lock()
+        self.prepared_path = None
+
+    @property
+    def path(self):
+        return self.explicit_path or getattr(settings, 'SEARCH_INDEX_PATH',
+                                             os.path.join(settings.BASE_DIR, 'search_index.sqlite3'))
+
+    def connect(self):
+        path = self.path
+        connection = sqlite3.connect(path, timeout=10)
+        if self.prepared_path != path:
+            with self.lock:
+                with connection:
+                    connection.executescript('''
+                        PRAGMA journal_mode=WAL;
+                        CREATE TABLE IF NOT EXISTS documents (
+                            recipe_id INTEGER PRIMARY KEY,
+                            length REAL NOT NULL
+                        );
+                        CREATE TABLE IF NOT EXISTS postings (
+                            term TEXT NOT NULL,
+                            recipe_id INTEGER NOT NULL,
+                            weight REAL NOT NULL,
+                            PRIMARY KEY (term, recipe_id)
+                        ) WITHOUT ROWID;
+                        CREATE INDEX IF NOT EXISTS postings_recipe ON postings (recipe_id);
+                    ''')
+                self.prepared_path = path
+        return connection
+
+    def recipe_fields(self, recipe):
+        return {
+            'title': [recipe.title],
+            'tags': [tag.name for tag in recipe.tags.all()],
+            'ingredients': [ingredient.name for ingredient in recipe.ingredients.all()],
+            'cook_stages': [cook_stage.description for cook_stage in recipe.cook_stages.all()],
+        }
+
+    def recipe_terms(self, recipe):
+        terms = {}
+        for field, texts in self.recipe_fields(recipe).items():
+            for text in texts:
+                for term in tokenize(text):
+                    terms[term] = terms.get(term, 0.0) + self.field_weights[field]
+        return terms
+
+    def write_recipe(self, connection, recipe):
+        terms = self.recipe_terms(recipe)
+        connection.execute('DELETE FROM postings WHERE recipe_id = ?', (recipe.id,))
+        connection.execute('INSERT OR REPLACE INTO documents (recipe_id, length) VALUES (?, ?)',
+                           (recipe.id, sum(terms.values())))
+        connection.executemany('INSERT INTO postings (term, recipe_id, weight) VALUES (?, ?, ?)',
+                               [(term, recipe.id, weight) for term, weight in terms.items()])
+
+    def index_recipe(self, recipe):
+        connection = self.connect()
+        try:
+            with connection:
+                self.write_recipe(connection, recipe)
+        finally:
+            connection.close()
+
+    def remove_recipe(self, recipe_id):
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute('DELETE FROM postings WHERE recipe_id = ?', (recipe_id,))
+                connection.execute('DELETE FROM documents WHERE recipe_id = ?', (recipe_id,))
+        finally:
+            connection.close()
+
+    def rebuild(self, recipes):
+        # recipes - итерируемая выборка с предзагруженными tags, ingredients, cook_stages
+        connection = self.connect()
+        indexed = 0
+        try:
+            with connection:
+                connection.execute('DELETE FROM postings')
+                connection.execute('DELETE FROM documents')
+                for recipe in recipes:
+                    self.write_recipe(connection, recipe)
+                    indexed += 1
+        finally:
+            connection.close()
+        return indexed
+
+    def search(self, query, limit=1000):
+        # возвращает id рецептов по убыванию релевантности
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+        connection = self.connect()
+        try:
+            documents, average_length = connection.execute('SELECT COUNT(*), AVG(length) FROM documents').fetchone()
+            if not documents:
+                return []
+            average_length = average_length or 1.0
+            lengths = {}
+            scores = {}
+            for position, term in enumerate(terms):
+                # последнее слово запроса может быть недописанным - ищем и по префиксу
+                if position == len(terms) - 1:
+                    rows = connection.execute(
+                        'SELECT term, recipe_id, weight FROM postings WHERE term >= ? AND term < ?',
+                        (term, term + '\uffff')
+                    ).fetchall()
+                else:
+                    rows = connection.execute(
+                        'SELECT term, recipe_id, weight FROM postings WHERE term = ?', (term,)
+                    ).fetchall()
+                if not rows:
+                    continue
+                frequency = len({recipe_id for _, recipe_id, _ in rows})
+                idf = math.log(1 + (documents - frequency + 0.5) / (frequency + 0.5))
+                missing = {recipe_id for _, recipe_id, _ in rows if recipe_id not in lengths}
+                for chunk in _chunks(list(missing), 500):
+                    lengths.update(connection.execute(
+                        'SELECT recipe_id, length FROM documents WHERE recipe_id IN (%s)' % ','.join('?' * len(chunk)),
+                        chunk
+                    ).fetchall())
+                for found_term, recipe_id, weight in rows:
+                    if found_term != term:
+                        weight *= self.prefix_weight
+                    norm = self.k1 * (1 - self.b + self.b * lengths.get(recipe_id, average_length) / average_length)
+                    scores[recipe_id] = scores.get(recipe_id, 0.0) + idf * weight * (self.k1 + 1) / (weight + norm)
+        finally:
+            connection.close()
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], -item[0]))
+        return [recipe_id for recipe_id, _ in ranked[:limit]]
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+search_index = RecipeSearchIndex()
+
+
+def update_recipe_index(recipe):
+    # индекс восстанавливается командой rebuild_search_index, поэтому сбой индекса не должен ломать сохранение рецепта
+    try:
+        search_index.index_recipe(recipe)
+    except sqlite3.Error:
+        logger.exception('Не удалось обновить поисковый индекс рецепта %s', recipe.id)
+
+
+def remove_recipe_index(recipe_id):
+    try:
+        search_index.remove_recipe(recipe_id)
+    except sqlite3.Error:
+        logger.exception('Не удалось удалить рецепт %s из поискового индекса', recipe_id)
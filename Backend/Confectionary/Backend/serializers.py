@@ -1,8 +1,13 @@
 from .models import *
+from .search import update_recipe_index
+from .hashing import set_client_password
 from rest_framework import serializers
+from djoser.serializers import TokenCreateSerializer
+from django.contrib.auth import authenticate
 from django.contrib.auth.password_validation import validate_password
 from django.contrib.auth.models import Group
 from django.conf import settings
+from django.db import transaction
 
 
 ##### Сериализаторы данных пользователя #####
@@ -63,17 +68,18 @@ class ClientFormSerializer(serializers.ModelSerializer):
         }
 
     def reset_avatar(self):
-        self.instance.avatar.delete(save=True)
-        self.instance.avatar = ''
+        self.instance.discard_avatar()
         self.instance.save()
 
     def create(self, validated_data):
         password_got = validated_data.pop('password')
         new_client = Client.objects.create(**validated_data)
-        new_client.set_password(password_got)
+        set_client_password(new_client, password_got)
         client_group = Group.objects.get(name='client')
         new_client.save()
         client_group.user_set.add(new_client)
+        if new_client.avatar:
+            MediaJob.objects.enqueue('client_avatar', target_id=new_client.id, creator_id=new_client.id)
         return new_client
 
     # исключаем возможность сменить пароль через обычный запрос на редактирование
@@ -86,11 +92,13 @@ class ClientFormSerializer(serializers.ModelSerializer):
 
         avatar_got = validated_data.get('avatar',  None)
         if avatar_got:
-            # удаляем предыдущее изображение; метод не выбрасывает исключений
-            instance.avatar.delete(save=True)
+            # предыдущее изображение удалит обработчик очереди медиафайлов
+            instance.discard_avatar()
             instance.avatar = avatar_got
 
         instance.save()
+        if avatar_got:
+            MediaJob.objects.enqueue('client_avatar', target_id=instance.id, creator_id=instance.id)
         return instance
 
 
@@ -103,6 +111,19 @@ class ClientPasswordChangeSerializer(serializers.Serializer):
         return password
 
 
+# (для входа: пароль проверяется один раз, в пуле хеширования; см. hashing.py)
+class ClientTokenCreateSerializer(TokenCreateSerializer):
+    def validate(self, attrs):
+        self.user = authenticate(
+            request=self.context.get('request'),
+            username=attrs.get('username'),
+            password=attrs.get('password')
+        )
+        if self.user and self.user.is_active:
+            return attrs
+        self.fail('invalid_credentials')
+
+
 
 ##### Сериализаторы данных тега #####
 
@@ -120,6 +141,16 @@ class TagSerializer(TagFormSerializer):
         fields = TagFormSerializer.Meta.fields + ['id']
 
 
+# (для списка популярных тегов)
+class TagWordSerializer(serializers.ModelSerializer):
+
+    recipes_count = serializers.IntegerField()
+
+    class Meta:
+        model = TagWord
+        fields = ['id', 'name', 'recipes_count']
+
+
 
 ##### Сериализаторы данных комментария #####
 
@@ -128,27 +159,18 @@ class CommentSerializer(serializers.ModelSerializer):
 
     creator = ClientRecipePageSerializer()
     date_init = serializers.SerializerMethodField()
-    rating = serializers.SerializerMethodField()
+    grade = serializers.SerializerMethodField()
 
     class Meta:
         model = Comment
-        fields = ['id', 'creator', 'body', 'date_init', 'rating']
+        fields = ['id', 'creator', 'body', 'date_init', 'rating', 'grade']
 
     def get_date_init(self, comment_obj):
         return comment_obj.date_init.strftime('%Y-%m-%d %H:%M:%S')
 
-    def get_rating(self, comment_obj):
-        grades = CommentGrade.objects.filter(comment=comment_obj.id)
-        rating_value = 0
-        # Проходимся по всем объектам оценивания и подсчитываем общий рейтинг
-        for grade in grades:
-            if grade.status == 'B':
-                continue
-            elif grade.grade:
-                rating_value += 1
-            else:
-                rating_value -= 1
-        return rating_value
+    def get_grade(self, comment_obj):
+        # оценка текущего пользователя (словарь id -> оценка собирается одним запросом в представлении)
+        return self.context.get('comment_grades', {}).get(comment_obj.id)
 
 
 class CommentFormSerializer(serializers.ModelSerializer):
@@ -188,13 +210,17 @@ class IngredientSerializer(IngredientFormSerialier):
 class CookStageSerializer(serializers.ModelSerializer):
 
     picture = serializers.SerializerMethodField()
+    picture_full = serializers.SerializerMethodField()
 
     class Meta:
         model = CookStage
-        fields = ['id', 'description', 'picture']
+        fields = ['id', 'description', 'picture', 'picture_full']
 
     def get_picture(self, cook_stage_obj):
-        return settings.CURRENT_PREFIX + cook_stage_obj.try_get_picture()
+        return settings.CURRENT_PREFIX + cook_stage_obj.try_get_picture('page')
+
+    def get_picture_full(self, cook_stage_obj):
+        return settings.CURRENT_PREFIX + cook_stage_obj.try_get_picture('full')
 
 
 # (для добавления к рецепту)
@@ -205,8 +231,7 @@ class CookStageFormSerializer(serializers.ModelSerializer):
         fields = ['description', 'picture']
 
     def reset_picture(self):
-        self.instance.picture.delete(save=True)
-        self.instance.picture = ''
+        self.instance.discard_picture()
         self.instance.save()
 
     def update(self, instance, validated_data):
@@ -214,11 +239,13 @@ class CookStageFormSerializer(serializers.ModelSerializer):
 
         picture_got = validated_data.get('picture', None)
         if picture_got:
-            # удаляем предыдущее изображение; метод не выбрасывает исключений
-            instance.picture.delete(save=True)
+            # предыдущее изображение удалит обработчик очереди медиафайлов
+            instance.discard_picture()
             instance.picture = picture_got
 
         instance.save()
+        if picture_got:
+            MediaJob.objects.enqueue('cook_stage_picture', target_id=instance.id)
         return instance
 
 
@@ -236,30 +263,26 @@ class RecipeCardForCreatorSerializer(serializers.ModelSerializer):
         fields = ['id', 'title', 'avatar', 'rating']
 
     def get_avatar(self, recipe_obj):
-        return settings.CURRENT_PREFIX + recipe_obj.try_get_avatar()
+        return settings.CURRENT_PREFIX + recipe_obj.try_get_avatar('card')
 
     def get_rating(self, recipe_obj):
-        grades = RecipeGrade.objects.filter(recipe=recipe_obj.pk)
-        rating_value = 0
-        # Проходимся по всем объектам оценивания и подсчитываем общий рейтинг
-        for grade in grades:
-            if grade.status == 'B':
-                continue
-            elif grade.grade:
-                rating_value += 1
-            else:
-                rating_value -= 1
-        return rating_value
+        # рейтинг хранится в самом рецепте, дополнительных запросов не требуется
+        return recipe_obj.rating
 
 
 # (для карточки рецепта)
 class RecipeCardSerializer(RecipeCardForCreatorSerializer):
 
     creator = ClientRecipeCardSerializer()
+    grade = serializers.SerializerMethodField()
 
     class Meta(RecipeCardForCreatorSerializer.Meta):
         model = Recipe
-        fields = RecipeCardForCreatorSerializer.Meta.fields + ['creator', 'cook_time', 'portions']
+        fields = RecipeCardForCreatorSerializer.Meta.fields + ['creator', 'cook_time', 'portions', 'grade']
+
+    def get_grade(self, recipe_obj):
+        # оценка текущего пользователя (словарь id -> оценка собирается одним запросом в представлении)
+        return self.context.get('grades', {}).get(recipe_obj.id)
 
 
 # (для страницы рецепта)
@@ -269,11 +292,36 @@ class RecipePageSerializer(RecipeCardSerializer):
     ingredients = IngredientSerializer(many=True)
     cook_stages = CookStageSerializer(many=True)
     tags = TagSerializer(many=True)
-    comments = CommentSerializer(many=True)
+    # первая страница комментариев (остальные - через recipe_comments)
+    comments = serializers.SerializerMethodField()
+    # похожие рецепты (строятся командой build_recommendations)
+    similar = serializers.SerializerMethodField()
+    avatar_full = serializers.SerializerMethodField()
 
     class Meta(RecipeCardSerializer.Meta):
-        fields = RecipeCardSerializer.Meta.fields + ['weight', 'ingredients', 'cook_stages', 'date_init', 'tags',
-                                                     'comments']
+        fields = RecipeCardSerializer.Meta.fields + ['avatar_full', 'weight', 'ingredients', 'cook_stages', 'date_init',
+                                                     'tags', 'comments', 'similar']
+
+    def get_avatar(self, recipe_obj):
+        return settings.CURRENT_PREFIX + recipe_obj.try_get_avatar('page')
+
+    def get_avatar_full(self, recipe_obj):
+        return settings.CURRENT_PREFIX + recipe_obj.try_get_avatar('full')
+
+    def get_comments(self, recipe_obj):
+        return CommentSerializer(self.context.get('comments', []), many=True, context=self.context).data
+
+    def get_similar(self, recipe_obj):
+        return RecipeCardForCreatorSerializer(self.context.get('similar', []), many=True).data
+
+    @staticmethod
+    def setup_eager_loading(queryset):
+        # страница рецепта собирается за постоянное число запросов
+        return queryset.select_related('creator').prefetch_related(
+            'ingredients',
+            'cook_stages',
+            'tags'
+        )
 
 
 # (для создания и редактирования рецепта)
@@ -298,79 +346,111 @@ class RecipeFormSerializer(serializers.ModelSerializer):
             'avatar': {'required': False}
         }
 
+    # поля рецепта, изменяемые формой (счётчики оценок не перезаписываем устаревшими значениями)
+    saved_fields = ['title', 'portions', 'cook_time', 'weight', 'avatar', 'avatar_digest']
+
     def reset_avatar(self):
-        self.instance.avatar.delete(save=True)
-        self.instance.avatar = ''
-        self.instance.save()
+        self.instance.discard_avatar()
+        self.instance.save(update_fields=['avatar', 'avatar_digest'])
+
+    def reset_pictures(self, pictures_reset):
+        # pictures_reset - флаги сброса изображений этапов по порядку этапов
+        reset = [cook_stage for cook_stage, flag in zip(self.instance.cook_stages.order_by('id'), pictures_reset)
+                 if flag and cook_stage.picture]
+        MediaJob.objects.enqueue_delete(sum([cook_stage.picture_names() for cook_stage in reset], []),
+                                        creator_id=self.instance.creator_id)
+        for cook_stage in reset:
+            cook_stage.picture = ''
+            cook_stage.picture_digest = ''
+        CookStage.objects.bulk_update(reset, ['picture', 'picture_digest'])
+
+    def enqueue_image_processing(self, recipe):
+        # уменьшенные копии новых изображений рецепта и его этапов строит обработчик очереди медиафайлов
+        jobs = []
+        if recipe.avatar and not recipe.avatar_digest:
+            jobs.append(MediaJob(kind='recipe_avatar', target_id=recipe.id, creator_id=recipe.creator_id))
+        cook_stages = recipe.cook_stages.exclude(picture='').filter(picture_digest='')
+        for cook_stage_id in cook_stages.values_list('id', flat=True):
+            jobs.append(MediaJob(kind='cook_stage_picture', target_id=cook_stage_id, creator_id=recipe.creator_id))
+        MediaJob.objects.bulk_create(jobs)
+
+    def attach_tag_words(self, tags_data):
+        # прикрепляемые теги ссылаются на слова словаря тегов
+        if not tags_data:
+            return tags_data
+        words = TagWord.objects.resolve([tag['name'] for tag in tags_data])
+        return [dict(tag, word=words[TagWord.normalize(tag['name'])]) for tag in tags_data]
+
+    def attach_ingredient_words(self, ingredients_data):
+        # ингредиенты ссылаются на слова словаря ингредиентов (поиск рецептов по ингредиентам)
+        if not ingredients_data:
+            return ingredients_data
+        words = IngredientWord.objects.resolve([ingredient['name'] for ingredient in ingredients_data
+                                                if 'name' in ingredient])
+        return [dict(ingredient, word=words.get(IngredientWord.normalize(ingredient['name']), None))
+                if 'name' in ingredient else ingredient for ingredient in ingredients_data]
 
     def create(self, validated_data):
         # выталкиваем все данные связанных таблиц
-        ingredients_got = validated_data.pop('ingredients', None)
-        cook_stages_got = validated_data.pop('cook_stages', None)
-        tags_got = validated_data.pop('tags', None)
-
-        new_recipe = Recipe.objects.create(**validated_data, creator=self.context['client'])
-
-        # создаём все связанные объекты других таблиц
-        if ingredients_got:
-            for ingredient in ingredients_got:
-                Ingredient.objects.create(**ingredient, recipe=new_recipe)
-                self.max_ingredients -= 1
-                if self.max_ingredients == 0:
-                    break
-        if cook_stages_got:
-            for cook_stage in cook_stages_got:
-                CookStage.objects.create(**cook_stage, recipe=new_recipe)
-                self.max_cook_stages -= 1
-                if self.max_cook_stages == 0:
-                    break
-        if tags_got:
-            for tag in tags_got:
-                Tag.objects.create(**tag, recipe=new_recipe)
-                self.max_tags -= 1
-                if self.max_tags == 0:
-                    break
-
+        ingredients_got = validated_data.pop('ingredients', None) or []
+        cook_stages_got = validated_data.pop('cook_stages', None) or []
+        tags_got = validated_data.pop('tags', None) or []
+
+        with transaction.atomic():
+            new_recipe = Recipe.objects.create(**validated_data, creator=self.context['client'])
+
+            # создаём все связанные объекты других таблиц пакетными INSERT
+            # (файлы изображений этапов сохраняются в хранилище при подготовке INSERT)
+            Ingredient.objects.bulk_create([
+                Ingredient(**ingredient, recipe=new_recipe)
+                for ingredient in self.attach_ingredient_words(ingredients_got[:self.max_ingredients])
+            ])
+            CookStage.objects.bulk_create([CookStage(**cook_stage, recipe=new_recipe)
+                                           for cook_stage in cook_stages_got[:self.max_cook_stages]])
+            Tag.objects.bulk_create([Tag(**tag, recipe=new_recipe)
+                                     for tag in self.attach_tag_words(tags_got[:self.max_tags])])
+
+            self.enqueue_image_processing(new_recipe)
+            transaction.on_commit(lambda: update_recipe_index(new_recipe))
         return new_recipe
 
     def partial_update_nested_multiple(self, instance, model, data, max_quantity):
-        # редактируем (при необходимости добавляем, удаляем) все связанные объекты других таблиц
-        # проверяем, пришёл ли словарь объектов (не пришёл - ничего не меняем)
-        if not (data is None):
-            # если пришёл пустой словарь, то удаляем все объекты
-            if not data:
-                model.objects.filter(recipe=instance).delete()
-            # вводим итераторы
-            obj_iter = iter(model.objects.filter(recipe=instance))
-            data_iter = iter(data)
-            # используем ограничение на максимальное количество в качестве обратного счётчика
-            while max_quantity:
-                # пробуем получить следующий объект для редактирования
-                try:
-                    curr_obj = next(obj_iter)
-                except StopIteration:
-                    # не получаем - просто добавляем оставшиеся объекты с нужными данными
-                    try:
-                        while True:
-                            model.objects.create(**next(data_iter), recipe=instance)
-                            max_quantity -= 1
-                    except StopIteration:
-                        pass
-                    break
-                # пробуем получить данные следующего объекта для редактирования
-                try:
-                    curr_data = next(data_iter)
-                except StopIteration:
-                    # не получаем - просто удаляем оставшиеся объекты
-                    curr_obj.delete()
-                    try:
-                        while True:
-                            next(obj_iter).delete()
-                    except StopIteration:
-                        pass
-                    break
-                model.objects.filter(id=curr_obj.id).update(**curr_data)
-                max_quantity -= 1
+        # редактируем (при необходимости добавляем, удаляем) все связанные объекты других таблиц:
+        # первые объекты получают пришедшие данные, недостающие добавляются, лишние удаляются
+        # проверяем, пришёл ли список объектов (не пришёл - ничего не меняем)
+        if data is None:
+            return
+        data = data[:max_quantity]
+        objects = list(model.objects.filter(recipe=instance).order_by('id'))
+        edited = objects[:len(data)]
+        removed = objects[len(data):]
+
+        # изображения заменённых и удалённых этапов удалит обработчик очереди медиафайлов
+        stale_media = []
+        if model is CookStage:
+            for cook_stage, cook_stage_data in zip(edited, data):
+                if cook_stage_data.get('picture'):
+                    stale_media += cook_stage.picture_names()
+            for cook_stage in removed:
+                stale_media += cook_stage.picture_names()
+
+        fields = set()
+        for obj, obj_data in zip(edited, data):
+            for field, value in obj_data.items():
+                setattr(obj, field, value)
+                fields.add(field)
+        if fields:
+            # bulk_update не вызывает pre_save, поэтому новые файлы сохраняем в хранилище сами
+            for field in model._meta.concrete_fields:
+                if field.name in fields and isinstance(field, models.FileField):
+                    for obj in edited:
+                        field.pre_save(obj, False)
+            model.objects.bulk_update(edited, list(fields))
+        if len(data) > len(objects):
+            model.objects.bulk_create([model(**obj_data, recipe=instance) for obj_data in data[len(objects):]])
+        if removed:
+            model.objects.filter(id__in=[obj.id for obj in removed]).delete()
+        MediaJob.objects.enqueue_delete(stale_media, creator_id=instance.creator_id)
 
     def update(self, instance, validated_data):
         # выталкиваем все данные связанных таблиц
@@ -378,23 +458,34 @@ class RecipeFormSerializer(serializers.ModelSerializer):
         cook_stages_got = validated_data.pop('cook_stages', None)
         tags_got = validated_data.pop('tags', None)
 
-        self.partial_update_nested_multiple(instance, Ingredient, ingredients_got, self.max_ingredients)
-        self.partial_update_nested_multiple(instance, CookStage, cook_stages_got, self.max_cook_stages)
-        self.partial_update_nested_multiple(instance, Tag, tags_got, self.max_tags)
-
-        instance.title = validated_data.get('title', instance.title)
-        instance.portions = validated_data.get('portions', instance.portions)
-        instance.cook_time = validated_data.get('cook_time', instance.cook_time)
-        instance.weight = validated_data.get('weight', instance.weight)
-
-        # удаляем предыдущее изображение
-        avatar_got = validated_data.get('avatar', None)
-        if avatar_got:
-            # метод не выбрасывает исключений
-            instance.avatar.delete(save=True)
-            instance.avatar = avatar_got
-
-        instance.save()
+        if cook_stages_got:
+            # новое изображение этапа требует пересоздания уменьшенных копий
+            cook_stages_got = [dict(cook_stage, picture_digest='') if cook_stage.get('picture') else cook_stage
+                               for cook_stage in cook_stages_got]
+
+        with transaction.atomic():
+            # блокируем строку рецепта: параллельные правки одного рецепта выполняются по очереди
+            Recipe.objects.select_for_update().filter(id=instance.id).exists()
+
+            self.partial_update_nested_multiple(instance, Ingredient, self.attach_ingredient_words(ingredients_got),
+                                                self.max_ingredients)
+            self.partial_update_nested_multiple(instance, CookStage, cook_stages_got, self.max_cook_stages)
+            self.partial_update_nested_multiple(instance, Tag, self.attach_tag_words(tags_got), self.max_tags)
+
+            instance.title = validated_data.get('title', instance.title)
+            instance.portions = validated_data.get('portions', instance.portions)
+            instance.cook_time = validated_data.get('cook_time', instance.cook_time)
+            instance.weight = validated_data.get('weight', instance.weight)
+
+            # предыдущее изображение удалит обработчик очереди медиафайлов
+            avatar_got = validated_data.get('avatar', None)
+            if avatar_got:
+                instance.discard_avatar()
+                instance.avatar = avatar_got
+
+            instance.save(update_fields=self.saved_fields)
+            self.enqueue_image_processing(instance)
+            transaction.on_commit(lambda: update_recipe_index(instance))
         return instance
 
 
@@ -408,17 +499,8 @@ class RecipeGradeFormSerializer(serializers.ModelSerializer):
         fields = ['grade']
 
     def create(self, validated_data):
-        new_grade = RecipeGrade.objects.create(
-            **validated_data,
-            evaluator=self.context['evaluator'],
-            recipe=Recipe.objects.get(id=self.context['recipe_id']))
-        return new_grade
-
-    def update(self, instance, validated_data):
-        instance.grade = validated_data.get('grade', instance.grade)
-        instance.status = 'A'
-        instance.save()
-        return instance
+        # добавление и изменение оценки - одна идемпотентная запись (см. GradeQuerySet.upsert)
+        return RecipeGrade.objects.upsert(self.context['evaluator'], self.context['recipe_id'], validated_data['grade'])
 
 
 # (для создания или редактирования оценки комментария)
@@ -428,14 +510,24 @@ class CommentGradeFormSerializer(serializers.ModelSerializer):
         fields = ['grade']
 
     def create(self, validated_data):
-        new_grade = CommentGrade.objects.create(
-            **validated_data,
-            evaluator=self.context['evaluator'],
-            comment=Comment.objects.get(id=self.context['comment_id']))
-        return new_grade
+        return CommentGrade.objects.upsert(self.context['evaluator'], self.context['comment_id'], validated_data['grade'])
 
-    def update(self, instance, validated_data):
-        instance.grade = validated_data.get('grade', instance.grade)
-        instance.status = 'A'
-        instance.save()
-        return instance
\ No newline at end of file
+
+
+##### Сериализаторы задач обработки медиафайлов #####
+
+# (для просмотра состояния очереди)
+class MediaJobSerializer(serializers.ModelSerializer):
+
+    kind = serializers.SerializerMethodField()
+    status = serializers.SerializerMethodField()
+
+    class Meta:
+        model = MediaJob
+        fields = ['id', 'kind', 'target_id', 'status', 'attempts', 'date_init', 'date_done']
+
+    def get_kind(self, job_obj):
+        return job_obj.get_kind_display()
+
+    def get_status(self, job_obj):
+        return job_obj.get_status_display()
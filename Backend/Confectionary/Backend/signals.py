@@ -0,0 +1,17 @@
+from django.dispatch import Signal
+
+# Сигналы записи данных, отправляемые представлениями, обработчиком очереди медиафайлов и командами.
+# По ним сбрасываются зависимые ответы кеша чтения (см. cache.py).
+
+# рецепт добавлен, изменён или удалён (аргумент recipe_id)
+recipe_changed = Signal()
+# изменена оценка рецепта (аргумент recipe_id)
+recipe_grade_changed = Signal()
+# добавлен или удалён комментарий либо изменена оценка комментария (аргумент recipe_id)
+comment_changed = Signal()
+# изменён профиль пользователя (аргумент client_id)
+client_changed = Signal()
+# пересчитана популярность рецептов (refresh_rankings)
+rankings_changed = Signal()
+# перестроены похожие рецепты (аргумент recipe_ids - рецепты с изменившимся списком)
+recommendations_changed = Signal()
@@ -1,3 +1,1302 @@
-from django.test import TestCase
+import datetime
+import io
+import os
+import posixpath
+import re
+import tempfile
+import time
+from unittest import mock
 
-# Create your tests here.
+import numpy
+from PIL import Image
+from asgiref.sync import async_to_sync
+from django.core.files.base import ContentFile
+from django.core.asgi import get_asgi_application
+from django.conf import settings
+from django.core.management import call_command
+from django.db import OperationalError
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
+
+from rest_framework.authtoken.models import Token
+from rest_framework.request import Request
+from scipy import sparse
+
+from .models import *
+from .serializers import RecipeFormSerializer
+from .pagination import paginate_ids, max_page_size
+from .cache import response_cache
+from .votes import VoteBuffer
+from .rankings import refresh_trending
+from .recommendations import build_recommendations, nearest_neighbours
+from .search import search_index
+from .images import derivative_names, derivative_sizes, make_derivatives
+from . import media_queue
+from .media_queue import claim_job, run_job
+from .sampling import RecipeSampler
+from .hashing import HashingPool
+from .throttling import throttle_store
+from .asgi_cache import CachedResponseRouter
+from .signals import recipe_changed
+from .authentication import TokenCache, revoke_client_tokens
+
+
+class RatingCountersTest(TestCase):
+    def setUp(self):
+        response_cache().clear()
+        throttle_store.clear()
+        creator = Client.objects.create(username='creator', email='creator@example.com')
+        self.recipe = Recipe.objects.create(creator=creator, title='Наполеон')
+        self.comment = Comment.objects.create(creator=creator, recipe=self.recipe, body='Вкусно')
+        self.auths = [
+            {'HTTP_AUTHORIZATION': 'Token %s' % Token.objects.create(user=Client.objects.create(
+                username='evaluator%i' % index, email='evaluator%i@example.com' % index)).key}
+            for index in range(3)
+        ]
+
+    def recount(self):
+        # количество исправленных рецептов и комментариев по отчёту recount_recipe_ratings
+        out = io.StringIO()
+        call_command('recount_recipe_ratings', stdout=out)
+        return [int(line.rsplit(':', 1)[1]) for line in out.getvalue().splitlines()]
+
+    def test_counters_match_recount(self):
+        first, second, third = self.auths
+        recipe_url = '/recipe_grade_%%s/%i/' % self.recipe.id
+        comment_url = '/comment_grade_%%s/%i/' % self.comment.id
+        for url in (recipe_url, comment_url):
+            self.assertEqual(self.client.post(url % 'add', {'grade': True}, **first).status_code, 204)
+            self.assertEqual(self.client.post(url % 'add', {'grade': True}, **second).status_code, 204)
+            # смена оценки и отмена
+            self.assertEqual(self.client.post(url % 'add', {'grade': False}, **second).status_code, 204)
+            self.assertEqual(self.client.post(url % 'add', {'grade': False}, **third).status_code, 204)
+            self.assertEqual(self.client.put(url % 'cancel', **third).status_code, 204)
+            self.assertEqual(self.client.put(url % 'cancel', **third).status_code, 204)
+
+        self.recipe.refresh_from_db()
+        self.comment.refresh_from_db()
+        self.assertEqual((self.recipe.upvotes, self.recipe.downvotes, self.recipe.rating), (1, 1, 0))
+        self.assertEqual((self.comment.upvotes, self.comment.downvotes, self.comment.rating), (1, 1, 0))
+        self.assertEqual(self.recount(), [0, 0])
+
+        # расхождение исправляется пересчётом
+        Recipe.objects.filter(id=self.recipe.id).change_rating(upvotes=5)
+        self.assertEqual(self.recount(), [1, 0])
+        self.recipe.refresh_from_db()
+        self.assertEqual((self.recipe.upvotes, self.recipe.downvotes, self.recipe.rating), (1, 1, 0))
+
+
+class RecipePaginationTest(TestCase):
+    recipes_quantity = 23
+
+    def setUp(self):
+        response_cache().clear()
+        creator = Client.objects.create(username='creator', email='creator@example.com')
+        self.ids = set()
+        today = timezone.now().date()
+        for index in range(self.recipes_quantity):
+            recipe = Recipe.objects.create(creator=creator, title='Рецепт %i' % index)
+            # по несколько рецептов на одну дату и с одним рейтингом
+            Recipe.objects.filter(id=recipe.id).update(date_init=today - datetime.timedelta(days=index % 3),
+                                                       rating=index % 4)
+            self.ids.add(recipe.id)
+        Recipe.objects.create(creator=creator, title='Заблокированный', status='B')
+
+    def walk(self, **params):
+        seen = []
+        cursor = ''
+        while True:
+            response = self.client.get('/recipes_all/', dict(params, cursor=cursor))
+            self.assertEqual(response.status_code, 200)
+            seen += response.data['recipes']
+            cursor = response.data['pagination']['next']
+            if not cursor:
+                return seen
+
+    def test_cursor_pages(self):
+        for ordering, field in (('new', 'date_init'), ('rating', 'rating')):
+            seen = self.walk(ordering=ordering, page_size=4)
+            ids = [recipe['id'] for recipe in seen]
+            # без повторов и пропусков, в порядке (поле сортировки, id) по убыванию
+            self.assertEqual(len(ids), len(set(ids)))
+            self.assertEqual(set(ids), self.ids)
+            expected = Recipe.objects.filter(status='A').order_by('-' + field, '-id').values_list('id', flat=True)
+            self.assertEqual(ids, list(expected))
+
+    def test_bounds_and_invalid(self):
+        response = self.client.get('/recipes_all/', {'page_size': 1000})
+        self.assertEqual(len(response.data['recipes']), self.recipes_quantity)
+        self.assertIsNone(response.data['pagination']['next'])
+        response = self.client.get('/recipes_all/', {'page_size': 0})
+        self.assertEqual(len(response.data['recipes']), 1)
+
+        for params in ({'cursor': 'мусор'}, {'cursor': 'bm90LWEtY3Vyc29y'}, {'ordering': 'title'}, {'page': 100}):
+            response = self.client.get('/recipes_all/', params)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.data['message'], 'Некорректные параметры страницы.')
+
+        # нумерованные страницы по готовому списку id
+        ids = list(range(max_page_size * 2 + 1))
+        request = Request(RequestFactory().get('/', {'page': 3, 'page_size': max_page_size * 2}))
+        self.assertEqual(paginate_ids(request, ids), ([ids[-1]], {'page': 3, 'pages': 3, 'count': len(ids)}))
+        with self.assertRaises(ValueError):
+            paginate_ids(Request(RequestFactory().get('/', {'page': 4})), ids[:10])
+
+
+class RecipeSearchIndexTest(TestCase):
+    def setUp(self):
+        response_cache().clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'search_index.sqlite3')
+        settings_override = override_settings(SEARCH_INDEX_PATH=self.path)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.creator = Client.objects.create(username='creator', email='creator@example.com')
+        self.auth = {'HTTP_AUTHORIZATION': 'Token %s' % Token.objects.create(user=self.creator).key}
+        self.cake = Recipe.objects.create(creator=self.creator, title='Шоколадный торт')
+        Ingredient.objects.create(recipe=self.cake, name='Вишня', measure='200 г')
+        self.pie = Recipe.objects.create(creator=self.creator, title='Пирог')
+        CookStage.objects.create(recipe=self.pie, description='Украсить шоколадной глазурью')
+        self.salad = Recipe.objects.create(creator=self.creator, title='Салат')
+
+    def search(self, query):
+        response = self.client.get('/recipes_by_title/%s/' % query)
+        self.assertEqual(response.status_code, 200)
+        return [recipe['id'] for recipe in response.data['recipes']]
+
+    def test_rebuild_and_search(self):
+        out = io.StringIO()
+        call_command('rebuild_search_index', '--chunk-size', '2', stdout=out)
+        self.assertIn('Проиндексировано рецептов: 3', out.getvalue())
+        self.assertTrue(os.path.exists(self.path))
+
+        # словоформы запроса сводятся к тем же основам; совпадение в наименовании весит больше, чем в этапе
+        self.assertEqual(self.search('шоколадного'), [self.cake.id, self.pie.id])
+        self.assertEqual(self.search('с вишнями'), [self.cake.id])
+        # последнее слово ищется и по префиксу
+        self.assertEqual(self.search('глаз'), [self.pie.id])
+        self.assertEqual(self.search('и'), [])
+
+        # заблокированный рецепт не выдаётся, удалённый - удаляется из индекса
+        Recipe.objects.filter(id=self.pie.id).update(status='B')
+        self.assertEqual(self.search('шоколадного'), [self.cake.id])
+        self.assertEqual(self.client.delete('/recipe_remove/%i/' % self.cake.id, **self.auth).status_code, 202)
+        self.assertEqual(search_index.search('шоколадного'), [self.pie.id])
+        self.assertEqual(self.search('шоколадного'), [])
+
+
+class TagDictionaryTest(TestCase):
+    def setUp(self):
+        response_cache().clear()
+        creator = Client.objects.create(username='creator', email='creator@example.com')
+        self.cake, self.chocolate, self.blocked = [
+            Recipe.objects.create(creator=creator, title=title) for title in ('Торт', 'Шоколад', 'Заблокированный')
+        ]
+        for recipe, names in ((self.cake, ['Торт', 'Ёлка']), (self.chocolate, ['ТОРТЫ', 'шоколад']),
+                              (self.blocked, ['торт', 'шоколад'])):
+            for name in names:
+                Tag.objects.create(recipe=recipe, name=name)
+        Recipe.objects.filter(id=self.blocked.id).update(status='B')
+
+    def search(self, tag, **params):
+        response = self.client.get('/recipes_by_tag/%s/' % tag, params)
+        self.assertEqual(response.status_code, 200)
+        return [recipe['id'] for recipe in response.data['recipes']]
+
+    def test_resolve(self):
+        # одно слово словаря на тег без учёта регистра, пробелов и ё
+        words = TagWord.objects.resolve(['  Торт ', 'торт', 'ЕЛКА', 'новый  тег'])
+        self.assertEqual(sorted(words), ['елка', 'новый тег', 'торт'])
+        self.assertEqual(words['торт'].id, Tag.objects.get(recipe=self.cake, name='Торт').word_id)
+        self.assertEqual(TagWord.objects.count(), 5)
+
+    def test_exact_and_prefix(self):
+        self.assertEqual(self.search('ТОРТ'), [self.cake.id])
+        self.assertEqual(self.search('ёлка'), [self.cake.id])
+        self.assertEqual(self.search('тор', match='prefix'), [self.chocolate.id, self.cake.id])
+        self.assertEqual(self.search('тор'), [])
+        self.assertEqual(self.search('шоколад'), [self.chocolate.id])
+
+    def test_popular(self):
+        response = self.client.get('/tags_popular/', {'quantity': 2})
+        self.assertEqual(response.status_code, 200)
+        # заблокированные рецепты не учитываются
+        self.assertEqual([(tag['name'], tag['recipes_count']) for tag in response.data['tags']],
+                         [('елка', 1), ('торт', 1)])
+        self.assertEqual(len(self.client.get('/tags_popular/').data['tags']), 4)
+        self.assertEqual(self.client.get('/tags_popular/', {'quantity': 'много'}).status_code, 400)
+
+
+class ImageDerivativesTest(TestCase):
+    def setUp(self):
+        response_cache().clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=directory.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        creator = Client.objects.create(username='creator', email='creator@example.com')
+        self.recipe = Recipe.objects.create(creator=creator, title='Наполеон')
+        buffer = io.BytesIO()
+        Image.new('RGB', (3000, 1500), (200, 120, 40)).save(buffer, 'JPEG')
+        self.image = buffer.getvalue()
+
+    def stage(self, filename):
+        stage = CookStage.objects.create(recipe=self.recipe, description='Украсить')
+        stage.picture.save(filename, ContentFile(self.image))
+        return stage
+
+    def test_make_derivatives(self):
+        self.recipe.avatar.save('avatar.jpg', ContentFile(self.image))
+        storage = self.recipe.avatar.storage
+        digest = make_derivatives(self.recipe.avatar)
+        self.assertEqual(len(digest), 16)
+        for max_side, name in zip(derivative_sizes.values(), derivative_names(self.recipe.avatar.name, digest)):
+            with storage.open(name) as file:
+                image = Image.open(file)
+                self.assertEqual((image.format, max(image.size)), ('WEBP', min(max_side, 3000)))
+
+        # без копий выдаётся оригинал, после построения - копия нужного размера
+        self.assertEqual(self.recipe.try_get_avatar('card'), self.recipe.avatar.url)
+        self.recipe.build_avatar_derivatives()
+        self.assertEqual(Recipe.objects.get(id=self.recipe.id).avatar_digest, digest)
+        self.assertEqual(self.recipe.try_get_avatar('card'),
+                         storage.url('%s/avatar_%s_card.webp' % (posixpath.dirname(self.recipe.avatar.name), digest)))
+        self.assertEqual(self.recipe.try_get_avatar(), self.recipe.avatar.url)
+
+        # файл, который не читается как изображение, отдаётся без копий
+        self.recipe.avatar.save('broken.jpg', ContentFile(b'not an image'))
+        self.recipe.build_avatar_derivatives()
+        self.assertEqual(Recipe.objects.get(id=self.recipe.id).avatar_digest, '')
+
+    def test_same_image_in_two_stages(self):
+        first, second = self.stage('cake.jpg'), self.stage('cake.jpg')
+        first.build_picture_derivatives()
+        second.build_picture_derivatives()
+        self.assertEqual(first.picture_digest, second.picture_digest)
+        self.assertNotEqual(first.try_get_picture('page'), second.try_get_picture('page'))
+
+        # удаление изображения одного этапа не затрагивает копии другого
+        storage = second.picture.storage
+        digest, first_names = first.picture_digest, first.picture_names()
+        first.discard_picture()
+        first.save()
+        call_command('media_worker', '--processes', '1', '--once', stdout=io.StringIO())
+        self.assertFalse(any(storage.exists(name) for name in first_names))
+        self.assertTrue(all(storage.exists(name) for name in second.picture_names()))
+
+        # команда строит недостающие копии
+        CookStage.objects.filter(id=second.id).update(picture_digest='')
+        out = io.StringIO()
+        call_command('build_image_derivatives', stdout=out)
+        self.assertIn('Обработано изображений: 1', out.getvalue())
+        self.assertEqual(CookStage.objects.get(id=second.id).picture_digest, digest)
+
+
+class MediaSweepTest(TestCase):
+    def setUp(self):
+        response_cache().clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.media_root = directory.name
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.creator = Client.objects.create(username='creator', email='creator@example.com', avatar='missing.jpg')
+        self.recipe = Recipe.objects.create(creator=self.creator, title='Наполеон')
+        self.avatar = recipe_avatar_upload_path(self.recipe, 'avatar.jpg')
+        Recipe.objects.filter(id=self.recipe.id).update(avatar=self.avatar, avatar_digest='e812e0aec766f2ab')
+        self.derivatives = [os.path.join(self.media_root, name)
+                            for name in derivative_names(self.avatar, 'e812e0aec766f2ab')]
+        for path in self.derivatives:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as file:
+                file.write(b'data')
+        self.stage = CookStage.objects.create(recipe=self.recipe, description='Испечь', picture='present.jpg')
+        with open(os.path.join(self.media_root, 'present.jpg'), 'wb') as file:
+            file.write(b'data')
+
+    def test_read_does_not_write(self):
+        # битая ссылка отдаётся как есть, без проверки файла и без записи в БД
+        recipe = Recipe.objects.get(id=self.recipe.id)
+        with self.assertNumQueries(0):
+            self.assertTrue(recipe.try_get_avatar('card').endswith('/avatar_e812e0aec766f2ab_card.webp'))
+            self.assertTrue(recipe.try_get_avatar().endswith('/avatar.jpg'))
+            self.assertTrue(self.creator.try_get_avatar().endswith('missing.jpg'))
+        self.assertEqual(Recipe.objects.get(id=self.recipe.id).avatar.name, self.avatar)
+
+    def test_sweep(self):
+        url = '/recipe_info/%i/' % self.recipe.id
+        etag = self.client.get(url)['ETag']
+
+        out = io.StringIO()
+        call_command('sweep_media', '--dry-run', stdout=out)
+        self.assertIn('Recipe.avatar: битых ссылок - 1', out.getvalue())
+        self.assertEqual(Recipe.objects.get(id=self.recipe.id).avatar_digest, 'e812e0aec766f2ab')
+
+        call_command('sweep_media', stdout=io.StringIO())
+        recipe = Recipe.objects.get(id=self.recipe.id)
+        self.assertEqual((recipe.avatar.name, recipe.avatar_digest), ('', ''))
+        self.assertEqual(recipe.try_get_avatar('card'), Recipe.default_avatar)
+        self.assertFalse(any(os.path.exists(path) for path in self.derivatives))
+        self.assertEqual(Client.objects.get(id=self.creator.id).avatar.name, '')
+        self.assertEqual(CookStage.objects.get(id=self.stage.id).picture.name, 'present.jpg')
+        # закешированная страница рецепта сброшена
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['recipe']['avatar'].endswith(Recipe.default_avatar))
+
+
+class MediaQueueTest(TestCase):
+    def setUp(self):
+        response_cache().clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.media_root = directory.name
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.creator = Client.objects.create(username='creator', email='creator@example.com')
+        self.other = Client.objects.create(username='other', email='other@example.com')
+        self.staff = Client.objects.create(username='staff', email='staff@example.com', is_staff=True)
+        self.auth, self.other_auth, self.staff_auth = [
+            {'HTTP_AUTHORIZATION': 'Token %s' % Token.objects.create(user=user).key}
+            for user in (self.creator, self.other, self.staff)
+        ]
+
+    def media_file(self, path):
+        full_path = os.path.join(self.media_root, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'wb') as file:
+            file.write(b'data')
+        return full_path
+
+    def work(self):
+        out = io.StringIO()
+        call_command('media_worker', '--processes', '1', '--once', stdout=out)
+        return int(out.getvalue().rsplit(':', 1)[1])
+
+    def test_enqueue_process_status(self):
+        full_path = self.media_file('files/old.jpg')
+        job = MediaJob.objects.enqueue_delete(['files/old.jpg', ''], creator_id=self.creator.id)
+        self.assertIsNone(MediaJob.objects.enqueue_delete(['']))
+        response = self.client.get('/media_job_info/%i/' % job.id, **self.auth)
+        self.assertEqual(response.data['job']['status'], 'В очереди')
+
+        self.assertEqual(self.work(), 1)
+        self.assertFalse(os.path.exists(full_path))
+        response = self.client.get('/media_job_info/%i/' % job.id, **self.auth)
+        self.assertEqual((response.data['job']['status'], response.data['job']['attempts']), ('Выполнена', 1))
+        self.assertEqual(self.work(), 0)
+
+        # каталог удалённого рецепта удаляется обработчиком очереди
+        recipe = Recipe.objects.create(creator=self.creator, title='Наполеон')
+        avatar_path = self.media_file(recipe_avatar_upload_path(recipe, 'avatar.jpg'))
+        self.assertEqual(self.client.delete('/recipe_remove/%i/' % recipe.id, **self.auth).status_code, 202)
+        self.assertTrue(os.path.exists(avatar_path))
+        self.assertEqual(self.work(), 1)
+        self.assertFalse(os.path.exists(os.path.dirname(os.path.dirname(avatar_path))))
+        self.assertTrue(os.path.isdir(os.path.join(self.media_root, Client.dir_path, str(self.creator.id))))
+
+    def test_strip_metadata(self):
+        recipe = Recipe.objects.create(creator=self.creator, title='Наполеон')
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        buffer = io.BytesIO()
+        Image.new('RGB', (40, 20)).save(buffer, 'JPEG', exif=exif)
+        recipe.avatar.save('avatar.jpg', ContentFile(buffer.getvalue()))
+        storage, old_name = recipe.avatar.storage, recipe.avatar.name
+
+        # сбой записи копии не затрагивает оригинал
+        with mock.patch('django.core.files.storage.FileSystemStorage.save', side_effect=OSError('Нет места')):
+            MediaJob.objects.enqueue('recipe_avatar', target_id=recipe.id)
+            self.assertEqual(self.work(), 1)
+        self.assertEqual(Recipe.objects.get(id=recipe.id).avatar.name, old_name)
+        self.assertTrue(storage.exists(old_name))
+
+        # оригинал удаляется после фиксации записи (в TestCase транзакция не фиксируется - вызываем сразу)
+        MediaJob.objects.enqueue('recipe_avatar', target_id=recipe.id)
+        with mock.patch('Backend.media_queue.transaction.on_commit', lambda callback: callback()):
+            self.assertEqual(self.work(), 1)
+        recipe.refresh_from_db()
+        self.assertNotEqual(recipe.avatar.name, old_name)
+        self.assertFalse(storage.exists(old_name))
+        with storage.open(recipe.avatar.name) as file:
+            image = Image.open(file)
+            self.assertEqual((image.size, len(image.getexif())), ((20, 40), 0))
+        self.assertTrue(recipe.avatar_digest)
+
+    def test_retry_and_failure(self):
+        job = MediaJob.objects.enqueue('delete_files', paths=['files/old.jpg'])
+        with mock.patch.dict('Backend.media_queue.processors', {'delete_files': mock.Mock(side_effect=OSError)}):
+            self.assertFalse(run_job(claim_job()))
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts), ('Q', 1))
+            self.assertIn('OSError', job.last_error)
+            # повтор - только после задержки
+            self.assertIsNone(claim_job())
+
+            MediaJob.objects.filter(id=job.id).update(run_after=timezone.now(), attempts=media_queue.max_attempts - 1)
+            self.assertFalse(run_job(claim_job()))
+            job.refresh_from_db()
+            self.assertEqual(job.status, 'F')
+            self.assertIsNone(claim_job())
+
+        # задача, брошенная упавшим обработчиком, выдаётся повторно по истечении срока
+        stale = MediaJob.objects.enqueue('delete_files', paths=['files/old.jpg'])
+        self.assertEqual(claim_job().id, stale.id)
+        self.assertIsNone(claim_job())
+        MediaJob.objects.filter(id=stale.id).update(run_after=timezone.now())
+        self.assertEqual(claim_job().attempts, 2)
+
+    def test_worker_errors(self):
+        jobs = [MediaJob.objects.enqueue('delete_files', paths=['a']) for _ in range(2)]
+        # сбой записи итога одной задачи не останавливает обработчик
+        with mock.patch('Backend.media_queue.run_job', side_effect=[OperationalError('gone away'), True]), \
+                mock.patch('Backend.media_queue.close_old_connections') as close_old_connections, \
+                mock.patch.object(media_queue.connection, 'close'), self.assertLogs('Backend.media_queue', 'ERROR'):
+            self.assertEqual(media_queue.work(once=True), 2)
+        self.assertEqual(close_old_connections.call_count, 3)
+        self.assertEqual([job.status for job in MediaJob.objects.order_by('id')], ['R', 'R'])
+        self.assertEqual(MediaJob.objects.filter(id__in=[job.id for job in jobs]).count(), 2)
+
+        # без --once недоступная БД не завершает обработчик
+        claims = [OperationalError('gone away'), KeyboardInterrupt]
+        with mock.patch('Backend.media_queue.claim_job', side_effect=claims), \
+                mock.patch('Backend.media_queue.time.sleep') as sleep, \
+                mock.patch.object(media_queue.connection, 'close'), self.assertLogs('Backend.media_queue', 'ERROR'):
+            with self.assertRaises(KeyboardInterrupt):
+                media_queue.work(poll_interval=5)
+        sleep.assert_called_once_with(5)
+
+    def test_supervisor(self):
+        started = []
+
+        class Process:
+            def __init__(self, target, args, daemon):
+                # первый обработчик падает, остальные завершаются, опустошив очередь
+                self.exitcode = 1 if not started else 0
+                self.pid = len(started)
+
+            def start(self):
+                started.append(self)
+
+            def is_alive(self):
+                return False
+
+        with mock.patch('Backend.management.commands.media_worker.multiprocessing.Process', Process), \
+                mock.patch('Backend.management.commands.media_worker.time.sleep'):
+            err = io.StringIO()
+            call_command('media_worker', '--processes', '2', '--once', stderr=err)
+        self.assertEqual(len(started), 3)
+        self.assertIn('Обработчик 0 завершился с кодом 1, перезапуск', err.getvalue())
+
+    def test_jobs_visibility(self):
+        own = MediaJob.objects.enqueue('delete_files', paths=['a'], creator_id=self.creator.id)
+        foreign = MediaJob.objects.enqueue('delete_files', paths=['b'], creator_id=self.other.id)
+
+        response = self.client.get('/media_jobs/', **self.auth)
+        self.assertEqual([job['id'] for job in response.data['jobs']], [own.id])
+        self.assertNotIn('queue', response.data)
+        self.assertEqual(self.client.get('/media_job_info/%i/' % foreign.id, **self.auth).status_code, 404)
+        self.assertEqual(self.client.get('/media_job_info/%i/' % own.id, **self.other_auth).status_code, 404)
+        self.assertEqual(self.client.get('/media_job_info/%i/' % own.id).status_code, 401)
+        self.assertEqual(self.client.get('/media_job_info/abc/', **self.staff_auth).status_code, 404)
+
+        # служебному аккаунту видны все задачи и сводка очереди
+        response = self.client.get('/media_jobs/', **self.staff_auth)
+        self.assertEqual([job['id'] for job in response.data['jobs']], [foreign.id, own.id])
+        self.assertEqual(response.data['queue'], {'Q': 2})
+        self.assertEqual(self.client.get('/media_job_info/%i/' % foreign.id, **self.staff_auth).status_code, 200)
+
+
+class GradesCheckTest(TestCase):
+    def setUp(self):
+        throttle_store.clear()
+        creator = Client.objects.create(username='creator', email='creator@example.com')
+        self.evaluator = Client.objects.create(username='evaluator', email='evaluator@example.com')
+        self.auth = {'HTTP_AUTHORIZATION': 'Token %s' % Token.objects.create(user=self.evaluator).key}
+        self.liked, self.disliked, self.ungraded, self.blocked = [
+            Recipe.objects.create(creator=creator, title='Рецепт %i' % index) for index in range(4)
+        ]
+        RecipeGrade.objects.upsert(self.evaluator, self.liked.id, True)
+        RecipeGrade.objects.upsert(self.evaluator, self.disliked.id, False)
+        RecipeGrade.objects.upsert(self.evaluator, self.blocked.id, True)
+        Recipe.objects.filter(id=self.blocked.id).update(status='B')
+        self.comments = [Comment.objects.create(creator=creator, recipe=self.liked, body='Вкусно') for _ in range(3)]
+        CommentGrade.objects.upsert(self.evaluator, self.comments[0].id, False)
+        CommentGrade.objects.upsert(self.evaluator, self.comments[2].id, True)
+        CommentGrade.objects.cancel(self.evaluator, self.comments[2].id)
+        # токен пользователя уже в кеше аутентификации
+        self.client.get('/client_info/', **self.auth)
+
+    def check(self, kind, ids):
+        return self.client.get('/%s_grades_check/' % kind, {'ids': ','.join(map(str, ids))}, **self.auth)
+
+    def test_single_query(self):
+        ids = [self.liked.id, self.disliked.id, self.ungraded.id, self.blocked.id, 0]
+        with self.assertNumQueries(1):
+            response = self.check('recipe', ids + [self.liked.id])
+        self.assertEqual(response.status_code, 200)
+        # оценка заблокированного рецепта не выдаётся, повторы id схлопываются
+        self.assertEqual(response.data['grades'], {self.liked.id: True, self.disliked.id: False,
+                                                   self.ungraded.id: None, self.blocked.id: None, 0: None})
+
+        with self.assertNumQueries(1):
+            response = self.check('comment', [comment.id for comment in self.comments])
+        self.assertEqual(response.data['grades'], {self.comments[0].id: False, self.comments[1].id: None,
+                                                   self.comments[2].id: None})
+
+    def test_single_check(self):
+        # отменённая оценка не выдаётся ни пакетной, ни одиночной проверкой
+        for kind, target, grade in (('recipe', self.liked, True), ('comment', self.comments[0], False)):
+            response = self.client.get('/%s_grade_check/%i/' % (kind, target.id), **self.auth)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['grade'], grade)
+        response = self.client.get('/comment_grade_check/%i/' % self.comments[2].id, **self.auth)
+        self.assertEqual(response.status_code, 404)
+
+    def test_invalid_comment_pk(self):
+        # нечисловой id комментария в пути - те же ответы, что и для несуществующего
+        for pk in ('abc', '0'):
+            response = self.client.post('/comment_grade_add/%s/' % pk, {'grade': True}, **self.auth)
+            self.assertEqual(response.status_code, 400)
+            response = self.client.get('/comment_grade_check/%s/' % pk, **self.auth)
+            self.assertEqual((response.status_code, response.data['grade']), (404, 'Оценка ещё не добавлена.'))
+            self.assertEqual(self.client.put('/comment_grade_cancel/%s/' % pk, **self.auth).status_code, 404)
+
+    def test_invalid_ids(self):
+        for kind in ('recipe', 'comment'):
+            for ids in (['abc'], [], list(range(1, max_page_size + 2))):
+                with self.assertNumQueries(0):
+                    response = self.check(kind, ids)
+                self.assertEqual(response.status_code, 400)
+            self.assertEqual(self.check(kind, list(range(1, max_page_size + 1))).status_code, 200)
+            self.assertEqual(self.client.get('/%s_grades_check/' % kind, {'ids': '1'}).status_code, 401)
+
+
+class RecipeInfoQueriesTest(TestCase):
+    comments_quantity = 200
+
+    def setUp(self):
+        response_cache().clear()
+        creator = Client.objects.create(username='creator', email='creator@example.com')
+        self.recipe = Recipe.objects.create(creator=creator, title='Наполеон')
+        Ingredient.objects.create(recipe=self.recipe, name='Мука', measure='500 г')
+        Ingredient.objects.create(recipe=self.recipe, name='Масло', measure='200 г')
+        CookStage.objects.create(recipe=self.recipe, description='Замесить тесто')
+        CookStage.objects.create(recipe=self.recipe, description='Испечь коржи')
+        Tag.objects.create(recipe=self.recipe, name='торт')
+
+        for index in range(self.comments_quantity):
+            commentator = Client.objects.create(username='commentator%i' % index,
+                                                email='commentator%i@example.com' % index)
+            comment = Comment.objects.create(creator=commentator, recipe=self.recipe, body='Комментарий')
+            grade = CommentGrade.objects.create(evaluator=creator, comment=comment, grade=bool(index % 2))
+            Comment.objects.filter(id=comment.id).change_rating(*grade.vote())
+
+    def test_recipe_info_constant_queries(self):
+        # рецепт с автором, ингредиенты, этапы, теги, первая страница комментариев с авторами, похожие рецепты
+        with self.assertNumQueries(6):
+            response = self.client.get('/recipe_info/%i/' % self.recipe.id)
+        self.assertEqual(response.status_code, 200)
+
+        comments = response.data['recipe']['comments']
+        self.assertEqual(len(comments), 10)
+        self.assertEqual(comments[0]['rating'], 1)
+        self.assertEqual(comments[1]['rating'], -1)
+        self.assertIsNotNone(response.data['comments_pagination']['next'])
+
+    def test_recipe_comments_pages(self):
+        url = '/recipe_comments/%i/' % self.recipe.id
+        seen = []
+        cursor = ''
+        while True:
+            response = self.client.get(url, {'ordering': 'top', 'page_size': 50, 'cursor': cursor})
+            self.assertEqual(response.status_code, 200)
+            seen += response.data['comments']
+            cursor = response.data['pagination']['next']
+            if not cursor:
+                break
+        self.assertEqual(len({comment['id'] for comment in seen}), self.comments_quantity)
+        self.assertEqual([comment['rating'] for comment in seen], [1] * 100 + [-1] * 100)
+        self.assertEqual(self.client.get('/recipe_comments/abc/').status_code, 404)
+
+
+class RecipeFormQueriesTest(TestCase):
+    def setUp(self):
+        self.creator = Client.objects.create(username='creator', email='creator@example.com')
+        self.data = {
+            'title': 'Торт',
+            'ingredients': [{'name': 'Ингредиент %i' % index, 'measure': '100 г'} for index in range(20)],
+            'cook_stages': [{'description': 'Этап %i' % index} for index in range(30)],
+            'tags': [{'name': 'тег%i' % index} for index in range(5)],
+        }
+
+    def test_create_bulk(self):
+        # транзакция, рецепт, пакеты ингредиентов, этапов и тегов, словари ингредиентов и тегов, очередь изображений
+        serializer = RecipeFormSerializer(data=self.data, context={'client': self.creator})
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        with self.assertNumQueries(13):
+            recipe = serializer.save()
+        self.assertEqual(recipe.ingredients.count(), 20)
+        self.assertEqual(recipe.cook_stages.count(), 30)
+        self.assertEqual(recipe.tags.count(), 5)
+
+    def test_update_keeps_rating(self):
+        serializer = RecipeFormSerializer(data=self.data, context={'client': self.creator})
+        serializer.is_valid()
+        recipe = serializer.save()
+        Recipe.objects.filter(id=recipe.id).change_rating(upvotes=2)
+
+        data = {'title': 'Торт', 'ingredients': [{'name': 'Мука', 'measure': '500 г'}], 'tags': []}
+        serializer = RecipeFormSerializer(instance=recipe, data=data, partial=True)
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        serializer.save()
+
+        recipe.refresh_from_db()
+        self.assertEqual(recipe.upvotes, 2)
+        self.assertEqual(list(recipe.ingredients.values_list('name', flat=True)), ['Мука'])
+        self.assertEqual(recipe.cook_stages.count(), 30)
+        self.assertEqual(recipe.tags.count(), 0)
+
+
+class ExplainQueriesTest(TestCase):
+    def setUp(self):
+        creator = Client.objects.create(username='creator', email='creator@example.com')
+        recipe = Recipe.objects.create(creator=creator, title='Наполеон')
+        Ingredient.objects.create(recipe=recipe, name='Мука', measure='500 г')
+        Tag.objects.create(recipe=recipe, name='торт')
+        Comment.objects.create(creator=creator, recipe=recipe, body='Вкусно')
+
+    def test_plans(self):
+        out = io.StringIO()
+        call_command('explain_queries', '--plans', stdout=out, no_color=True)
+        output = out.getvalue()
+        self.assertIn('Все запросы представлений используют индексы.', output)
+        for view in ('recipes_all (new)', 'recipe_info (similar)', 'recipe_comments (top)', 'login (username)',
+                     'recipe_grade_check (grade)', 'comment_grade_check (grade)', 'media_worker (claim)'):
+            self.assertIn(view + ':', output)
+        # полные просмотры допускаются только для запросов из allowed_scans
+        scans = re.findall(r'^(\w+) \(\w+\): полный просмотр', output, re.MULTILINE)
+        self.assertTrue(set(scans) <= {'tags_popular', 'ingredient_index'}, scans)
+
+
+class ResponseCacheTest(TestCase):
+    def setUp(self):
+        response_cache().clear()
+        throttle_store.clear()
+        self.creator = Client.objects.create(username='creator', email='creator@example.com')
+        self.recipe = Recipe.objects.create(creator=self.creator, title='Наполеон')
+        self.url = '/recipe_info/%i/' % self.recipe.id
+        self.auth = {'HTTP_AUTHORIZATION': 'Token %s' % Token.objects.create(user=self.creator).key}
+
+    def test_cached_until_write(self):
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(self.url)['ETag'], etag)
+            self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # комментарий сбрасывает страницу рецепта, но не списки рецептов
+        recipes_etag = self.client.get('/recipes_all/')['ETag']
+        response = self.client.post('/comment_add/%i/' % self.recipe.id, {'body': 'Вкусно'}, **self.auth)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.client.get('/recipes_all/')['ETag'], recipes_etag)
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(len(response.data['recipe']['comments']), 1)
+
+
+    def test_similar_cards(self):
+        # карточка похожего рецепта на закешированной странице обновляется вместе с ним
+        similar = Recipe.objects.create(creator=self.creator, title='Медовик')
+        RecipeNeighbour.objects.create(recipe=self.recipe, neighbour=similar, score=0.5)
+        etag = self.client.get(self.url)['ETag']
+        evaluator = Client.objects.create(username='evaluator', email='evaluator@example.com')
+        auth = {'HTTP_AUTHORIZATION': 'Token %s' % Token.objects.create(user=evaluator).key}
+        self.assertEqual(self.client.post('/recipe_grade_add/%i/' % similar.id, {'grade': True}, **auth).status_code,
+                         204)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.data['recipe']['similar'][0]['rating'], 1)
+
+        etag = response['ETag']
+        similar.title = 'Медовик классический'
+        similar.save()
+        recipe_changed.send(sender=Recipe, recipe_id=similar.id)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.data['recipe']['similar'][0]['title'], 'Медовик классический')
+
+        etag = response['ETag']
+        self.assertEqual(self.client.delete('/recipe_remove/%i/' % similar.id, **self.auth).status_code, 202)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).data['recipe']['similar'], [])
+
+
+class GradeUpsertTest(TestCase):
+    def setUp(self):
+        self.creator = Client.objects.create(username='creator', email='creator@example.com')
+        self.evaluator = Client.objects.create(username='evaluator', email='evaluator@example.com')
+        self.recipe = Recipe.objects.create(creator=self.creator, title='Наполеон')
+
+    def assertCounters(self, upvotes, downvotes):
+        self.recipe.refresh_from_db()
+        self.assertEqual((self.recipe.upvotes, self.recipe.downvotes, self.recipe.rating),
+                         (upvotes, downvotes, upvotes - downvotes))
+
+    def test_upsert_idempotent(self):
+        # транзакция, вставка без конфликта, блокировка строки, изменение оценки, изменение счётчиков
+        with self.assertNumQueries(6):
+            RecipeGrade.objects.upsert(self.evaluator, self.recipe.id, True)
+        # повторный голос с той же оценкой ничего не меняет
+        with self.assertNumQueries(4):
+            RecipeGrade.objects.upsert(self.evaluator, self.recipe.id, True)
+        self.assertCounters(1, 0)
+
+        RecipeGrade.objects.upsert(self.evaluator, self.recipe.id, False)
+        self.assertCounters(0, 1)
+        self.assertIsNotNone(RecipeGrade.objects.cancel(self.evaluator, self.recipe.id))
+        self.assertIsNotNone(RecipeGrade.objects.cancel(self.evaluator, self.recipe.id))
+        self.assertCounters(0, 0)
+        RecipeGrade.objects.upsert(self.evaluator, self.recipe.id, True)
+        self.assertCounters(1, 0)
+        self.assertEqual(RecipeGrade.objects.count(), 1)
+
+    def test_cancel_missing(self):
+        self.assertIsNone(RecipeGrade.objects.cancel(self.evaluator, self.recipe.id))
+        self.assertCounters(0, 0)
+
+
+class VoteBufferTest(TestCase):
+    def setUp(self):
+        response_cache().clear()
+        throttle_store.clear()
+        creator = Client.objects.create(username='creator', email='creator@example.com')
+        self.recipe = Recipe.objects.create(creator=creator, title='Наполеон')
+        self.evaluators = [
+            Client.objects.create(username='evaluator%i' % index, email='evaluator%i@example.com' % index)
+            for index in range(3)
+        ]
+        # сброс только вручную, без фонового потока
+        self.buffer = VoteBuffer(enabled=True, flush_interval=None)
+        patcher = mock.patch('Backend.views.vote_buffer', self.buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def vote(self, evaluator, grade):
+        token = Token.objects.get_or_create(user=evaluator)[0]
+        return self.client.post('/recipe_grade_add/%i/' % self.recipe.id, {'grade': grade},
+                                HTTP_AUTHORIZATION='Token %s' % token.key)
+
+    def test_flush(self):
+        first, second, third = self.evaluators
+        self.vote(first, True)
+        self.vote(second, True)
+        self.vote(second, False)
+        self.vote(third, True)
+
+        # голос виден автору сразу, но в БД ещё не записан
+        token = Token.objects.get(user=second)
+        response = self.client.get('/recipe_grade_check/%i/' % self.recipe.id,
+                                   HTTP_AUTHORIZATION='Token %s' % token.key)
+        self.assertEqual(response.data['grade'], False)
+        self.assertFalse(RecipeGrade.objects.exists())
+
+        self.assertEqual(self.buffer.flush(), 3)
+        self.recipe.refresh_from_db()
+        self.assertEqual((self.recipe.upvotes, self.recipe.downvotes, self.recipe.rating), (2, 1, 1))
+
+        response = self.client.put('/recipe_grade_cancel/%i/' % self.recipe.id,
+                                   HTTP_AUTHORIZATION='Token %s' % token.key)
+        self.assertEqual(response.status_code, 204)
+        self.buffer.flush()
+        self.recipe.refresh_from_db()
+        self.assertEqual((self.recipe.upvotes, self.recipe.downvotes, self.recipe.rating), (2, 0, 2))
+        self.assertEqual(RecipeGrade.objects.filter(status='A').count(), 2)
+
+    def test_invalid_pk(self):
+        # нечисловой id в пути - те же ответы, что и для несуществующего рецепта
+        auth = {'HTTP_AUTHORIZATION': 'Token %s' % Token.objects.get_or_create(user=self.evaluators[0])[0].key}
+        for pk in ('abc', '0'):
+            self.assertEqual(self.client.post('/recipe_grade_add/%s/' % pk, {'grade': True}, **auth).status_code, 400)
+            response = self.client.get('/recipe_grade_check/%s/' % pk, **auth)
+            self.assertEqual((response.status_code, response.data['grade']), (404, 'Оценка ещё не добавлена.'))
+            response = self.client.put('/recipe_grade_cancel/%s/' % pk, **auth)
+            self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.buffer.pending, {})
+
+
+class TrendingFeedTest(TestCase):
+    def setUp(self):
+        response_cache().clear()
+        creator = Client.objects.create(username='creator', email='creator@example.com')
+        self.old, self.fresh, self.quiet = [
+            Recipe.objects.create(creator=creator, title=title) for title in ('Наполеон', 'Медовик', 'Эклер')
+        ]
+        now = timezone.now()
+        for index in range(3):
+            evaluator = Client.objects.create(username='evaluator%i' % index, email='evaluator%i@example.com' % index)
+            # три голоса трёхдневной давности против одного свежего голоса и свежего комментария
+            RecipeGrade.objects.create(evaluator=evaluator, recipe=self.old,
+                                       date_change=now - datetime.timedelta(days=3))
+        RecipeGrade.objects.create(evaluator=evaluator, recipe=self.fresh, date_change=now)
+        Comment.objects.create(creator=evaluator, recipe=self.fresh, body='Вкусно')
+        # оценка без времени изменения (поставлена до появления поля) не учитывается
+        RecipeGrade.objects.create(evaluator=creator, recipe=self.quiet, date_change=None)
+
+    def test_refresh_and_feed(self):
+        self.assertEqual(refresh_trending(), 2)
+        # повторный пересчёт меняет только затухшие значения
+        self.assertEqual(refresh_trending(), 0)
+        self.assertEqual(refresh_trending(timezone.now() + datetime.timedelta(hours=1)), 2)
+
+        response = self.client.get('/recipes_feed/trending/?page_size=2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([recipe['id'] for recipe in response.data['recipes']], [self.fresh.id, self.old.id])
+        response = self.client.get('/recipes_feed/trending/?cursor=%s' % response.data['pagination']['next'])
+        self.assertEqual([recipe['id'] for recipe in response.data['recipes']], [self.quiet.id])
+
+        # активность вне окна обнуляет популярность
+        RecipeGrade.objects.filter(recipe=self.fresh).update(date_change=timezone.now() - datetime.timedelta(days=30))
+        Comment.objects.filter(recipe=self.fresh).update(status='B')
+        refresh_trending()
+        self.fresh.refresh_from_db()
+        self.assertEqual(self.fresh.trending, 0)
+
+        self.assertEqual(self.client.get('/recipes_feed/unknown/').status_code, 404)
+        self.assertEqual(self.client.get('/recipes_feed/top/?ordering=new').status_code, 400)
+
+
+class RecommendationsTest(TestCase):
+    def setUp(self):
+        response_cache().clear()
+        self.creator = Client.objects.create(username='creator', email='creator@example.com')
+        self.napoleon = self.recipe('Торт Наполеон', ['Мука', 'Масло сливочное', 'Молоко'], ['торт'])
+        self.honey = self.recipe('Торт Медовик', ['Мука', 'Мёд', 'Сметана'], ['торт'])
+        self.salad = self.recipe('Салат оливье', ['Картофель', 'Огурцы', 'Горошек'], ['салат'])
+
+    def recipe(self, title, ingredients, tags):
+        recipe = Recipe.objects.create(creator=self.creator, title=title)
+        for name in ingredients:
+            Ingredient.objects.create(recipe=recipe, name=name, measure='100 г')
+        for name in tags:
+            Tag.objects.create(recipe=recipe, name=name)
+        return recipe
+
+    def test_similar_and_recommended(self):
+        # у салата нет общих термов с тортами - список его соседей пуст
+        self.assertEqual(build_recommendations(), 2)
+        # без изменений данных списки не переписываются
+        self.assertEqual(build_recommendations(), 0)
+        similar = self.client.get('/recipe_info/%i/' % self.napoleon.id).data['recipe']['similar']
+        self.assertEqual(similar[0]['id'], self.honey.id)
+
+        # новый рецепт получает соседей и попадает в их списки
+        eclair = self.recipe('Торт эклер', ['Мука', 'Масло сливочное', 'Молоко'], ['торт'])
+        self.assertGreater(build_recommendations(new_only=True), 1)
+        self.assertEqual(RecipeNeighbour.objects.filter(recipe=eclair).first().neighbour_id, self.napoleon.id)
+        self.assertTrue(RecipeNeighbour.objects.filter(recipe=self.napoleon, neighbour=eclair).exists())
+        similar = self.client.get('/recipe_info/%i/' % self.napoleon.id).data['recipe']['similar']
+        self.assertEqual(similar[0]['id'], eclair.id)
+
+        evaluator = Client.objects.create(username='evaluator', email='evaluator@example.com')
+        RecipeGrade.objects.upsert(evaluator, self.napoleon.id, True)
+        RecipeGrade.objects.upsert(evaluator, eclair.id, False)
+        token = Token.objects.create(user=evaluator)
+        response = self.client.get('/recipes_recommended/', HTTP_AUTHORIZATION='Token %s' % token.key)
+        self.assertEqual(response.status_code, 200)
+        # оценённые пользователем рецепты не рекомендуются
+        self.assertEqual(response.data['recipes'][0]['id'], self.honey.id)
+        self.assertNotIn(eclair.id, [recipe['id'] for recipe in response.data['recipes']])
+
+
+    def test_nearest_neighbours_blocks(self):
+        # выбор лучших соседей из разреженных блоков совпадает с полным перебором плотной матрицы сходств
+        random = numpy.random.RandomState(0)
+        ids = list(range(10, 50))
+        content = sparse.csr_matrix(random.rand(40, 15) * (random.rand(40, 15) > 0.8))
+        likes = sparse.csr_matrix((random.rand(40, 6) > 0.7).astype(float))
+        options = {'neighbours': 3, 'likes_weight': 0.3, 'block_size': 7}
+        dense = (0.7 * (content @ content.T) + 0.3 * (likes @ likes.T)).toarray()
+        numpy.fill_diagonal(dense, 0)
+
+        neighbours = dict(nearest_neighbours(ids, content, likes, ids, options))
+        self.assertEqual(sorted(neighbours), ids)
+        for row, recipe_id in enumerate(ids):
+            expected = sorted(((-dense[row, column], ids[column]) for column in range(40) if dense[row, column] > 0))[:3]
+            self.assertEqual([neighbour_id for neighbour_id, _ in neighbours[recipe_id]],
+                             [neighbour_id for _, neighbour_id in expected])
+            for (_, score), (expected_score, _) in zip(neighbours[recipe_id], expected):
+                self.assertAlmostEqual(score, -expected_score, places=6)
+
+class IngredientSearchTest(TestCase):
+    def setUp(self):
+        response_cache().clear()
+        creator = Client.objects.create(username='creator', email='creator@example.com')
+        self.recipes = {}
+        for title, ingredients in [
+            ('Блины', ['Мука', 'Молоко', 'Яйца', 'Масло сливочное']),
+            ('Оладьи', ['Мука', 'Кефир', 'Яйца']),
+            ('Ореховый пирог', ['Мука', 'Яйца', 'Грецкие орехи', 'Масло сливочное']),
+            ('Омлет', ['Молоко', 'Яйцо']),
+        ]:
+            recipe = Recipe.objects.create(creator=creator, title=title)
+            for name in ingredients:
+                Ingredient.objects.create(recipe=recipe, name=name, measure='по вкусу')
+            self.recipes[title] = recipe.id
+        # перестроение индекса выполняется сразу, в потоке теста (фоновый поток не видит транзакцию теста)
+        self.rebuilds = []
+        self.patch('Backend.ingredients.threading.Thread', self.thread)
+        self.patch('Backend.ingredients.connection.close')
+        self.inline = True
+
+    def patch(self, target, new=mock.DEFAULT):
+        patcher = mock.patch(target, new)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def thread(self, target, args, daemon):
+        # inline - перестроить сразу; иначе перестроение откладывается до вызова из теста
+        return mock.Mock(start=lambda: target(*args) if self.inline else self.rebuilds.append((target, args)))
+
+    def search(self, **params):
+        response = self.client.get('/recipes_by_ingredients/', params)
+        self.assertEqual(response.status_code, 200)
+        return [recipe['id'] for recipe in response.data['recipes']]
+
+    def test_include_exclude_missing(self):
+        self.assertEqual(Ingredient.objects.filter(name='Масло сливочное').first().word.name,
+                         IngredientWord.normalize('сливочного масла'))
+        # 'яйцо' совпадает и с 'Яйца'
+        self.assertEqual(self.search(include='мука,яйцо'),
+                         [self.recipes['Ореховый пирог'], self.recipes['Оладьи'], self.recipes['Блины']])
+        self.assertEqual(self.search(include='мука,масло', exclude='орехи'), [self.recipes['Блины']])
+        # сначала рецепты со всеми ингредиентами, затем без одного (более новые раньше)
+        self.assertEqual(self.search(include='молоко,яйца,мука', missing=1),
+                         [self.recipes['Блины'], self.recipes['Омлет'], self.recipes['Ореховый пирог'],
+                          self.recipes['Оладьи']])
+        self.assertEqual(self.client.get('/recipes_by_ingredients/', {'exclude': 'мука'}).status_code, 400)
+
+    def test_background_rebuild(self):
+        self.assertEqual(self.search(include='кефир'), [self.recipes['Оладьи']])
+        # пока индекс перестраивается, поиск отвечает по прежнему индексу и второе перестроение не запускает
+        self.inline = False
+        creator = Client.objects.get(username='creator')
+        recipe = Recipe.objects.create(creator=creator, title='Манник')
+        Ingredient.objects.create(recipe=recipe, name='Кефир', measure='250 мл')
+        recipe_changed.send(sender=Recipe, recipe_id=recipe.id)
+        self.assertEqual(self.search(include='кефир'), [self.recipes['Оладьи']])
+        self.assertEqual(self.search(include='кефир'), [self.recipes['Оладьи']])
+        self.assertEqual(len(self.rebuilds), 1)
+
+        target, args = self.rebuilds.pop()
+        target(*args)
+        self.assertEqual(self.search(include='кефир'), [recipe.id, self.recipes['Оладьи']])
+        self.assertEqual(self.rebuilds, [])
+
+
+class RecipeSearchFacetsTest(TestCase):
+    def setUp(self):
+        response_cache().clear()
+        self.creator = Client.objects.create(username='creator', email='creator@example.com')
+        other = Client.objects.create(username='other', email='other@example.com')
+        for index, (cook_time, portions, tags) in enumerate([
+            (10, 2, ['торт']), (45, 4, ['торт', 'шоколад']), (90, 8, ['пирог']), (None, None, ['торт']),
+        ]):
+            recipe = Recipe.objects.create(creator=self.creator if index < 3 else other, title='Рецепт %i' % index,
+                                           cook_time=cook_time, portions=portions)
+            for name in tags:
+                Tag.objects.create(recipe=recipe, name=name)
+
+    def test_filters_and_facets(self):
+        response = self.client.get('/recipes_search/', {'cook_time_max': 60, 'tags': 'Торт'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([recipe['title'] for recipe in response.data['recipes']], ['Рецепт 1', 'Рецепт 0'])
+        facets = response.data['facets']
+        self.assertEqual([bucket['count'] for bucket in facets['cook_time']], [1, 0, 1, 0, 0, 0])
+        self.assertEqual(facets['tags'], [{'name': 'торт', 'recipes_count': 2},
+                                          {'name': 'шоколад', 'recipes_count': 1}])
+
+        # страница с авторами - один запрос, фасеты того же набора фильтров берутся из кеша
+        with self.assertNumQueries(1):
+            response = self.client.get('/recipes_search/', {'cook_time_max': 60, 'tags': 'торт', 'page_size': 1,
+                                                            'ordering': 'rating'})
+        self.assertEqual(response.data['facets'], facets)
+
+        response = self.client.get('/recipes_search/', {'author': 'other'})
+        self.assertEqual([recipe['title'] for recipe in response.data['recipes']], ['Рецепт 3'])
+        self.assertEqual(self.client.get('/recipes_search/', {'portions_min': 'много'}).status_code, 400)
+
+
+class AuthorSearchTest(TestCase):
+    def setUp(self):
+        response_cache().clear()
+        self.baker = Client.objects.create(username='BakerAnna', email='anna@example.com')
+        self.other = Client.objects.create(username='Bakery', email='bakery@example.com')
+        Client.objects.create(username='cookbaker', email='cook@example.com')
+        self.recipe = Recipe.objects.create(creator=self.baker, title='Наполеон')
+        Recipe.objects.create(creator=self.other, title='Медовик', status='B')
+
+    def test_prefix_lookup(self):
+        response = self.client.get('/authors_autocomplete/', {'prefix': 'bAkEr'})
+        self.assertEqual([author['username'] for author in response.data['authors']], ['BakerAnna', 'Bakery'])
+
+        # поиск по началу логина, а не по подстроке
+        response = self.client.get('/recipes_by_author/baker/')
+        self.assertEqual([recipe['id'] for recipe in response.data['recipes']], [self.recipe.id])
+
+        response = self.client.get('/author_recipes/%i/' % self.baker.id)
+        self.assertEqual([recipe['id'] for recipe in response.data['recipes']], [self.recipe.id])
+        self.assertEqual(self.client.get('/author_recipes/0/').status_code, 404)
+        self.assertEqual(self.client.get('/author_recipes/abc/').status_code, 404)
+
+        # ключ логина обновляется вместе с логином
+        self.baker.username = 'Pastry'
+        self.baker.save(update_fields=['username'])
+        self.assertEqual(Client.objects.get(id=self.baker.id).username_key, 'pastry')
+
+
+class RandomRecipesTest(TestCase):
+    def setUp(self):
+        creator = Client.objects.create(username='creator', email='creator@example.com')
+        self.active = {Recipe.objects.create(creator=creator, title='Рецепт %i' % index).id for index in range(8)}
+        self.blocked = Recipe.objects.create(creator=creator, title='Заблокированный', status='B')
+        patcher = mock.patch('Backend.views.recipe_sampler', RecipeSampler())
+        self.sampler = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_distinct_active(self):
+        # массив id читается один раз, затем - только запрос карточек
+        self.client.get('/recipes_random/5/')
+        for _ in range(10):
+            with self.assertNumQueries(1):
+                response = self.client.get('/recipes_random/5/')
+            ids = [recipe['id'] for recipe in response.data['recipes']]
+            self.assertEqual(len(ids), 5)
+            self.assertEqual(len(set(ids)), 5)
+            self.assertTrue(set(ids) <= self.active)
+
+        # рецепт, заблокированный после чтения массива, не выдаётся
+        Recipe.objects.filter(id__in=list(self.active)[:4]).update(status='B')
+        ids = [recipe['id'] for recipe in self.client.get('/recipes_random/8/').data['recipes']]
+        self.assertEqual(set(ids), set(list(self.active)[4:]))
+        self.assertEqual(self.client.get('/recipes_random/0/').status_code, 400)
+
+
+class CachedTokenAuthenticationTest(TestCase):
+    def setUp(self):
+        self.client_obj = Client.objects.create(username='client', email='client@example.com')
+        self.auth = {'HTTP_AUTHORIZATION': 'Token %s' % Token.objects.create(user=self.client_obj).key}
+
+    def test_cached_until_revoked(self):
+        # токен с пользователем читается из БД только при первом запросе
+        with self.assertNumQueries(2):
+            self.assertEqual(self.client.get('/client_info/', **self.auth).status_code, 200)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get('/client_info/', **self.auth).status_code, 200)
+
+        self.assertEqual(self.client.post('/logout/', **self.auth).status_code, 204)
+        self.assertEqual(self.client.get('/client_info/', **self.auth).status_code, 401)
+
+    def test_blocked(self):
+        self.assertEqual(self.client.get('/client_info/', **self.auth).status_code, 200)
+        self.client_obj.status = 'B'
+        self.client_obj.save()
+        self.assertEqual(self.client.get('/client_info/', **self.auth).status_code, 401)
+
+        # пакетная блокировка не отправляет post_save - кеш сбрасывается явно
+        Client.objects.filter(id=self.client_obj.id).update(status='A')
+        revoke_client_tokens([self.client_obj.id])
+        self.assertEqual(self.client.get('/client_info/', **self.auth).status_code, 200)
+        Client.objects.filter(id=self.client_obj.id).update(status='B')
+        self.assertEqual(self.client.get('/client_info/', **self.auth).status_code, 200)
+        revoke_client_tokens([self.client_obj.id])
+        self.assertEqual(self.client.get('/client_info/', **self.auth).status_code, 401)
+
+    @override_settings(CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+        'worker_a': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'worker_a'},
+        'worker_b': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'worker_b'},
+    })
+    def test_revoked_in_other_process(self):
+        # два процесса сервера, у каждого свой LocMemCache: он не используется как общий кеш
+        first, second = TokenCache(local_ttl=5, cache_alias='worker_a'), TokenCache(local_ttl=5, cache_alias='worker_b')
+        self.assertIsNone(first.cache())
+        with mock.patch('Backend.authentication.token_cache', first):
+            self.assertEqual(self.client.get('/client_info/', **self.auth).status_code, 200)
+        with mock.patch('Backend.authentication.token_cache', second):
+            self.assertEqual(self.client.post('/logout/', **self.auth).status_code, 204)
+        with mock.patch('Backend.authentication.token_cache', first):
+            # копия в LRU первого процесса живёт не дольше LOCAL_TTL
+            self.assertEqual(self.client.get('/client_info/', **self.auth).status_code, 200)
+            with mock.patch('Backend.authentication.time.monotonic', return_value=time.monotonic() + 6):
+                self.assertEqual(self.client.get('/client_info/', **self.auth).status_code, 401)
+
+    def test_shared_cache(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        caches_setting = {
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'tokens': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': directory.name},
+        }
+        with self.settings(CACHES=caches_setting):
+            first, second = TokenCache(cache_alias='tokens'), TokenCache(cache_alias='tokens')
+            first.set('key', 'value')
+            self.assertEqual(second.get('key'), 'value')
+            # отзыв в одном процессе удаляет запись общего кеша, в другом остаётся только копия LRU
+            second.revoke('key')
+            with mock.patch('Backend.authentication.time.monotonic', return_value=time.monotonic() + 6):
+                self.assertIsNone(first.get('key'))
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class PasswordHashingTest(TestCase):
+    def setUp(self):
+        throttle_store.clear()
+        self.client_obj = Client.objects.create(username='client', email='client@example.com')
+        self.client_obj.set_password('secret-password')
+        self.client_obj.save()
+
+    def login(self, password='secret-password'):
+        return self.client.post('/login/', {'username': 'client', 'password': password})
+
+    def test_rehash_on_login(self):
+        self.assertEqual(self.login('wrong-password').status_code, 400)
+        self.assertTrue(Client.objects.get(id=self.client_obj.id).password.startswith('md5$'))
+
+        # после смены первого алгоритма хеш пересчитывается при успешном входе
+        with self.settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.SHA1PasswordHasher',
+                                             'django.contrib.auth.hashers.MD5PasswordHasher']):
+            self.assertEqual(self.login('wrong-password').status_code, 400)
+            self.assertTrue(Client.objects.get(id=self.client_obj.id).password.startswith('md5$'))
+            self.assertEqual(self.login().status_code, 200)
+            self.assertTrue(Client.objects.get(id=self.client_obj.id).password.startswith('sha1$'))
+            self.assertEqual(self.login().status_code, 200)
+
+    def test_busy(self):
+        pool = HashingPool(workers=1, queue_size=0, wait=1, retry_after=3)
+        pool.slots.acquire()
+        with mock.patch('Backend.hashing.hashing_pool', pool):
+            response = self.login()
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response['Retry-After'], '3')
+            pool.slots.release()
+            self.assertEqual(self.login().status_code, 200)
+
+
+class ThrottlingTest(TestCase):
+    def setUp(self):
+        throttle_store.clear()
+        self.creator = Client.objects.create(username='creator', email='creator@example.com')
+        self.recipe = Recipe.objects.create(creator=self.creator, title='Наполеон')
+        self.auth = {'HTTP_AUTHORIZATION': 'Token %s' % Token.objects.create(user=self.creator).key}
+
+    @mock.patch('Backend.throttling.scope_limits', lambda scope: [('user', 3, 3 / 60)])
+    def test_user_bucket(self):
+        url = '/comment_add/%i/' % self.recipe.id
+        for _ in range(3):
+            self.assertEqual(self.client.post(url, {'body': 'Вкусно'}, **self.auth).status_code, 201)
+        # отказ - до разбора данных и без запросов к БД
+        with self.assertNumQueries(0):
+            response = self.client.post(url, {'body': 'Вкусно'}, **self.auth)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '20')
+        self.assertEqual(Comment.objects.filter(recipe=self.recipe).count(), 3)
+
+        # корзина пополняется со временем
+        with mock.patch('Backend.throttling.time.monotonic', return_value=time.monotonic() + 20):
+            self.assertEqual(self.client.post(url, {'body': 'Вкусно'}, **self.auth).status_code, 201)
+
+    def test_login_username_bucket(self):
+        # попытки подобрать пароль к одному логину ограничены независимо от адреса
+        for _ in range(5):
+            self.assertEqual(self.client.post('/login/', {'username': 'creator', 'password': 'wrong'}).status_code,
+                             400)
+        response = self.client.post('/login/', {'username': 'Creator', 'password': 'wrong'})
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(int(response['Retry-After']) > 0)
+        self.assertEqual(self.client.post('/login/', {'username': 'other', 'password': 'wrong'}).status_code, 400)
+
+    def test_forwarded_for(self):
+        # подставленный клиентом X-Forwarded-For не даёт новой корзины
+        for index in range(5):
+            response = self.client.post('/client_register/', {}, HTTP_X_FORWARDED_FOR='10.0.0.%i' % index)
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.post('/client_register/', {}, HTTP_X_FORWARDED_FOR='10.0.1.1').status_code, 429)
+
+        # за доверенным прокси адрес клиента - последний адрес цепочки, добавленный прокси
+        throttle_store.clear()
+        with self.settings(THROTTLING=dict(settings.THROTTLING, TRUSTED_PROXIES=['127.0.0.1', '10.1.0.1'])):
+            for index in range(5):
+                response = self.client.post('/client_register/', {},
+                                            HTTP_X_FORWARDED_FOR='10.0.0.%i, 192.0.2.1, 10.1.0.1' % index)
+                self.assertEqual(response.status_code, 400)
+            response = self.client.post('/client_register/', {}, HTTP_X_FORWARDED_FOR='10.0.0.9, 192.0.2.1')
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(self.client.post('/client_register/', {}, HTTP_X_FORWARDED_FOR='192.0.2.2').status_code,
+                             400)
+
+
+class CachedResponseRouterTest(TestCase):
+    def setUp(self):
+        response_cache().clear()
+        creator = Client.objects.create(username='creator', email='creator@example.com')
+        self.recipe = Recipe.objects.create(creator=creator, title='Наполеон')
+        self.token = Token.objects.create(user=creator).key
+        self.django_calls = 0
+        django_application = get_asgi_application()
+
+        async def counted(scope, receive, send):
+            self.django_calls += 1
+            await django_application(scope, receive, send)
+        self.router = CachedResponseRouter(counted)
+
+    def get(self, path, headers=()):
+        scope = {
+            'type': 'http', 'method': 'GET', 'path': path, 'root_path': '', 'query_string': b'',
+            'scheme': 'http', 'server': ('testserver', 80), 'client': ('127.0.0.1', 1000),
+            'headers': [(b'host', b'testserver')] + list(headers),
+        }
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+        async_to_sync(self.router)(scope, receive, send)
+        headers = dict(messages[0]['headers'])
+        return messages[0]['status'], headers, b''.join(message.get('body', b'') for message in messages[1:])
+
+    def test_served_from_cache(self):
+        path = '/recipe_info/%i/' % self.recipe.id
+        status, headers, body = self.get(path)
+        self.assertEqual(status, 200)
+        self.assertEqual(self.django_calls, 1)
+        # повторный запрос и запрос с ETag - без Django и без БД
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get(path), (status, headers, body))
+            self.assertEqual(self.get(path, [(b'if-none-match', headers[b'ETag'])])[0], 304)
+        self.assertEqual(self.django_calls, 1)
+
+        # другой формат ответа кешируется отдельно
+        self.assertEqual(self.get(path, [(b'accept', b'text/html')])[0], 200)
+        self.assertEqual(self.django_calls, 2)
+        # запись увеличивает версию области рецепта
+        recipe_changed.send(sender=Recipe, recipe_id=self.recipe.id)
+        self.assertEqual(self.get(path)[0], 200)
+        self.assertEqual(self.django_calls, 3)
+
+    def test_passed_to_django(self):
+        auth = [(b'authorization', ('Token %s' % self.token).encode())]
+        for _ in range(2):
+            self.assertEqual(self.get('/recipe_grade_check/%i/' % self.recipe.id, auth)[0], 404)
+            self.assertEqual(self.get('/recipe_info/%i/' % self.recipe.id, auth)[0], 200)
+            self.assertEqual(self.get('/recipe_info/0/')[0], 404)
+        self.assertEqual(self.django_calls, 6)
@@ -0,0 +1,152 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.throttling import BaseThrottle
+
+# Ограничение частоты запросов корзинами жетонов (настройка THROTTLING).
+# Правило области (вход, регистрация, комментарии, оценки) задаёт для каждого вида ключа - адреса клиента ('ip'),
+# пользователя ('user') и логина, под которым пытаются войти ('username'), - частоту вида '10/min': корзина вмещает
+# 10 жетонов и пополняется на 10 за минуту, запрос забирает жетон. Пустая корзина - ответ 429 с заголовком
+# Retry-After (секунды до появления жетона).
+# Корзины хранятся в памяти процесса (до MAX_ENTRIES, давно не использованные вытесняются - то есть снова полны),
+# проверка - несколько микросекунд без обращения к БД. С CACHE корзины хранятся в общем кеше и действуют
+# на все процессы сервера; чтение и запись корзины там не атомарны (get - пересчёт - set), поэтому режим
+# общего кеша - приблизительный: одновременные запросы из разных процессов могут потратить один и тот же жетон,
+# и лимит превышается не больше чем на число одновременно обрабатываемых запросов.
+# Адрес клиента - REMOTE_ADDR. Заголовок X-Forwarded-For клиент может подставить любой, поэтому он учитывается,
+# только если запрос пришёл с адреса из TRUSTED_PROXIES (обратный прокси перед сервером): адресом клиента
+# считается последний адрес цепочки, не принадлежащий доверенным прокси.
+
+
+def parse_rate(rate):
+    # '10/min' -> (ёмкость корзины, пополнение в секунду)
+    count, period = rate.split('/')
+    duration = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[period[0]]
+    return int(count), int(count) / duration
+
+
+@lru_cache(maxsize=None)
+def scope_limits(scope):
+    # [(вид ключа, ёмкость, пополнение в секунду), ...] правила области scope
+    policy = getattr(settings, 'THROTTLING', {}).get('POLICIES', {}).get(scope, {})
+    return [(kind,) + parse_rate(rate) for kind, rate in policy.items()]
+
+
+def client_address(request):
+    remote_addr = request.META.get('REMOTE_ADDR', '')
+    trusted = getattr(settings, 'THROTTLING', {}).get('TRUSTED_PROXIES', ())
+    if remote_addr not in trusted:
+        return remote_addr
+    forwarded = [address.strip() for address in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')]
+    for address in reversed(forwarded):
+        if address and address not in trusted:
+            return address
+    return remote_addr
+
+
+class BucketStore:
+    def __init__(self, max_entries=100000, cache_alias=None):
+        self.max_entries = max_entries
+        self.cache_alias = cache_alias
+        # ключ -> (жетонов в корзине, момент пересчёта по time.monotonic)
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        options = getattr(settings, 'THROTTLING', {})
+        return cls(
+            max_entries=options.get('MAX_ENTRIES', 100000),
+            cache_alias=options.get('CACHE', None),
+        )
+
+    @staticmethod
+    def spend(tokens, updated, now, capacity, refill):
+        tokens = min(capacity, tokens + max(now - updated, 0) * refill)
+        if tokens >= 1:
+            return tokens - 1, 0
+        return tokens, (1 - tokens) / refill
+
+    def take(self, key, capacity, refill):
+        # забирает жетон из корзины key: 0, если запрос разрешён, иначе секунды до появления жетона
+        if self.cache_alias is not None:
+            return self.take_shared(key, capacity, refill)
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (capacity, now))
+            tokens, wait = self.spend(tokens, updated, now, capacity, refill)
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.max_entries:
+                self.buckets.popitem(last=False)
+        return wait
+
+    def take_shared(self, key, capacity, refill):
+        # в общем кеше время по time.time: монотонные часы у процессов свои
+        cache = caches[self.cache_alias]
+        cache_key = 'throttle:%s' % key
+        now = time.time()
+        tokens, updated = cache.get(cache_key, (capacity, now))
+        tokens, wait = self.spend(tokens, updated, now, capacity, refill)
+        # корзина, которая успеет наполниться, из кеша не нужна
+        cache.set(cache_key, (tokens, now), timeout=math.ceil(capacity / refill))
+        return wait
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+throttle_store = BucketStore.from_settings()
+
+
+class BucketThrottle(BaseThrottle):
+    # scope - имя правила в THROTTLING['POLICIES']
+    scope = None
+
+    def __init__(self):
+        self.wait_time = 0
+
+    def identify(self, kind, request):
+        if kind == 'ip':
+            return client_address(request)
+        if kind == 'user':
+            return request.user.id if request.user.is_authenticated else None
+        if kind == 'username':
+            username = request.data.get('username', None)
+            return str(username).strip().lower() if username else None
+        return None
+
+    def allow_request(self, request, view):
+        for kind, capacity, refill in scope_limits(self.scope):
+            ident = self.identify(kind, request)
+            if ident is None:
+                continue
+            wait = throttle_store.take('%s:%s:%s' % (self.scope, kind, ident), capacity, refill)
+            if wait:
+                self.wait_time = wait
+                return False
+        return True
+
+    def wait(self):
+        return math.ceil(self.wait_time)
+
+
+class LoginThrottle(BucketThrottle):
+    scope = 'login'
+
+
+class RegisterThrottle(BucketThrottle):
+    scope = 'register'
+
+
+class CommentThrottle(BucketThrottle):
+    scope = 'comment'
+
+
+class GradeThrottle(BucketThrottle):
+    scope = 'grade'
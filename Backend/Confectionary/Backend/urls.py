@@ -11,8 +11,16 @@ urlpatterns = [
     path('recipe_add/', recipe_add),
     path('recipes_by_title/<str:search_title>/', recipes_by_title),
     path('recipes_by_tag/<str:search_tag>/', recipes_by_tag),
+    path('recipes_by_ingredients/', recipes_by_ingredients),
+    path('recipes_search/', recipes_search),
+    path('tags_popular/', tags_popular),
     path('recipes_by_author/<str:search_author>/', recipes_by_author),
+    path('authors_autocomplete/', authors_autocomplete),
+    path('author_recipes/<str:pk>/', author_recipes),
     path('recipes_all/', recipes_all),
+    path('recipes_feed/<str:kind>/', recipes_feed),
+    path('recipes_random/<str:quantity>/', recipes_random),
+    path('recipes_recommended/', recipes_recommended),
     path('recipe_info/<str:pk>/', recipe_info),
     path('recipe_edit/<str:pk>/', recipe_edit),
     path('recipe_remove/<str:pk>/', recipe_remove),
@@ -24,19 +32,23 @@ urlpatterns = [
     path('client_edit/', client_edit),
     path('client_password_change/', client_pass_change),
 
+    path('recipe_comments/<str:recipe_pk>/', recipe_comments),
     path('comment_add/<str:recipe_pk>/', comment_add),
     path('comment_remove/<str:pk>/', comment_remove),
 
     path('recipe_grade_add/<str:recipe_pk>/', recipe_grade_add),
     path('recipe_grade_check/<str:recipe_pk>/', recipe_grade_check),
+    path('recipe_grades_check/', recipe_grades_check),
     path('recipe_grade_cancel/<str:recipe_pk>/', recipe_grade_cancel),
 
     path('comment_grade_add/<str:comment_pk>/', comment_grade_add),
     path('comment_grade_check/<str:comment_pk>/', comment_grade_check),
-    path('comment_grade_cancel/<str:comment_pk>/', comment_grade_cancel)
+    path('comment_grades_check/', comment_grades_check),
+    path('comment_grade_cancel/<str:comment_pk>/', comment_grade_cancel),
+
+    path('media_jobs/', media_jobs),
+    path('media_job_info/<str:pk>/', media_job_info)
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
 
 # path('recipe_grade_inverse/<str:recipe_pk>/', recipe_grade_inverse),
-# path('comment_grade_inverse/<str:comment_pk>/', comment_grade_inverse),
-
-# path('Recipes/random/<str:quantity>/', recipes_random),
\ No newline at end of file
+# path('comment_grade_inverse/<str:comment_pk>/', comment_grade_inverse),
\ No newline at end of file
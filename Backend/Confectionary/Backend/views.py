@@ -1,15 +1,29 @@
-import shutil
-
+from django.db import transaction
+from django.db.models import Count, Sum
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.parsers import JSONParser, FormParser, MultiPartParser
-from rest_framework.decorators import api_view, permission_classes, parser_classes
+from rest_framework.decorators import api_view, permission_classes, parser_classes, throttle_classes
 
 from rest_framework import generics, status
 from djoser import utils
 from djoser.conf import settings as djoser_settings
 
 from .serializers import *
+from .pagination import paginate, paginate_ids, recipe_orderings, comment_orderings, max_page_size
+from .search import search_index, remove_recipe_index
+from .ingredients import ingredient_index
+from .facets import filter_recipes, recipe_facets
+from .sampling import recipe_sampler
+from .hashing import check_client_password, set_client_password
+from .throttling import LoginThrottle, RegisterThrottle, CommentThrottle, GradeThrottle
+from .cache import cached_response
+from .signals import recipe_changed, recipe_grade_changed, comment_changed, client_changed
+from .votes import vote_buffer
+
+# сколько последних положительных оценок пользователя и сколько рекомендаций учитывается в recipes_recommended
+recommendation_sources = 50
+max_recommendations = 200
 
 messages = {
     'USER_DOES_NOT_EXISTS': 'Пользователь не существует.',
@@ -32,16 +46,104 @@ messages = {
     'NO_GRADE_YET': 'Оценка ещё не добавлена.',
     'GRADE_NOT_ACCESSIBLE': 'Оценка не существует или заблокирована для изменения.',
     'FIELD_MISMATCH': 'Ни одно поле формы не соответствует принимаемому формату.',
+    'PAGE_INVALID': 'Некорректные параметры страницы.',
+    'FEED_NOT_FOUND': 'Лента рецептов не существует.',
+    'INGREDIENTS_INVALID': 'Некорректный список ингредиентов.',
+    'FILTER_INVALID': 'Некорректные параметры фильтра.',
+    'MEDIA_JOB_NOT_ACCESSIBLE': 'Задача обработки медиафайлов не существует или недоступна.',
 }
 
 
+def caller_grades(request, grades, field, ids):
+    # оценки текущего пользователя для набора объектов одним запросом: id объекта -> оценка
+    if not (request.user.is_authenticated and ids):
+        return {}
+    return dict(grades.filter(evaluator=request.user, status='A', **{field + '__in': ids}).values_list(field, 'grade'))
+
+
+def caller_recipe_grades(request, ids, grades=RecipeGrade.objects):
+    # то же для рецептов, с учётом ещё не применённых голосов из буфера отложенной записи
+    recipe_grades = caller_grades(request, grades, 'recipe_id', ids)
+    if vote_buffer.enabled and request.user.is_authenticated and ids:
+        for recipe_id, (grade, grade_status) in vote_buffer.overlay(request.user.id, ids).items():
+            if grade_status == 'A':
+                recipe_grades[recipe_id] = grade
+            else:
+                recipe_grades.pop(recipe_id, None)
+    return recipe_grades
+
+
+def parse_ids(request):
+    # список id из параметра ?ids=1,2,3 (не больше одной страницы); None - параметр некорректен
+    try:
+        ids = list(dict.fromkeys(int(pk) for pk in request.query_params.get('ids', '').split(',') if pk))
+    except ValueError:
+        return None
+    if not ids or len(ids) > max_page_size:
+        return None
+    return ids
+
+
+def parse_pk(pk):
+    # id объекта из пути URL; None - не число (ORM и буфер голосов ждут целое)
+    try:
+        return int(pk)
+    except ValueError:
+        return None
+
+
+def paginated_recipes(request, recipes, serializer_class, orderings=None, default_ordering='new'):
+    # выдаём одну страницу рецептов вместо всей выборки (автор карточки - в том же запросе)
+    try:
+        page, pagination = paginate(request, recipes.select_related('creator'), orderings, default_ordering)
+    except ValueError:
+        return Response(
+            data={'message': messages['PAGE_INVALID']},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    grades = caller_recipe_grades(request, [recipe.id for recipe in page])
+    serializer = serializer_class(page, many=True, context={'grades': grades})
+    return Response(data={'recipes': serializer.data, 'pagination': pagination}, status=status.HTTP_200_OK)
+
+
+def ranked_recipes(request, ids, serializer_class):
+    # выдаём страницу рецептов в порядке ранжированного списка id
+    active_ids = set(Recipe.objects.filter(id__in=ids, status='A').values_list('id', flat=True))
+    try:
+        page, pagination = paginate_ids(request, [pk for pk in ids if pk in active_ids])
+    except ValueError:
+        return Response(
+            data={'message': messages['PAGE_INVALID']},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    recipes = Recipe.objects.select_related('creator').in_bulk(page)
+    grades = caller_recipe_grades(request, page)
+    serializer = serializer_class([recipes[pk] for pk in page if pk in recipes], many=True, context={'grades': grades})
+    return Response(data={'recipes': serializer.data, 'pagination': pagination}, status=status.HTTP_200_OK)
+
+
+def recipe_comments_page(request, recipe_id):
+    # страница активных комментариев рецепта; бросает ValueError при некорректных параметрах страницы
+    comments = Comment.objects.select_related('creator').filter(recipe_id=recipe_id, status='A')
+    return paginate(request, comments, comment_orderings)
+
+
+def similar_recipes(recipe_id):
+    # похожие активные рецепты одним запросом по индексу (recipe, score) таблицы соседей
+    return list(Recipe.objects.filter(neighbour_of__recipe_id=recipe_id, status='A').order_by(
+        '-neighbour_of__score', 'id'
+    ))
+
+
 class CustomTokenCreateView(utils.ActionViewMixin, generics.GenericAPIView):
     serializer_class = djoser_settings.SERIALIZERS.token_create
     permission_classes = djoser_settings.PERMISSIONS.token_create
     parser_classes = [JSONParser, FormParser, MultiPartParser]
+    throttle_classes = [LoginThrottle]
 
     def _action(self, serializer):
-        if Client.objects.get_by_natural_key(serializer.user.username).status == 'A':
+        # пользователь уже прочитан при проверке логина и пароля
+        if serializer.user.status == 'A':
             token = utils.login_user(self.request, serializer.user)
             token_serializer_class = djoser_settings.SERIALIZERS.token
             return Response(
@@ -57,6 +159,7 @@ class CustomTokenCreateView(utils.ActionViewMixin, generics.GenericAPIView):
 
 @api_view(['GET'])
 @permission_classes([AllowAny])
+@cached_response('recipes', 'clients')
 def recipes_all(request):
     try:
         recipes = Recipe.objects.filter(status='A')
@@ -65,60 +168,183 @@ def recipes_all(request):
             data={'message': messages['RECIPES_NONE']},
             status=status.HTTP_404_NOT_FOUND
         )
-    serializer = RecipeCardSerializer(recipes, many=True)
+    return paginated_recipes(request, recipes, RecipeCardSerializer)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def recipes_random(request, quantity):
+    # quantity различных случайных активных рецептов (см. sampling.py)
+    try:
+        quantity = int(quantity)
+    except ValueError:
+        quantity = None
+    if quantity is None or not 1 <= quantity <= max_page_size:
+        return Response(
+            data={'message': messages['FIELD_MISMATCH']},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    ids = recipe_sampler.sample(quantity)
+    recipes = Recipe.objects.select_related('creator').filter(status='A').in_bulk(ids)
+    page = [recipes[pk] for pk in ids if pk in recipes][:quantity]
+    grades = caller_recipe_grades(request, [recipe.id for recipe in page])
+    serializer = RecipeCardSerializer(page, many=True, context={'grades': grades})
     return Response(data={'recipes': serializer.data}, status=status.HTTP_200_OK)
 
 
+# ленты рецептов: имя ленты -> порядок выдачи из recipe_orderings
+recipe_feeds = {
+    'new': 'new',
+    'top': 'rating',
+    'trending': 'trending',
+}
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+@cached_response('recipes', 'clients')
+def recipes_feed(request, kind):
+    if kind not in recipe_feeds:
+        return Response(
+            data={'message': messages['FEED_NOT_FOUND']},
+            status=status.HTTP_404_NOT_FOUND
+        )
+    # порядок ленты фиксирован, параметр ordering принимает только её собственное имя
+    orderings = {kind: recipe_orderings[recipe_feeds[kind]]}
+    return paginated_recipes(request, Recipe.objects.filter(status='A'), RecipeCardSerializer, orderings, kind)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def recipes_recommended(request):
+    # соседи рецептов, недавно оценённых пользователем положительно, кроме уже оценённых им рецептов;
+    # сходства соседа с разными рецептами складываются
+    liked = RecipeGrade.objects.filter(evaluator=request.user, status='A', grade=True).order_by(
+        '-date_change', '-id'
+    ).values_list('recipe_id', flat=True)[:recommendation_sources]
+    graded = RecipeGrade.objects.filter(evaluator=request.user, status='A').values('recipe_id')
+    ids = RecipeNeighbour.objects.filter(recipe_id__in=list(liked)).exclude(neighbour_id__in=graded).values(
+        'neighbour_id'
+    ).annotate(total=Sum('score')).order_by('-total', 'neighbour_id').values_list('neighbour_id', flat=True)
+    return ranked_recipes(request, list(ids[:max_recommendations]), RecipeCardSerializer)
+
+
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def recipes_by_title(request, search_title):
+    # полнотекстовый поиск по наименованию, тегам, ингредиентам и описаниям этапов
+    return ranked_recipes(request, search_index.search(search_title), RecipeCardSerializer)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+@cached_response('recipes', 'clients', 'ingredient_index')
+def recipes_by_ingredients(request):
+    # ?include=мука,молоко - ингредиенты, которые есть; ?exclude=орехи - ингредиенты, которых быть не должно;
+    # ?missing=1 - сколько ингредиентов из include может не хватать рецепту
+    include = [name for name in request.query_params.get('include', '').split(',') if name.strip()]
+    exclude = [name for name in request.query_params.get('exclude', '').split(',') if name.strip()]
     try:
-        recipes = Recipe.objects.filter(status='A', title__icontains=search_title)
-    except Recipe.DoesNotExist:
+        missing = int(request.query_params.get('missing', 0))
+    except ValueError:
+        missing = None
+    if not include or len(include) + len(exclude) > RecipeFormSerializer.max_ingredients or \
+            missing is None or missing < 0:
         return Response(
-            data={'message': messages['RECIPES_NONE_TITLE']},
-            status=status.HTTP_404_NOT_FOUND
+            data={'message': messages['INGREDIENTS_INVALID']},
+            status=status.HTTP_400_BAD_REQUEST
         )
-    serializer = RecipeCardSerializer(recipes, many=True)
-    return Response(data={'recipes': serializer.data}, status=status.HTTP_200_OK)
+    return ranked_recipes(request, ingredient_index.search(include, exclude, missing), RecipeCardSerializer)
 
 
 @api_view(['GET'])
 @permission_classes([AllowAny])
-def recipes_by_tag(request, search_tag):
+@cached_response('recipes', 'clients')
+def recipes_search(request):
+    # фильтры и фасеты - см. facets.py; порядок и страницы - как в recipes_all
     try:
-        recipes = Recipe.objects.filter(
-            status='A',
-            fixed_tags__in=(
-                Tag.objects.filter(name__icontains=search_tag)
-            )
+        recipes = filter_recipes(request.query_params)
+    except ValueError:
+        return Response(
+            data={'message': messages['FILTER_INVALID']},
+            status=status.HTTP_400_BAD_REQUEST
         )
-    except Recipe.DoesNotExist:
+    response = paginated_recipes(request, recipes, RecipeCardSerializer)
+    if response.status_code == status.HTTP_200_OK:
+        response.data['facets'] = recipe_facets(request.query_params, recipes)
+    return response
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def recipes_by_tag(request, search_tag):
+    word = TagWord.normalize(search_tag)
+    # ?match=prefix - все теги, начинающиеся с введённой строки; иначе точное совпадение тега
+    # (слова словаря уже нормализованы, поэтому префикс - это диапазон ключа уникального индекса на любой СУБД)
+    if request.query_params.get('match', None) == 'prefix':
+        words = TagWord.objects.filter(name__gte=word, name__lt=word + '\uffff')
+    else:
+        words = TagWord.objects.filter(name=word)
+    recipes = Recipe.objects.filter(status='A', tag_words__in=words).distinct()
+    return paginated_recipes(request, recipes, RecipeCardSerializer)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def tags_popular(request):
+    try:
+        quantity = max(1, min(int(request.query_params.get('quantity', 20)), 100))
+    except ValueError:
         return Response(
-            data={'message': messages['RECIPES_NONE_TAG']},
-            status=status.HTTP_404_NOT_FOUND
+            data={'message': messages['FIELD_MISMATCH']},
+            status=status.HTTP_400_BAD_REQUEST
         )
-    serializer = RecipeCardSerializer(recipes, many=True)
-    return Response(data={'recipes': serializer.data}, status=status.HTTP_200_OK)
+    tags = TagWord.objects.filter(tags__recipe__status='A').annotate(
+        recipes_count=Count('tags__recipe', distinct=True)
+    ).order_by('-recipes_count', 'name')[:quantity]
+    serializer = TagWordSerializer(tags, many=True)
+    return Response(data={'tags': serializer.data}, status=status.HTTP_200_OK)
 
 
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def recipes_by_author(request, search_author):
+    # рецепты авторов, логин которых начинается с введённой строки (без учёта регистра)
+    recipes = Recipe.objects.filter(status='A', creator__in=Client.objects.username_prefix(search_author))
+    return paginated_recipes(request, recipes, RecipeCardSerializer)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def authors_autocomplete(request):
+    # ?prefix=... - начало логина, ?quantity=... - количество подсказок
     try:
-        recipes = Recipe.objects.filter(
-            status='A',
-            creator__in=(
-                Client.objects.filter(username__icontains=search_author)
-            )
+        quantity = max(1, min(int(request.query_params.get('quantity', 10)), max_page_size))
+    except ValueError:
+        return Response(
+            data={'message': messages['FIELD_MISMATCH']},
+            status=status.HTTP_400_BAD_REQUEST
         )
-    except Recipe.DoesNotExist:
+    prefix = request.query_params.get('prefix', '')
+    if not prefix:
+        return Response(data={'authors': []}, status=status.HTTP_200_OK)
+    authors = Client.objects.username_prefix(prefix).filter(status='A').order_by('username_key')[:quantity]
+    serializer = ClientRecipePageSerializer(authors, many=True)
+    return Response(data={'authors': serializer.data}, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+@cached_response('recipes', 'clients')
+def author_recipes(request, pk):
+    # рецепты одного автора (индекс creator, status, date_init, id)
+    pk = parse_pk(pk)
+    if pk is None or not Client.objects.filter(id=pk).exists():
         return Response(
-            data={'message': messages['RECIPES_NONE_AUTHOR']},
+            data={'message': messages['USER_DOES_NOT_EXISTS']},
             status=status.HTTP_404_NOT_FOUND
         )
-    serializer = RecipeCardSerializer(recipes, many=True)
-    return Response(data={'recipes': serializer.data}, status=status.HTTP_200_OK)
+    return paginated_recipes(request, Recipe.objects.filter(status='A', creator=pk), RecipeCardSerializer)
 
 
 @api_view(['GET'])
@@ -131,26 +357,67 @@ def client_recipes(request):
             data={'message': messages['RECIPES_NONE']},
             status=status.HTTP_404_NOT_FOUND
         )
-    serializer = RecipeCardForCreatorSerializer(recipes, many=True)
-    return Response(data={'recipes': serializer.data}, status=status.HTTP_200_OK)
+    return paginated_recipes(request, recipes, RecipeCardForCreatorSerializer)
 
 
 @api_view(['GET'])
 @permission_classes([AllowAny])
+@cached_response('recipe:{pk}', 'clients')
 def recipe_info(request, pk):
     try:
-        recipe = Recipe.objects.get(id=pk, status='A')
+        recipe = RecipePageSerializer.setup_eager_loading(Recipe.objects).get(id=pk, status='A')
     except Recipe.DoesNotExist:
         return Response(
             data={'message': messages['RECIPES_NONE_ACCESSIBLE']},
             status=status.HTTP_404_NOT_FOUND
         )
-    serializer = RecipePageSerializer(recipe)
-    return Response(data={'recipe': serializer.data}, status=status.HTTP_200_OK)
+    try:
+        comments, comments_pagination = recipe_comments_page(request, recipe.id)
+    except ValueError:
+        return Response(
+            data={'message': messages['PAGE_INVALID']},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    grades = caller_recipe_grades(request, [recipe.id])
+    comment_grades = caller_grades(request, CommentGrade.objects, 'comment_id', [comment.id for comment in comments])
+    serializer = RecipePageSerializer(recipe, context={
+        'comments': comments,
+        'similar': similar_recipes(recipe.id),
+        'grades': grades,
+        'comment_grades': comment_grades
+    })
+    return Response(
+        data={'recipe': serializer.data, 'comments_pagination': comments_pagination},
+        status=status.HTTP_200_OK
+    )
 
 
 @api_view(['GET'])
 @permission_classes([AllowAny])
+@cached_response('recipe:{recipe_pk}', 'clients')
+def recipe_comments(request, recipe_pk):
+    # ?ordering=new|top, ?cursor - курсор следующей страницы из предыдущего ответа
+    recipe_pk = parse_pk(recipe_pk)
+    if recipe_pk is None or not Recipe.objects.filter(id=recipe_pk, status='A').exists():
+        return Response(
+            data={'message': messages['RECIPES_NONE_ACCESSIBLE']},
+            status=status.HTTP_404_NOT_FOUND
+        )
+    try:
+        comments, pagination = recipe_comments_page(request, recipe_pk)
+    except ValueError:
+        return Response(
+            data={'message': messages['PAGE_INVALID']},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    grades = caller_grades(request, CommentGrade.objects, 'comment_id', [comment.id for comment in comments])
+    serializer = CommentSerializer(comments, many=True, context={'comment_grades': grades})
+    return Response(data={'comments': serializer.data, 'pagination': pagination}, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+@cached_response('client:{pk}')
 def client_info(request, pk):
     try:
         client = Client.objects.get(id=pk)
@@ -180,6 +447,7 @@ def client_self_info(request):
 @api_view(['POST'])
 @parser_classes([JSONParser, FormParser, MultiPartParser])
 @permission_classes([AllowAny])
+@throttle_classes([RegisterThrottle])
 def client_reg(request):
     new_client = ClientFormSerializer(data=request.data, partial=True)
     if new_client.is_valid():
@@ -225,6 +493,7 @@ def client_edit(request):
             if avatar_reset:
                 new_client.reset_avatar()
             new_client.save()
+            client_changed.send(sender=Client, client_id=old_client.id)
             return Response(
                 data={'message': messages['USER_EDITED']},
                 status=status.HTTP_202_ACCEPTED
@@ -244,8 +513,8 @@ def client_pass_change(request):
     passwords = ClientPasswordChangeSerializer(data=request.data)
     if passwords.is_valid():
         if passwords.validated_data:
-            if client.check_password(passwords.data.get('old_password')):
-                client.set_password(passwords.data.get('new_password'))
+            if check_client_password(client, passwords.data.get('old_password')):
+                set_client_password(client, passwords.data.get('new_password'))
                 client.save()
             return Response(
                 data={'message': messages['PASSWORD_RESET']},
@@ -265,7 +534,8 @@ def recipe_add(request):
     new_recipe = RecipeFormSerializer(data=request.data, context={'client': request.user}, partial=True)
     if new_recipe.is_valid():
         if new_recipe.validated_data:
-            new_recipe.save()
+            recipe = new_recipe.save()
+            recipe_changed.send(sender=Recipe, recipe_id=recipe.id)
             return Response(
                 data={'message': messages['RECIPE_ADDED']},
                 status=status.HTTP_201_CREATED
@@ -317,17 +587,15 @@ def recipe_edit(request, pk):
 
     if new_recipe.is_valid():
         if new_recipe.validated_data:
-            # физически зачищаем все сброшенные картинки
-            if pictures_reset:
-                index = 0
-                for cook_stage in new_recipe.cook_stages:
-                    if pictures_reset[index]:
-                        cook_stage.reset_picture()
-                    index += 1
-            if avatar_reset:
-                new_recipe.reset_avatar()
-
-            new_recipe.save()
+            with transaction.atomic():
+                # физически зачищаем все сброшенные картинки
+                if pictures_reset:
+                    new_recipe.reset_pictures(pictures_reset)
+                if avatar_reset:
+                    new_recipe.reset_avatar()
+
+                new_recipe.save()
+            recipe_changed.send(sender=Recipe, recipe_id=old_recipe.id)
             return Response(
                 data={'message': messages['RECIPE_EDITED']},
                 status=status.HTTP_202_ACCEPTED
@@ -351,13 +619,17 @@ def recipe_remove(request, pk):
         )
 
     # зачищаем соответствующие данные рецепта в ФС
-    # подготавливаем системный путь возможно созданного каталога файлов
-    rm_path = settings.BASE_DIR + settings.MEDIA_URL + recipe_avatar_upload_path(recipe, '')
+    # подготавливаем путь (относительно MEDIA_ROOT) возможно созданного каталога файлов
+    rm_path = recipe_avatar_upload_path(recipe, '')
     rm_dir = 'recipes/%i' % recipe.id
-    # пробуем удалить каталог со всеми связанными изображениями
-    shutil.rmtree(path=rm_path[0: (rm_path.find(rm_dir) + len(rm_dir))], ignore_errors=True)
+    # каталог со всеми связанными изображениями удалит обработчик очереди медиафайлов
+    MediaJob.objects.enqueue('delete_dir', paths=[rm_path[0: (rm_path.find(rm_dir) + len(rm_dir))]],
+                             creator_id=request.user.id)
 
+    remove_recipe_index(recipe.id)
+    recipe_id = recipe.id
     recipe.delete()
+    recipe_changed.send(sender=Recipe, recipe_id=recipe_id)
     return Response(
         data={'message': messages['RECIPE_REMOVED']},
         status=status.HTTP_202_ACCEPTED
@@ -367,6 +639,7 @@ def recipe_remove(request, pk):
 @api_view(['POST'])
 @parser_classes([JSONParser, FormParser, MultiPartParser])
 @permission_classes([IsAuthenticated])
+@throttle_classes([CommentThrottle])
 def comment_add(request, recipe_pk):
     new_comment = CommentFormSerializer(
         data=request.data,
@@ -375,6 +648,7 @@ def comment_add(request, recipe_pk):
     if new_comment.is_valid(raise_exception=False):
         if new_comment.validated_data:
             new_comment.save()
+            comment_changed.send(sender=Comment, recipe_id=recipe_pk)
             return Response(
                 data={'message': messages['COMMENT_ADDED']},
                 status=status.HTTP_201_CREATED
@@ -397,6 +671,7 @@ def comment_remove(request, pk):
             status=status.HTTP_404_NOT_FOUND
         )
     comment.delete()
+    comment_changed.send(sender=Comment, recipe_id=comment.recipe_id)
     return Response(
         data={'message': messages['COMMENT_REMOVED']},
         status=status.HTTP_202_ACCEPTED
@@ -406,21 +681,21 @@ def comment_remove(request, pk):
 @api_view(['POST'])
 @parser_classes([JSONParser, FormParser, MultiPartParser])
 @permission_classes([IsAuthenticated])
+@throttle_classes([GradeThrottle])
 def recipe_grade_add(request, recipe_pk):
-    if Recipe.objects.filter(id=recipe_pk, status='A').exists():
-        try:
-            old_grade = RecipeGrade.objects.get(
-                recipe=Recipe.objects.get(id=recipe_pk),
-                evaluator=request.user
-            )
-            new_grade = RecipeGradeFormSerializer(instance=old_grade, data=request.data)
-        except RecipeGrade.DoesNotExist:
-            new_grade = RecipeGradeFormSerializer(
-                data=request.data,
-                context={'evaluator': request.user, 'recipe_id': recipe_pk})
+    recipe_pk = parse_pk(recipe_pk)
+    if recipe_pk is not None and Recipe.objects.filter(id=recipe_pk, status='A').exists():
+        new_grade = RecipeGradeFormSerializer(
+            data=request.data,
+            context={'evaluator': request.user, 'recipe_id': recipe_pk})
         if new_grade.is_valid():
             if new_grade.validated_data:
-                new_grade.save()
+                if vote_buffer.enabled:
+                    # голос применит буфер отложенной записи (см. votes.py)
+                    vote_buffer.record(request.user.id, recipe_pk, new_grade.validated_data['grade'])
+                else:
+                    new_grade.save()
+                    recipe_grade_changed.send(sender=RecipeGrade, recipe_id=recipe_pk)
                 return Response(status=status.HTTP_204_NO_CONTENT)
             return Response(
                 data={'message': messages['FIELD_MISMATCH']},
@@ -436,6 +711,22 @@ def recipe_grade_add(request, recipe_pk):
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def recipe_grade_check(request, recipe_pk):
+    recipe_pk = parse_pk(recipe_pk)
+    if recipe_pk is None:
+        return Response(
+            data={'grade': messages['NO_GRADE_YET']},
+            status=status.HTTP_404_NOT_FOUND
+        )
+    if vote_buffer.enabled:
+        # свой голос виден сразу, даже если ещё не применён
+        vote = vote_buffer.overlay(request.user.id, [recipe_pk]).get(recipe_pk, None)
+        if vote is not None:
+            if vote[1] == 'A':
+                return Response(data={'grade': vote[0]}, status=status.HTTP_200_OK)
+            return Response(
+                data={'grade': messages['NO_GRADE_YET']},
+                status=status.HTTP_404_NOT_FOUND
+            )
     try:
         grade = RecipeGrade.objects.get(
             status='A',
@@ -453,44 +744,67 @@ def recipe_grade_check(request, recipe_pk):
     )
 
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def recipe_grades_check(request):
+    # ?ids=1,2,3 - оценки текущего пользователя для страницы рецептов (null - оценки нет)
+    ids = parse_ids(request)
+    if ids is None:
+        return Response(
+            data={'message': messages['FIELD_MISMATCH']},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    grades = caller_recipe_grades(request, ids, RecipeGrade.objects.filter(recipe__status='A'))
+    return Response(data={'grades': {pk: grades.get(pk) for pk in ids}}, status=status.HTTP_200_OK)
+
+
 @api_view(['PUT'])
 @permission_classes([IsAuthenticated])
 def recipe_grade_cancel(request, recipe_pk):
-    try:
-        grade = RecipeGrade.objects.get(
-            evaluator=request.user,
-            recipe__in=Recipe.objects.filter(id=recipe_pk, status='A')
-        )
-    except RecipeGrade.DoesNotExist:
+    recipe_pk = parse_pk(recipe_pk)
+    if recipe_pk is None:
         return Response(
             data={'message': messages['GRADE_NOT_ACCESSIBLE']},
             status=status.HTTP_404_NOT_FOUND
         )
+    if vote_buffer.enabled:
+        vote = vote_buffer.overlay(request.user.id, [recipe_pk]).get(recipe_pk, None)
+        if vote is None and not RecipeGrade.objects.filter(
+                evaluator=request.user, recipe_id=recipe_pk, recipe__status='A').exists():
+            return Response(
+                data={'message': messages['GRADE_NOT_ACCESSIBLE']},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        vote_buffer.record(request.user.id, recipe_pk, None, 'B')
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
     # не удаляем, а только блокируем
-    grade.status = 'B'
-    grade.save()
+    grade = RecipeGrade.objects.cancel(request.user, recipe_pk)
+    if grade is None:
+        return Response(
+            data={'message': messages['GRADE_NOT_ACCESSIBLE']},
+            status=status.HTTP_404_NOT_FOUND
+        )
+    recipe_grade_changed.send(sender=RecipeGrade, recipe_id=grade.recipe_id)
     return Response(status=status.HTTP_204_NO_CONTENT)
 
 
 @api_view(['POST'])
 @parser_classes([JSONParser, FormParser, MultiPartParser])
 @permission_classes([IsAuthenticated])
+@throttle_classes([GradeThrottle])
 def comment_grade_add(request, comment_pk):
-    if Comment.objects.filter(id=comment_pk, status='A').exists():
-        try:
-            old_grade = CommentGrade.objects.get(
-                comment=Comment.objects.get(id=comment_pk),
-                evaluator=request.user
-            )
-            new_grade = CommentGradeFormSerializer(instance=old_grade, data=request.data)
-        except CommentGrade.DoesNotExist:
-            new_grade = CommentGradeFormSerializer(
-                data=request.data,
-                context={'evaluator': request.user, 'comment_id': comment_pk}
-            )
+    comment_pk = parse_pk(comment_pk)
+    comment = Comment.objects.filter(id=comment_pk, status='A').only('id', 'recipe_id').first()
+    if comment is not None:
+        new_grade = CommentGradeFormSerializer(
+            data=request.data,
+            context={'evaluator': request.user, 'comment_id': comment_pk}
+        )
         if new_grade.is_valid():
             if new_grade.validated_data:
                 new_grade.save()
+                comment_changed.send(sender=CommentGrade, recipe_id=comment.recipe_id)
                 return Response(status=status.HTTP_204_NO_CONTENT)
             return Response(
                 data={'message': messages['FIELD_MISMATCH']},
@@ -506,8 +820,15 @@ def comment_grade_add(request, comment_pk):
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def comment_grade_check(request, comment_pk):
+    comment_pk = parse_pk(comment_pk)
+    if comment_pk is None:
+        return Response(
+            data={'grade': messages['NO_GRADE_YET']},
+            status=status.HTTP_404_NOT_FOUND
+        )
     try:
         grade = CommentGrade.objects.get(
+            status='A',
             evaluator=request.user,
             comment__in=Comment.objects.filter(id=comment_pk, status='A')
         )
@@ -519,20 +840,66 @@ def comment_grade_check(request, comment_pk):
     return Response(data={'grade': grade.grade}, status=status.HTTP_200_OK)
 
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def comment_grades_check(request):
+    # ?ids=1,2,3 - оценки текущего пользователя для страницы комментариев (null - оценки нет)
+    ids = parse_ids(request)
+    if ids is None:
+        return Response(
+            data={'message': messages['FIELD_MISMATCH']},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    grades = caller_grades(request, CommentGrade.objects.filter(comment__status='A'), 'comment_id', ids)
+    return Response(data={'grades': {pk: grades.get(pk) for pk in ids}}, status=status.HTTP_200_OK)
+
+
 @api_view(['PUT'])
 @permission_classes([IsAuthenticated])
 def comment_grade_cancel(request, comment_pk):
-    try:
-        grade = CommentGrade.objects.get(
-            evaluator=request.user,
-            comment__in=Comment.objects.filter(id=comment_pk, status='A')
-        )
-    except CommentGrade.DoesNotExist:
+    comment_pk = parse_pk(comment_pk)
+    if comment_pk is None:
         return Response(
             data={'message': messages['GRADE_NOT_ACCESSIBLE']},
             status=status.HTTP_404_NOT_FOUND
         )
     # не удаляем, а только блокируем
-    grade.status = 'B'
-    grade.save()
-    return Response(status=status.HTTP_204_NO_CONTENT)
\ No newline at end of file
+    grade = CommentGrade.objects.cancel(request.user, comment_pk)
+    if grade is None:
+        return Response(
+            data={'message': messages['GRADE_NOT_ACCESSIBLE']},
+            status=status.HTTP_404_NOT_FOUND
+        )
+    comment_changed.send(sender=CommentGrade, recipe_id=grade.comment.recipe_id)
+    return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def media_jobs(request):
+    # последние задачи обработки медиафайлов текущего пользователя (служебному аккаунту - все и сводка очереди)
+    jobs = MediaJob.objects.order_by('-id')
+    if not request.user.is_staff:
+        jobs = jobs.filter(creator=request.user)
+    serializer = MediaJobSerializer(jobs[:50], many=True)
+    data = {'jobs': serializer.data}
+    if request.user.is_staff:
+        data['queue'] = dict(MediaJob.objects.values_list('status').annotate(Count('id')).order_by())
+    return Response(data=data, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def media_job_info(request, pk):
+    jobs = MediaJob.objects.all()
+    if not request.user.is_staff:
+        jobs = jobs.filter(creator=request.user)
+    try:
+        job = jobs.get(id=parse_pk(pk))
+    except MediaJob.DoesNotExist:
+        return Response(
+            data={'message': messages['MEDIA_JOB_NOT_ACCESSIBLE']},
+            status=status.HTTP_404_NOT_FOUND
+        )
+    serializer = MediaJobSerializer(job)
+    return Response(data={'job': serializer.data}, status=status.HTTP_200_OK)
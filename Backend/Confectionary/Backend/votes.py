@@ -0,0 +1,169 @@
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .signals import recipe_grade_changed
+
+logger = logging.getLogger(__name__)
+
+# Отложенная запись голосов за рецепты (включается настройкой VOTE_BUFFER).
+# Голос не пишется в БД в самом запросе, а попадает в буфер процесса: последняя оценка пользователя за рецепт
+# заменяет предыдущую. Фоновый поток раз в FLUSH_INTERVAL секунд (или запрос, переполнивший буфер до MAX_PENDING)
+# применяет весь буфер одной транзакцией: строки RecipeGrade - пакетными INSERT/UPDATE, счётчики - одним UPDATE
+# на рецепт за пакет, поэтому строка популярного рецепта блокируется раз в интервал, а не на каждый голос.
+# При аварийном завершении процесса теряются голоса не старше FLUSH_INTERVAL секунд и не больше MAX_PENDING штук.
+# Копия неприменённых голосов лежит в кеше CACHE, поэтому пользователь сразу видит свою оценку (recipe_grade_check,
+# поле grade карточек), в том числе в других процессах сервера, если кеш общий.
+
+
+class VoteBuffer:
+    def __init__(self, enabled=False, flush_interval=2.0, max_pending=1000, cache_alias='default'):
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.cache_alias = cache_alias
+        # (id пользователя, id рецепта) -> (оценка, статус); отмена оценки - (None, 'B')
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+
+    @classmethod
+    def from_settings(cls):
+        options = getattr(settings, 'VOTE_BUFFER', {})
+        return cls(
+            enabled=options.get('ENABLED', False),
+            flush_interval=options.get('FLUSH_INTERVAL', 2.0),
+            max_pending=options.get('MAX_PENDING', 1000),
+            cache_alias=options.get('CACHE', 'default'),
+        )
+
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def cache_key(self, evaluator_id, recipe_id):
+        return 'vote:%s:%s' % (recipe_id, evaluator_id)
+
+    def record(self, evaluator_id, recipe_id, grade, status='A'):
+        key = (int(evaluator_id), int(recipe_id))
+        with self.lock:
+            self.pending[key] = (grade, status)
+            overflow = len(self.pending) >= self.max_pending
+        # копия нужна только до применения голоса, после него оценка читается из БД
+        self.cache().set(self.cache_key(*key), (grade, status), timeout=(self.flush_interval or 0) * 10 + 60)
+        if overflow:
+            self.flush()
+        else:
+            self.ensure_thread()
+
+    def overlay(self, evaluator_id, recipe_ids):
+        # неприменённые голоса пользователя: id рецепта -> (оценка, статус)
+        recipe_ids = [int(recipe_id) for recipe_id in recipe_ids]
+        keys = {self.cache_key(evaluator_id, recipe_id): recipe_id for recipe_id in recipe_ids}
+        votes = {keys[key]: vote for key, vote in self.cache().get_many(list(keys)).items()}
+        with self.lock:
+            for recipe_id in recipe_ids:
+                if (evaluator_id, recipe_id) in self.pending:
+                    votes[recipe_id] = self.pending[(evaluator_id, recipe_id)]
+        return votes
+
+    def flush(self):
+        # применяет накопленные голоса; возвращает их количество
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, {}
+            if not batch:
+                return 0
+            try:
+                recipe_ids = apply_votes(batch)
+            except Exception:
+                # возвращаем голоса в буфер, не затирая поступившие за время сброса
+                with self.lock:
+                    for key, vote in batch.items():
+                        self.pending.setdefault(key, vote)
+                logger.exception('Не удалось применить %i голосов за рецепты', len(batch))
+                return 0
+        for recipe_id in recipe_ids:
+            recipe_grade_changed.send(sender=VoteBuffer, recipe_id=recipe_id)
+        return len(batch)
+
+    def ensure_thread(self):
+        if not self.flush_interval or (self.thread is not None and self.thread.is_alive()):
+            return
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='vote-buffer', daemon=True)
+                self.thread.start()
+                atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            finally:
+                # соединение с БД принадлежит этому потоку
+                connection.close()
+
+
+def apply_votes(batch):
+    # batch: (id пользователя, id рецепта) -> (оценка, статус); возвращает id рецептов с изменившимся рейтингом
+    from .models import Client, Recipe, RecipeGrade
+
+    with transaction.atomic():
+        # голоса за удалённые или заблокированные рецепты и от удалённых пользователей отбрасываются
+        recipe_ids = set(Recipe.objects.filter(
+            id__in={recipe_id for _, recipe_id in batch}, status='A'
+        ).values_list('id', flat=True))
+        evaluator_ids = set(Client.objects.filter(
+            id__in={evaluator_id for evaluator_id, _ in batch}
+        ).values_list('id', flat=True))
+        batch = {(evaluator_id, recipe_id): vote for (evaluator_id, recipe_id), vote in batch.items()
+                 if recipe_id in recipe_ids and evaluator_id in evaluator_ids}
+        if not batch:
+            return []
+
+        # недостающие строки вставляются без вклада в рейтинг (как в GradeQuerySet.upsert)
+        RecipeGrade.objects.bulk_create([
+            RecipeGrade(evaluator_id=evaluator_id, recipe_id=recipe_id, grade=grade, status='B')
+            for (evaluator_id, recipe_id), (grade, status) in batch.items() if status == 'A'
+        ], ignore_conflicts=True)
+        grades = RecipeGrade.objects.select_for_update().filter(
+            recipe_id__in={recipe_id for _, recipe_id in batch},
+            evaluator_id__in={evaluator_id for evaluator_id, _ in batch}
+        )
+
+        changed = []
+        deltas = {}
+        now = timezone.now()
+        for grade in grades:
+            vote = batch.get((grade.evaluator_id, grade.recipe_id), None)
+            if vote is None:
+                continue
+            new_grade, new_status = vote
+            if new_grade is None:
+                new_grade = grade.grade
+            if (grade.grade, grade.status) == (new_grade, new_status):
+                continue
+            old_upvotes, old_downvotes = grade.vote()
+            grade.grade = new_grade
+            grade.status = new_status
+            grade.date_change = now
+            new_upvotes, new_downvotes = grade.vote()
+            upvotes, downvotes = deltas.get(grade.recipe_id, (0, 0))
+            deltas[grade.recipe_id] = (upvotes + new_upvotes - old_upvotes, downvotes + new_downvotes - old_downvotes)
+            changed.append(grade)
+
+        RecipeGrade.objects.bulk_update(changed, ['grade', 'status', 'date_change'])
+        for recipe_id, (upvotes, downvotes) in deltas.items():
+            Recipe.objects.filter(id=recipe_id).change_rating(upvotes, downvotes)
+    return list(deltas)
+
+
+vote_buffer = VoteBuffer.from_settings()
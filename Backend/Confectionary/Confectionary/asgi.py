@@ -13,4 +13,10 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Confectionary.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# импорт после настройки Django (get_asgi_application)
+from Backend.asgi_cache import CachedResponseRouter
+
+# кешированные ответы отдаются без перехода в поток (см. Backend/asgi_cache.py)
+application = CachedResponseRouter(django_application)
@@ -84,6 +84,47 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# первый алгоритм хеширует новые пароли; хеши остальных пересчитываются им при следующем входе
+# (см. Backend/hashing.py, сравнение алгоритмов - команда bench_hashers)
+PASSWORD_HASHERS = [
+    'django.contrib.auth.hashers.PBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+]
+
+AUTHENTICATION_BACKENDS = ['Backend.hashing.PooledModelBackend']
+
+# пул хеширования паролей (см. Backend/hashing.py): одновременно считаемые и ожидающие хеши,
+# наибольшее ожидание результата и значение Retry-After ответа 503 в секундах
+PASSWORD_HASHING = {
+    'WORKERS': 2,
+    'QUEUE': 20,
+    'WAIT': 5,
+    'RETRY_AFTER': 2,
+}
+
+# ограничение частоты запросов (см. Backend/throttling.py): частоты по адресу клиента, пользователю
+# и логину входа для каждой области, размер хранилища корзин процесса, общий кеш корзин (None - только процесс)
+# и адреса обратных прокси, которым доверяется заголовок X-Forwarded-For
+THROTTLING = {
+    'POLICIES': {
+        'login': {'ip': '20/min', 'username': '5/min'},
+        'register': {'ip': '5/hour'},
+        'comment': {'user': '10/min', 'ip': '30/min'},
+        'grade': {'user': '60/min', 'ip': '300/min'},
+    },
+    'MAX_ENTRIES': 100000,
+    'CACHE': None,
+    'TRUSTED_PROXIES': [],
+}
+
+DJOSER = {
+    'SERIALIZERS': {
+        'token_create': 'Backend.serializers.ClientTokenCreateSerializer',
+    },
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/3.0/topics/i18n/
 
@@ -106,6 +147,64 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# файл локального полнотекстового индекса рецептов (пересоздаётся командой rebuild_search_index)
+SEARCH_INDEX_PATH = os.path.join(BASE_DIR, 'search_index.sqlite3')
+
+# кеш ответов на анонимные запросы чтения (см. Backend/cache.py):
+# LocMemCache вытесняет по LRU при превышении MAX_ENTRIES и по TIMEOUT, но существует только внутри процесса;
+# при нескольких процессах сервера нужен общий кеш - FileBasedCache (LOCATION - каталог)
+# или локальный Redis ('BACKEND': 'django_redis.cache.RedisCache', 'LOCATION': 'redis://127.0.0.1:6379/1')
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'responses': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'responses',
+        'TIMEOUT': 600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 5000,
+        },
+    },
+}
+RESPONSE_CACHE_ALIAS = 'responses'
+
+# отложенная запись голосов за рецепты (см. Backend/votes.py):
+# голоса копятся в памяти процесса и применяются пакетом раз в FLUSH_INTERVAL секунд или по достижении MAX_PENDING;
+# это же граница потерь голосов при аварийном завершении процесса. CACHE - кеш копий неприменённых голосов
+VOTE_BUFFER = {
+    'ENABLED': False,
+    'FLUSH_INTERVAL': 2.0,
+    'MAX_PENDING': 1000,
+    'CACHE': 'default',
+}
+
+# лента популярных рецептов (см. Backend/rankings.py, команда refresh_rankings):
+# окно учитываемой активности, время уменьшения вклада вдвое и вес комментария относительно оценки
+RANKINGS = {
+    'WINDOW_DAYS': 7,
+    'HALF_LIFE_HOURS': 24,
+    'COMMENT_WEIGHT': 0.5,
+}
+
+# похожие рецепты (см. Backend/recommendations.py, команда build_recommendations): количество соседей рецепта,
+# вес сходства по общим положительным оценкам относительно сходства содержания и число строк в блоке вычислений
+RECOMMENDATIONS = {
+    'NEIGHBOURS': 10,
+    'LIKES_WEIGHT': 0.3,
+    'BLOCK_SIZE': 500,
+}
+
+# кеш аутентификации по токену (см. Backend/authentication.py): размер и время жизни LRU процесса
+# (наибольшая задержка отзыва токена в других процессах сервера), время жизни записи в общем кеше CACHE;
+# CACHE - псевдоним кеша, общего для всех процессов (Redis, FileBasedCache), None - только LRU процесса
+AUTH_TOKEN_CACHE = {
+    'MAX_ENTRIES': 10000,
+    'LOCAL_TTL': 5,
+    'SHARED_TTL': 60,
+    'CACHE': None,
+}
+
 CURRENT_PREFIX = 'http://Tuna-Muna-60338.portmap.host:60338'
 # CURRENT_PREFIX = '188.243.62.96:8000'
 # 192.168.1.52
@@ -115,7 +214,7 @@ AUTH_USER_MODEL = 'Backend.Client'
 REST_FRAMEWORK = {
     "DEFAULT_PERMISSION_CLASSES": ("rest_framework.permissions.IsAuthenticated",),
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework.authentication.TokenAuthentication",
+        "Backend.authentication.CachedTokenAuthentication",
     ),
     'PAGE_SIZE': 10,
     'EXCEPTION_HANDLER': 'rest_framework_json_api.exceptions.exception_handler',